@@ -0,0 +1,49 @@
+"""Throughput of uncached connection lookups against the number of threads.
+
+Every lookup misses the connections cache, so it costs a GCS metadata request and
+a download. The fake storage client holds at most `--pool-size` requests in flight,
+like the HTTP connection pool set with `http_pool_size`, so the table shows where
+throughput stops scaling with the thread count.
+
+    python benchmarks/bench_concurrency.py --threads 1 2 4 8 16 --pool-size 10
+"""
+import argparse
+import time
+
+from bench_backend import run
+from fakes import FakeKmsClient, FakeStorageClient, Latency, fake_backend, populate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--gcs-latency', type=float, default=10, help='milliseconds per GCS request')
+    parser.add_argument('--kms-latency', type=float, default=20, help='milliseconds per KMS request')
+    parser.add_argument('--pool-size', type=int, default=10, help='GCS requests in flight, 0 for unbounded')
+    parser.add_argument('--iterations', type=int, default=400)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    storage_client = FakeStorageClient(Latency(args.gcs_latency / 1e3), max_connections=args.pool_size)
+    kms_client = FakeKmsClient(Latency(args.kms_latency / 1e3))
+    conn_ids = populate(storage_client, kms_client, connections=args.connections, variables=0)
+    from airflow.models.connection import Connection
+    from google.cloud.kms import DecryptRequest  # noqa: F401
+    Connection(conn_id='warm_up')
+
+    # one backend for all runs, its data key stays cached and only GCS is on the path
+    backend = fake_backend(storage_client, kms_client, connections_cache_max_size=0, connections_index_ttl=None)
+    backend.get_connection(conn_ids[0])
+
+    print("{:>7} {:>10} {:>8}".format('threads', 'ops/s', 'speedup'))
+    baseline = None
+    for threads in args.threads:
+        start = time.perf_counter()
+        run(backend.get_connection, conn_ids, args.iterations, threads)
+        throughput = args.iterations / (time.perf_counter() - start)
+        baseline = baseline or throughput
+        print("{:>7} {:>10.0f} {:>7.1f}x".format(threads, throughput, throughput / baseline))
+
+
+if __name__ == '__main__':
+    main()
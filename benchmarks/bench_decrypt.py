@@ -0,0 +1,68 @@
+"""Per-leaf decryption cost of `_walk_and_decrypt`.
+
+Compares the batched walk against the per-leaf routine it replaced, which
+rebuilt the value regex, re-ran the sops version checks and created a new
+AES-GCM decryptor for every leaf.
+
+    python benchmarks/bench_decrypt.py --leaves 2000 --size 256
+"""
+import argparse
+import copy
+import os
+import re
+import timeit
+
+from base64 import b64decode
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, modes, algorithms
+from airflow_sops.helpers import SOPS_INPUT_VERSION, _a_is_newer_than_b, _walk_and_decrypt, _walk_and_encrypt
+
+
+def _baseline_decrypt(value, key, aad=b''):
+    """The per-leaf path as shipped in 0.0.5."""
+    valre = b'^ENC\\[AES256_GCM,data:(.+),iv:(.+),tag:(.+)'
+    if _a_is_newer_than_b(SOPS_INPUT_VERSION, '0.8'):
+        valre += b',type:(.+)'
+    valre += b'\\]'
+    res = re.match(valre, value.encode('utf-8'))
+    if res is None:
+        return value
+    enc_value = b64decode(res.group(1))
+    iv = b64decode(res.group(2))
+    tag = b64decode(res.group(3))
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(iv, tag), default_backend()).decryptor()
+    decryptor.authenticate_additional_data(aad)
+    return (decryptor.update(enc_value) + decryptor.finalize()).decode('utf-8')
+
+
+def _baseline_walk(branch, key):
+    for k, v in branch.items():
+        if k == 'sops':
+            continue
+        if not _a_is_newer_than_b(SOPS_INPUT_VERSION, '0.9'):
+            raise NotImplementedError
+        branch[k] = _baseline_decrypt(v, key, aad=k.encode('utf-8') + b':')
+    return branch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leaves', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=64, help='cleartext bytes per leaf')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    document = {'leaf_{}'.format(i): 'x' * args.size for i in range(args.leaves)}
+    document['sops'] = {'gcp_kms': []}
+    encrypted = _walk_and_encrypt(document, key)
+
+    for name, walk in (('baseline', _baseline_walk),
+                       ('batched', lambda tree, k: _walk_and_decrypt(tree, k, ignore_mac=True))):
+        best = min(timeit.repeat(lambda: walk(copy.deepcopy(encrypted), key), number=1, repeat=args.repeat))
+        copy_cost = min(timeit.repeat(lambda: copy.deepcopy(encrypted), number=1, repeat=args.repeat))
+        print("{:<10} {:>8.2f} us/leaf".format(name, (best - copy_cost) / args.leaves * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Parse time of sops documents per format and document size.
+
+Compares the pure-Python YAML loader used before, the ruamel C loader (when
+ruamel.yaml.clib is installed) and JSON, on encrypted documents of growing size.
+
+    python benchmarks/bench_parse.py --leaves 10 100 1000
+"""
+import argparse
+import json
+import os
+import timeit
+
+from io import BytesIO, StringIO
+from ruamel.yaml import YAML
+from airflow_sops.helpers import _load_document, _walk_and_encrypt
+
+
+def _encrypted_document(leaves, size):
+    document = {'leaf_{}'.format(i): 'x' * size for i in range(leaves)}
+    document['sops'] = {'gcp_kms': [{'resource_id': 'projects/p/locations/l/keyRings/r/cryptoKeys/k',
+                                     'enc': 'd3JhcHBlZA=='}]}
+    return _walk_and_encrypt(document, os.urandom(32))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leaves', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--size', type=int, default=64, help='cleartext bytes per leaf')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    c_loader = 'CParser' in YAML(typ='safe').Parser.__name__
+    print("{:>6} {:>10} {:>12} {:>12} {:>12}".format(
+        'leaves', 'bytes', 'yaml pure', 'yaml C' if c_loader else 'yaml (no C)', 'json'))
+    for leaves in args.leaves:
+        document = _encrypted_document(leaves, args.size)
+        yaml_text = StringIO()
+        YAML(typ='safe', pure=True).dump(document, yaml_text)
+        yaml_data = yaml_text.getvalue().encode('utf-8')
+        json_data = json.dumps(document).encode('utf-8')
+
+        def best(fn):
+            return min(timeit.repeat(fn, number=1, repeat=args.repeat)) * 1e3
+
+        pure = best(lambda: YAML(typ='safe', pure=True).load(yaml_data))
+        fast = best(lambda: _load_document(BytesIO(yaml_data), name='doc.enc.yaml'))
+        native = best(lambda: _load_document(BytesIO(json_data), name='doc.enc.json'))
+        print("{:>6} {:>10} {:>9.2f} ms {:>9.2f} ms {:>9.2f} ms".format(
+            leaves, len(yaml_data), pure, fast, native))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Import and construction time of GcsSopsSecretsBackend.
+
+Every Airflow process instantiates the secrets backend, most of them without
+ever resolving a secret through it. Each run happens in a fresh interpreter that
+has already imported the Airflow modules any secrets backend needs, and reports
+the time to import airflow_sops and construct the backend, which heavy modules
+that loaded, and the import time that is deferred to the first lookup.
+
+    python benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ['google.cloud.kms', 'google.cloud.storage', 'google.api_core', 'google.auth', 'grpc',
+                 'ruamel.yaml']
+
+CODE = """
+import json, sys, time
+import airflow.secrets, airflow.exceptions, airflow.utils.log.logging_mixin
+start = time.perf_counter()
+import airflow_sops.secrets_backend
+imported = time.perf_counter()
+backend = airflow_sops.secrets_backend.GcsSopsSecretsBackend(bucket_name='bench')
+constructed = time.perf_counter()
+loaded = [m for m in {heavy!r} if m in sys.modules]
+import google.cloud.storage, google.cloud.kms, google.api_core.exceptions, google.auth, ruamel.yaml
+deferred = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'construct': constructed - imported,
+                  'deferred': deferred - constructed, 'loaded': loaded}}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', CODE.format(heavy=HEAVY_MODULES)],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    for name in ('import', 'construct', 'deferred'):
+        print("{:<10} {:>8.1f} ms (median of {})".format(
+            name, statistics.median(r[name] for r in results) * 1e3, args.runs))
+    print("heavy modules loaded by import + construct: {}".format(', '.join(results[-1]['loaded']) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Tail latency of uncached lookups with request retries and hedging.
+
+The fake GCS and KMS clients answer most requests after `--latency` ms, a
+`--slow-fraction` of them after `--slow-latency` ms, and fail an `--error-rate`
+fraction with ServiceUnavailable. Caches are off, so every lookup downloads the
+connection and unwraps its key. Each configuration reports p50/p99 latency and
+the share of failed lookups. Hedging only helps while slow requests are rarer than
+1 - hedge_quantile, otherwise the hedge delay lands in the slow mode itself.
+
+    python benchmarks/bench_tail_latency.py --slow-fraction 0.02 --slow-latency 200 --error-rate 0.01
+"""
+import argparse
+import time
+
+from bench_backend import percentile
+from fakes import FakeKmsClient, FakeStorageClient, Latency, fake_backend, populate
+
+CONFIGURATIONS = (
+    ('library defaults', {}),
+    ('retries', {'max_retries': 3, 'retry_backoff': 0.01, 'lookup_deadline': 2}),
+    ('retries + hedging', {'max_retries': 3, 'retry_backoff': 0.01, 'lookup_deadline': 2, 'hedged_requests': True}),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=10, help='milliseconds per request')
+    parser.add_argument('--slow-latency', type=float, default=200, help='milliseconds per slow request')
+    parser.add_argument('--slow-fraction', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    latency = Latency(args.latency / 1e3, slow_fraction=args.slow_fraction, slow_seconds=args.slow_latency / 1e3,
+                      error_rate=args.error_rate)
+    storage_client = FakeStorageClient(latency)
+    kms_client = FakeKmsClient(latency)
+    error_rate, latency.error_rate = latency.error_rate, 0
+    conn_ids = populate(storage_client, kms_client, connections=args.connections, variables=0)
+    from airflow.models.connection import Connection
+    from google.cloud.kms import DecryptRequest  # noqa: F401
+    Connection(conn_id='warm_up')
+    latency.error_rate = error_rate
+
+    print("{:<20} {:>10} {:>10} {:>10}".format('configuration', 'p50 ms', 'p99 ms', 'failed'))
+    for name, kwargs in CONFIGURATIONS:
+        backend = fake_backend(storage_client, kms_client, connections_cache_max_size=0, key_cache_max_size=0,
+                               connections_index_ttl=None, **kwargs)
+        latencies = []
+        failed = 0
+        for i in range(args.iterations):
+            start = time.perf_counter()
+            try:
+                backend.get_connection(conn_ids[i % len(conn_ids)])
+            except Exception:
+                failed += 1
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print("{:<20} {:>10.2f} {:>10.2f} {:>9.1f}%".format(
+            name, percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3, 100.0 * failed / args.iterations))
+        backend._cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Time `python -m airflow_sops verify` over thousands of connection files.
+
+The fakes live in this process, so the files are verified by the threads of one
+process; the command spreads the same work over `--processes` worker processes.
+
+    python benchmarks/bench_verify.py --connections 2000 --threads 16
+"""
+import argparse
+import time
+from collections import Counter
+
+from fakes import FakeKmsClient, FakeStorageClient, Latency, fake_backend, populate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--gcs-latency', type=float, default=10, help='milliseconds per GCS request')
+    parser.add_argument('--kms-latency', type=float, default=20, help='milliseconds per KMS request')
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    storage_client = FakeStorageClient(Latency(args.gcs_latency / 1e3))
+    kms_client = FakeKmsClient(Latency(args.kms_latency / 1e3))
+    populate(storage_client, kms_client, connections=args.connections, variables=0)
+    from google.cloud.kms import DecryptRequest  # noqa: F401
+    from airflow_sops.verify import verify
+
+    backend = fake_backend(storage_client, kms_client, ignore_mac=False, max_workers=args.threads,
+                           connections_index_ttl=None, metrics=False)
+    start = time.perf_counter()
+    reports = verify({}, backend=backend)
+    elapsed = time.perf_counter() - start
+    statuses = Counter(report.status for report in reports)
+    decrypt_ms = sorted(report.decrypt_ms for report in reports)
+    print("{} files in {:.2f}s ({:.0f} files/s), {}".format(len(reports), elapsed, len(reports) / elapsed,
+                                                          dict(statuses)))
+    print("decrypt p50 {:.2f} ms, p99 {:.2f} ms, {} KMS requests".format(
+        decrypt_ms[len(decrypt_ms) // 2], decrypt_ms[int(len(decrypt_ms) * 0.99)], kms_client.requests))
+
+
+if __name__ == '__main__':
+    main()
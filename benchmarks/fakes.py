@@ -0,0 +1,241 @@
+"""In-process stand-ins for the GCS and KMS clients, and synthetic SOPS documents.
+
+The fakes implement the parts of `google.cloud.storage.Client` and
+`KeyManagementServiceClient` the backend uses, and can inject a fixed latency
+(plus optional jitter) per request, so benchmarks run offline and repeatably.
+"""
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+
+from base64 import b64encode
+from io import StringIO
+from unittest import mock
+from google.api_core.exceptions import NotFound, PreconditionFailed, ServiceUnavailable
+from ruamel.yaml import YAML
+from airflow_sops.bundle import build_bundle, dump_bundle
+from airflow_sops.helpers import _walk_and_encrypt
+
+RESOURCE_ID = "projects/bench/locations/global/keyRings/bench/cryptoKeys/sops"
+
+
+class Latency:
+    """Sleeps `seconds` per request, plus up to `jitter` seconds drawn at random.
+
+    A `slow_fraction` of the requests take `slow_seconds` instead, and an `error_rate`
+    fraction fail with ServiceUnavailable, to model the tail of a real service.
+    """
+
+    def __init__(self, seconds: float = 0.0, jitter: float = 0.0, slow_fraction: float = 0.0,
+                 slow_seconds: float = 0.0, error_rate: float = 0.0):
+        self.seconds = seconds
+        self.jitter = jitter
+        self.slow_fraction = slow_fraction
+        self.slow_seconds = slow_seconds
+        self.error_rate = error_rate
+
+    def __call__(self):
+        if self.slow_fraction and random.random() < self.slow_fraction:
+            delay = self.slow_seconds
+        else:
+            delay = self.seconds + (random.random() * self.jitter if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            raise ServiceUnavailable("injected error")
+
+
+class FakeBlob:
+
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+
+    def download_to_file(self, file_obj, if_generation_match=None, **kwargs):
+        with self.bucket.client.connection():
+            self.bucket.client.latency()
+        with self.bucket.client.lock:
+            self.bucket.client.requests["download"] += 1
+            stored = self.bucket.client.objects.get(self.name)
+        if stored is None:
+            raise NotFound("{} not found".format(self.name))
+        generation, data = stored
+        if if_generation_match is not None and if_generation_match != generation:
+            raise PreconditionFailed("{} is at generation {}, not {}".format(self.name, generation, if_generation_match))
+        file_obj.write(data)
+        self.generation = generation
+
+
+class FakeBucket:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self, name, generation)
+
+    def get_blob(self, name, **kwargs):
+        with self.client.connection():
+            self.client.latency()
+        with self.client.lock:
+            self.client.requests["metadata"] += 1
+            stored = self.client.objects.get(name)
+        if stored is None:
+            return None
+        return FakeBlob(self, name, stored[0])
+
+
+class FakeStorageClient:
+    """A single bucket of objects kept in memory.
+
+    `max_connections` caps the requests in flight, like the HTTP connection pool of the real client.
+    """
+
+    def __init__(self, latency=None, max_connections=None):
+        self.latency = latency or Latency()
+        self.connections = threading.BoundedSemaphore(max_connections) if max_connections else None
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.requests = {"download": 0, "metadata": 0, "list": 0}
+
+    def upload(self, name, data: bytes):
+        with self.lock:
+            generation = self.objects[name][0] + 1 if name in self.objects else 1
+            self.objects[name] = (generation, data)
+
+    def delete(self, name):
+        with self.lock:
+            self.objects.pop(name, None)
+
+    def connection(self):
+        return self.connections if self.connections is not None else contextlib.nullcontext()
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def list_blobs(self, bucket_name, prefix=None, **kwargs):
+        with self.connection():
+            self.latency()
+        bucket = self.bucket(bucket_name)
+        with self.lock:
+            self.requests["list"] += 1
+            return [FakeBlob(bucket, name, generation) for name, (generation, _) in sorted(self.objects.items())
+                    if prefix is None or name.startswith(prefix)]
+
+    def close(self):
+        pass
+
+
+class FakeKmsClient:
+    """Unwraps the data keys it wrapped itself."""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.transport = mock.Mock()
+
+    def wrap(self, resource_id, key: bytes) -> str:
+        ciphertext = os.urandom(48)
+        self.keys[(resource_id, ciphertext)] = key
+        return b64encode(ciphertext).decode("utf-8")
+
+    def decrypt(self, request=None, **kwargs):
+        self.latency()
+        with self.lock:
+            self.requests += 1
+        try:
+            plaintext = self.keys[(request.name, request.ciphertext)]
+        except KeyError:
+            raise PermissionError("cannot decrypt with {}".format(request.name))
+        return mock.Mock(plaintext=plaintext)
+
+
+def encrypted_document(document, kms_client, resource_id=RESOURCE_ID, key=None, enc=None, fmt="yaml") -> bytes:
+    """Encrypt a document with a data key wrapped by `kms_client`, serialized as sops would.
+
+    Pass the same `key` and `enc` to several documents to make them share a data key.
+    """
+    if key is None:
+        key = os.urandom(32)
+    if enc is None:
+        enc = kms_client.wrap(resource_id, key)
+    document = dict(document)
+    document["sops"] = {"gcp_kms": [{"resource_id": resource_id, "enc": enc,
+                                     "created_at": "2022-01-01T00:00:00Z"}],
+                        "version": "3.7.3"}
+    document = _walk_and_encrypt(document, key)
+    # keep the key order the MAC was computed in, as sops does
+    stream = StringIO()
+    dump_bundle(document, stream, fmt)
+    return stream.getvalue().encode("utf-8")
+
+
+def synthetic_connection(leaves=10, size=64, seed=0) -> dict:
+    """A connection whose `extra` JSON holds `leaves` fields of `size` characters."""
+    rng = random.Random(seed)
+    extra = {"field_{}".format(i): "".join(rng.choice("abcdef0123456789") for _ in range(size))
+             for i in range(leaves)}
+    return {"conn_type": "postgres", "host": "db-{}.internal".format(seed), "port": 5432,
+            "login": "user_{}".format(seed), "password": "secret-{}".format(seed), "schema": "public",
+            "extra": json.dumps(extra)}
+
+
+def synthetic_variables(count=100, size=64, seed=0) -> dict:
+    rng = random.Random(seed)
+    return {"var_{}".format(i): "".join(rng.choice("abcdef0123456789") for _ in range(size)) for i in range(count)}
+
+
+def populate(storage_client, kms_client, connections=10, leaves=10, size=64, variables=100,
+             variables_encrypted=False, shared_key=True, root_folder_name="sops", fmt="yaml", bundle=None):
+    """Upload synthetic connections `conn_0..conn_N` and a variables file; returns the conn ids.
+
+    With `bundle`, the connections are also uploaded as one connections bundle of that name.
+    """
+    key, enc = None, None
+    if shared_key:
+        key = os.urandom(32)
+        enc = kms_client.wrap(RESOURCE_ID, key)
+    conn_ids = []
+    for i in range(connections):
+        conn_id = "conn_{}".format(i)
+        storage_client.upload("{}/connections/{}.enc.{}".format(root_folder_name, conn_id, fmt),
+                              encrypted_document(synthetic_connection(leaves, size, seed=i), kms_client,
+                                                 key=key, enc=enc, fmt=fmt))
+        conn_ids.append(conn_id)
+    if bundle:
+        bundle_key = key or os.urandom(32)
+        entry = {"resource_id": RESOURCE_ID, "enc": enc or kms_client.wrap(RESOURCE_ID, bundle_key),
+                 "created_at": "2022-01-01T00:00:00Z"}
+        document = build_bundle({conn_id: synthetic_connection(leaves, size, seed=i)
+                                 for i, conn_id in enumerate(conn_ids)}, bundle_key, kms_entries=[entry])
+        stream = StringIO()
+        dump_bundle(document, stream, fmt)
+        storage_client.upload("{}/{}.enc.{}".format(root_folder_name, bundle, fmt), stream.getvalue().encode("utf-8"))
+    var_dict = synthetic_variables(variables, size)
+    if variables_encrypted:
+        storage_client.upload("{}/variables.enc.{}".format(root_folder_name, fmt),
+                              encrypted_document(var_dict, kms_client, key=key, enc=enc, fmt=fmt))
+    else:
+        stream = StringIO()
+        if fmt == "json":
+            json.dump(var_dict, stream)
+        else:
+            YAML(typ="safe", pure=True).dump(var_dict, stream)
+        storage_client.upload("{}/variables.{}".format(root_folder_name, fmt), stream.getvalue().encode("utf-8"))
+    return conn_ids
+
+
+def fake_backend(storage_client, kms_client, **kwargs):
+    """A backend that talks to the fake clients."""
+    from airflow_sops.secrets_backend import GcsSopsSecretsBackend
+    backend = GcsSopsSecretsBackend(bucket_name=kwargs.pop("bucket_name", "bench"), **kwargs)
+    backend.storage_client = storage_client
+    backend.kms_client = kms_client
+    return backend
@@ -158,6 +158,9 @@ setup(
                 "wheel"],
         "test": ["python-dotenv",
                  "pytest"],
+        "speedups": ["ruamel.yaml.clib>=0.2.6"],
+        "notifications": ["google-cloud-pubsub>=2.0.0"],
+        "async": ["aiohttp>=3.8"],
     },
 
     # If there are data files included in your packages that need to be
@@ -0,0 +1,26 @@
+"""Command line tools of airflow_sops.
+
+    python -m airflow_sops verify --help
+    python -m airflow_sops bundle --help
+"""
+import sys
+
+from importlib import import_module
+
+# command name to the module whose main(argv) runs it
+COMMANDS = {
+    'verify': 'airflow_sops.verify',
+    'bundle': 'airflow_sops.bundle',
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print("usage: python -m airflow_sops {{{}}} ...".format(','.join(COMMANDS)), file=sys.stderr)
+        return 2
+    return import_module(COMMANDS[argv[0]]).main(argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+"""Non-blocking lookups for code running on an asyncio event loop, e.g. the triggerer.
+
+    connection = await backend.aget_connection('my_postgres')
+    value = await backend.aget_variable('my_variable')
+
+GCS objects are read through the JSON API with aiohttp, data keys are unwrapped with the
+asyncio KMS client and gpg runs as an asyncio subprocess. Parsing and decryption are
+CPU-bound and run on the default executor of the loop. The caches are those of the
+backend, so sync and async lookups share their entries, and concurrent async lookups of
+the same file or data key await the same in-flight work. Needs the aiohttp package,
+e.g. `pip install airflow-sops-secrets-backend[async]`; GCS requests go to
+STORAGE_EMULATOR_HOST when it is set.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+
+from base64 import b64decode
+from io import BytesIO
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+from urllib.parse import quote
+from airflow.exceptions import AirflowException
+from . import helpers
+from .cache import CachedBlob
+
+log = logging.getLogger(__name__)
+
+STORAGE_ENDPOINT = 'https://storage.googleapis.com'
+# the async lookups only read objects
+STORAGE_SCOPES = ('https://www.googleapis.com/auth/devstorage.read_only',)
+
+# returned by the loads of objects that don't exist
+_NOT_FOUND = object()
+
+
+class AsyncLookups:
+    """The async lookups of one backend on one event loop.
+
+    `session` and `kms_client` default to an `aiohttp.ClientSession` and a
+    `KeyManagementServiceAsyncClient`, created on first use; both are bound to the loop.
+    """
+
+    def __init__(self, backend, session=None, kms_client=None, endpoint: Optional[str] = None):
+        self.backend = backend
+        self.session = session
+        self.kms_client = kms_client
+        self.endpoint = (endpoint or os.environ.get('STORAGE_EMULATOR_HOST') or STORAGE_ENDPOINT).rstrip('/')
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._credentials_lock = asyncio.Lock()
+        # the backend credentials scoped for GCS, see _auth_headers
+        self._credentials = None
+
+    async def get_document(self, blob_name: str, cache, ttl, load: Callable, load_tree: Callable, missing=None):
+        """The async `_get_cached_document`: the document loaded from a blob, or `missing` if it doesn't exist.
+
+        `load` reloads the entry on the refresher thread, `load_tree(tree, version, key)` loads
+        a parsed document whose data key is already unwrapped.
+        """
+        backend = self.backend
+        backend._listen_for_changes()
+        if blob_name in backend.negative_cache:
+            backend.metrics.incr('negative_cache.hit')
+            return missing
+        if cache.max_size > 0:
+            cached = backend._get_fresh(blob_name, cache, ttl, load)
+            if cached is not None:
+                backend.metrics.incr('{}.hit'.format(cache.name))
+                return cached.value
+        value = await self._shared((cache.name, blob_name), lambda: self._load(blob_name, cache, ttl, load_tree))
+        return missing if value is _NOT_FOUND else value
+
+    async def resolve(self, get: Callable, key):
+        """`get(key)` on the executor, for documents that decrypt their values on first access.
+
+        The decryption is CPU-bound, and waits for another thread decrypting the same value.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, get, key)
+
+    async def _load(self, blob_name, cache, ttl, load_tree):
+        backend = self.backend
+        cached = cache.get(blob_name) if cache.max_size > 0 else None
+        try:
+            data, generation = await self._download(blob_name, None if cached is None else cached.generation)
+            if data is None and generation is None:
+                cache.invalidate(blob_name)
+                backend.negative_cache.set(blob_name, True)
+                return _NOT_FOUND
+            if data is None:
+                cached = cached._replace(checked_at=monotonic())
+                cache.set(blob_name, cached)
+                backend.metrics.incr('{}.revalidated'.format(cache.name))
+                return cached.value
+            backend.metrics.incr('{}.miss'.format(cache.name))
+            value = await self._load_tree(blob_name, data, generation, load_tree)
+        except Exception as e:
+            stale = backend._stale_fallback(blob_name, cache, ttl, e)
+            if stale is None:
+                raise
+            return stale.value
+        if cache.max_size > 0:
+            cache.set(blob_name, CachedBlob(generation, value, monotonic()))
+        return value
+
+    async def _load_tree(self, blob_name, data: bytes, generation, load_tree):
+        loop = asyncio.get_running_loop()
+        stream = BytesIO(data)
+        stream.name = blob_name
+        tree = await loop.run_in_executor(None, self.backend._parse_stream, stream)
+        key = None
+        if isinstance(tree, dict) and tree.get('sops'):
+            key = await self.unwrap(tree)
+        return await loop.run_in_executor(None, load_tree, tree, (blob_name, generation), key)
+
+    async def _download(self, blob_name: str, if_generation_not_match=None):
+        """Download the latest generation of a blob.
+
+        Returns `(data, generation)`, `(None, generation)` when the blob is still at
+        `if_generation_not_match`, or `(None, None)` when it doesn't exist.
+        """
+        import aiohttp
+        backend = self.backend
+        url = '{}/storage/v1/b/{}/o/{}'.format(self.endpoint, quote(backend.bucket_name, safe=''),
+                                               quote(blob_name, safe=''))
+        params = {'alt': 'media'}
+        if if_generation_not_match is not None:
+            params['ifGenerationNotMatch'] = str(if_generation_not_match)
+        headers = await self._auth_headers()
+        timeout = aiohttp.ClientTimeout(total=self._request_timeout())
+        session = self._session()
+        with backend.metrics.phase('gcs_download'):
+            async with session.get(url, params=params, headers=headers, timeout=timeout) as response:
+                if response.status == 404:
+                    return None, None
+                if response.status == 304:
+                    return None, if_generation_not_match
+                response.raise_for_status()
+                data = await response.read()
+                generation = response.headers.get('x-goog-generation')
+        backend.metrics.incr('bytes_downloaded', len(data))
+        return data, int(generation) if generation else None
+
+    async def unwrap(self, tree) -> bytes:
+        """The data key of a parsed document, unwrapped once however many lookups need it at the same time."""
+        return await self._shared(('key',) + self.backend._wrapped_key_id(tree), lambda: self._unwrap(tree))
+
+    async def _unwrap(self, tree) -> bytes:
+        backend = self.backend
+        kms_entries = backend._kms_entries(tree)
+        for resource_id, enc in kms_entries:
+            key = backend.key_cache.get((resource_id, enc))
+            if key is not None:
+                backend.metrics.incr('key_cache.hit')
+                return key
+        errors = []
+        for resource_id, enc in kms_entries:
+            try:
+                return await self._unwrap_kms_entry(resource_id, enc)
+            except Exception as e:
+                errors.append("kms %s failed with error: %s " % (resource_id, e))
+        if errors:
+            log.warning("WARN: no KMS client could be accessed:")
+            for err in errors:
+                log.warning("* %s" % err)
+        with backend.metrics.phase('pgp_unwrap'):
+            key = await self._unwrap_pgp_entries(tree)
+        if key is not None:
+            return key
+        raise AirflowException("could not retrieve a key to encrypt/decrypt the tree")
+
+    async def _unwrap_kms_entry(self, resource_id: str, enc: str) -> bytes:
+        backend = self.backend
+        cache_key = (resource_id, enc)
+        backend.metrics.incr('key_cache.miss')
+        if backend.key_service is not None:
+            loop = asyncio.get_running_loop()
+            with backend.metrics.phase('key_service_unwrap'):
+                key = await loop.run_in_executor(None, backend.key_service.unwrap, resource_id, enc)
+            if key is not None:
+                backend.key_cache.set(cache_key, key)
+                return key
+
+        from google.cloud.kms import DecryptRequest
+        request = DecryptRequest(name=resource_id, ciphertext=b64decode(enc))
+        kwargs = {}
+        if self._request_timeout() is not None:
+            kwargs['timeout'] = self._request_timeout()
+        kms_client = await self._kms_client()
+        with backend.metrics.phase('kms_unwrap'):
+            response = await kms_client.decrypt(request=request, **kwargs)
+        backend.key_cache.set(cache_key, response.plaintext)
+        return response.plaintext
+
+    async def _unwrap_pgp_entries(self, tree) -> Optional[bytes]:
+        """The async `_get_key_from_pgp`: every pgp entry is tried at once, the first 32 bytes key wins."""
+        cache = self.backend.key_cache
+        cache_keys = [('pgp', entry.get('fp'), entry['enc'])
+                      for entry in (tree['sops'].get('pgp') or []) if entry and 'enc' in entry]
+        for cache_key in cache_keys:
+            key = cache.get(cache_key)
+            if key is not None:
+                return key
+        if not cache_keys:
+            return None
+        if helpers.GPG_EXEC is None:
+            helpers._set_gpg_exec()
+
+        async def attempt(cache_key):
+            return cache_key, await _gpg_decrypt(helpers.GPG_EXEC, cache_key[2])
+
+        tasks = [asyncio.ensure_future(attempt(cache_key)) for cache_key in cache_keys]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    cache_key, key = await next_done
+                except Exception as e:
+                    log.info("PGP decryption failed with error: %s", e)
+                    continue
+                if len(key) == 32:
+                    cache.set(cache_key, key)
+                    return key
+        finally:
+            # don't wait for slower entries once a key was found
+            for task in tasks:
+                task.cancel()
+        return None
+
+    async def _shared(self, key: Hashable, start: Callable[[], Awaitable]):
+        """Await the in-flight task for `key`, starting it with `start()` if there is none.
+
+        A cancelled caller doesn't cancel the task the others are waiting for.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(start())
+
+            def done(finished):
+                if self._inflight.get(key) is finished:
+                    del self._inflight[key]
+                if not finished.cancelled():
+                    # retrieved here, so a failure nobody waits for anymore isn't reported as lost
+                    finished.exception()
+
+            task.add_done_callback(done)
+        else:
+            self.backend.metrics.incr('inflight.shared')
+        return await asyncio.shield(task)
+
+    def _request_timeout(self) -> Optional[float]:
+        policy = self.backend.request_policy
+        return policy.timeout if policy is not None else None
+
+    def _session(self):
+        if self.session is None:
+            import aiohttp
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.backend.http_pool_size or 100))
+        return self.session
+
+    async def _kms_client(self):
+        if self.kms_client is None:
+            await self._load_credentials()
+            from google.cloud.kms import KeyManagementServiceAsyncClient
+            self.kms_client = KeyManagementServiceAsyncClient(credentials=self.backend.credentials)
+        return self.kms_client
+
+    async def _load_credentials(self):
+        if not self.backend._credentials_loaded:
+            # google.auth.default may ask the metadata server
+            await asyncio.get_running_loop().run_in_executor(None, self.backend._load_credentials)
+
+    async def _auth_headers(self) -> Dict[str, str]:
+        await self._load_credentials()
+        if self.backend.credentials is None:
+            return {}
+        if self._credentials is None:
+            # key file credentials can't be refreshed until they are given scopes
+            from google.auth.credentials import with_scopes_if_required
+            self._credentials = with_scopes_if_required(self.backend.credentials, STORAGE_SCOPES)
+        credentials = self._credentials
+        if not credentials.valid:
+            async with self._credentials_lock:
+                if not credentials.valid:
+                    from google.auth.transport.requests import Request
+                    await asyncio.get_running_loop().run_in_executor(None, credentials.refresh, Request())
+        return {'Authorization': 'Bearer {}'.format(credentials.token)}
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.kms_client is not None:
+            await self.kms_client.transport.close()
+            self.kms_client = None
+
+
+async def _gpg_decrypt(gpg_exec, enc) -> bytes:
+    process = await asyncio.create_subprocess_exec(gpg_exec, '--use-agent', '-d', stdin=asyncio.subprocess.PIPE,
+                                                   stdout=asyncio.subprocess.PIPE)
+    try:
+        stdout, _ = await process.communicate(input=enc.encode('utf-8'))
+    except asyncio.CancelledError:
+        with contextlib.suppress(ProcessLookupError):
+            process.kill()
+        raise
+    return stdout
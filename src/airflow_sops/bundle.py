@@ -0,0 +1,163 @@
+"""Build a connections bundle: every connection in one SOPS document under one data key.
+
+The bundle holds one top-level subtree per connection and a clear-text index of
+connection ids to the key of their subtree, so the backend downloads the bundle and
+unwraps its data key once, then decrypts only the connections that are looked up.
+
+    python -m airflow_sops.bundle --kms-key projects/p/locations/global/keyRings/r/cryptoKeys/k \\
+        --output connections.enc.yaml connections/*.yaml
+
+Each input file is a plain-text connection (decrypt sops files with `sops -d` first),
+named after its conn_id, e.g. `my_postgres.yaml`. Upload the output to
+`<root_folder_name>/<connections_bundle>.<encrypted_file_ext>.<file_format>` and set
+the `connections_bundle` backend kwarg.
+"""
+import argparse
+import json
+import os
+import sys
+
+from base64 import b64encode
+from datetime import datetime
+from typing import Dict, List, Optional
+from .helpers import SOPS_INPUT_VERSION, SOPS_UNENCRYPTED_SUFFIX, _load_document, _walk_and_encrypt
+from .records import ConnectionRecord
+
+# the top-level key of the clear-text index; sops leaves keys with this suffix unencrypted,
+# and still covers them with the MAC
+BUNDLE_INDEX_KEY = 'index' + SOPS_UNENCRYPTED_SUFFIX
+
+
+def _subtree_key(conn_id: str, used) -> str:
+    """The bundle key of a connection: its conn_id, unless sops would treat that key specially."""
+    key = conn_id
+    if key in ('sops', BUNDLE_INDEX_KEY) or key.endswith(SOPS_UNENCRYPTED_SUFFIX):
+        key = 'connection_{}'.format(len(used))
+    while key in used:
+        key = '_' + key
+    return key
+
+
+def build_bundle(connections: Dict[str, Dict], key: bytes, kms_entries: Optional[List[Dict]] = None,
+                 pgp_entries: Optional[List[Dict]] = None) -> Dict:
+    """Encrypt connections into one sops document with the data key `key`.
+
+    `kms_entries` and `pgp_entries` are the sops metadata entries holding `key` wrapped
+    by each master key, e.g. `{'resource_id': ..., 'enc': ..., 'created_at': ...}`.
+    """
+    index = {}
+    document = {}
+    for conn_id, conn in connections.items():
+        subtree_key = _subtree_key(conn_id, document)
+        index[conn_id] = subtree_key
+        document[subtree_key] = dict(conn)
+    document[BUNDLE_INDEX_KEY] = index
+    sops = {'version': SOPS_INPUT_VERSION}
+    if kms_entries:
+        sops['gcp_kms'] = kms_entries
+    if pgp_entries:
+        sops['pgp'] = pgp_entries
+    document['sops'] = sops
+    return _walk_and_encrypt(document, key)
+
+
+def bundle_index(tree) -> Dict[str, str]:
+    """The clear-text index of a parsed bundle, mapping conn_ids to their subtree keys."""
+    return dict(tree.get(BUNDLE_INDEX_KEY) or {})
+
+
+class ConnectionsBundle:
+    """The connections of a loaded bundle, looked up through its index.
+
+    `subtrees` maps the bundle keys to decrypted connections, e.g. a `_LazyDecryptedTree`
+    that decrypts each connection on first access. Each connection is turned into a
+    `ConnectionRecord` once.
+    """
+
+    def __init__(self, index: Dict[str, str], subtrees):
+        self.index = index
+        self.subtrees = subtrees
+        self._records = {}
+
+    def get(self, conn_id: str) -> Optional[ConnectionRecord]:
+        record = self._records.get(conn_id)
+        if record is None:
+            subtree_key = self.index.get(conn_id)
+            if subtree_key is None:
+                return None
+            record = self._records[conn_id] = ConnectionRecord.from_dict(self.subtrees.get(subtree_key))
+        return record
+
+    def __contains__(self, conn_id):
+        return conn_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def conn_ids(self) -> List[str]:
+        return list(self.index)
+
+
+def _read_connections(paths: List[str]) -> Dict[str, Dict]:
+    connections = {}
+    for path in paths:
+        conn_id = os.path.basename(path).split('.', 1)[0]
+        if conn_id in connections:
+            raise ValueError("{} is defined twice".format(conn_id))
+        with open(path, 'rb') as f:
+            conn = _load_document(f, name=path)
+        if not isinstance(conn, dict):
+            raise ValueError("{} does not hold a connection mapping".format(path))
+        if 'sops' in conn:
+            raise ValueError("{} is sops encrypted, decrypt it with `sops -d` first".format(path))
+        connections[conn_id] = conn
+    return connections
+
+
+def _wrap_key(kms_client, resource_id: str, key: bytes) -> Dict:
+    response = kms_client.encrypt(request={'name': resource_id, 'plaintext': key})
+    return {'resource_id': resource_id, 'enc': b64encode(response.ciphertext).decode('utf-8'),
+            'created_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+def dump_bundle(document, stream, fmt: str = 'yaml'):
+    """Serialize a bundle, keeping the key order its MAC was computed in."""
+    if fmt == 'json':
+        json.dump(document, stream, indent=2)
+        stream.write('\n')
+    else:
+        from ruamel.yaml import YAML
+        yaml = YAML(typ='safe', pure=True)
+        yaml.default_flow_style = False
+        # the MAC covers the values in document order, keys must not be sorted on output
+        yaml.sort_base_mapping_type_on_output = False
+        yaml.dump(document, stream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a SOPS connections bundle encrypted with GCP KMS.")
+    parser.add_argument('inputs', nargs='+', help='plain-text connection files, named <conn_id>.yaml or .json')
+    parser.add_argument('--kms-key', action='append', required=True, dest='kms_keys',
+                        help='KMS key resource id wrapping the data key, can be repeated')
+    parser.add_argument('--output', help='bundle file to write, standard output by default')
+    parser.add_argument('--format', choices=('yaml', 'json'), default=None,
+                        help='output format, from the output file extension by default')
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ('json' if args.output and args.output.endswith('.json') else 'yaml')
+    connections = _read_connections(args.inputs)
+    from google.cloud.kms import KeyManagementServiceClient
+    kms_client = KeyManagementServiceClient()
+    key = os.urandom(32)
+    document = build_bundle(connections, key, kms_entries=[_wrap_key(kms_client, resource_id, key)
+                                                           for resource_id in args.kms_keys])
+    if args.output:
+        with open(args.output, 'w') as f:
+            dump_bundle(document, f, fmt)
+    else:
+        dump_bundle(document, sys.stdout, fmt)
+    print("Bundled {} connections".format(len(connections)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
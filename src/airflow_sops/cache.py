@@ -0,0 +1,62 @@
+import threading
+
+from collections import OrderedDict, namedtuple
+from time import monotonic
+
+_MISSING = object()
+
+# A document parsed from a GCS blob, with the blob generation it was read from and the
+# monotonic time it was last known to be current.
+CachedBlob = namedtuple('CachedBlob', ['generation', 'value', 'checked_at'])
+
+
+class TTLCache:
+    """A thread-safe, size-bounded LRU cache whose entries expire after `ttl` seconds.
+
+    A `max_size` of 0 disables caching, a `ttl` of None keeps entries until they are evicted.
+    """
+
+    def __init__(self, max_size: int = 128, ttl=None, timer=monotonic, name: str = 'cache'):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at <= self._timer():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires_at = None if self.ttl is None else self._timer() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,116 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import tempfile
+
+from contextlib import contextmanager
+from io import BytesIO
+
+BLOB_FILE_EXT = "blob"
+
+
+class DiskBlobCache:
+    """Downloaded blobs shared by every process on a node through a local directory.
+
+    Only the encrypted content of a blob is stored, never decrypted values. Each entry
+    is a single file named after the blob name hash and its GCS generation, written
+    atomically, so readers never see a partial or mismatched file and need no lock.
+    Writers hold an exclusive file lock while storing and evicting, and the least
+    recently read entries are evicted once the directory grows over `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self._lock_path = os.path.join(self.directory, ".lock")
+
+    def get(self, blob_name: str, generation):
+        """Return a read-only memory map of the cached blob, or None on a miss."""
+        path = self._path(blob_name, generation)
+        try:
+            with open(path, "rb") as f:
+                # bump the modification time, eviction uses it as the last access time
+                os.utime(f.fileno())
+                if os.fstat(f.fileno()).st_size == 0:
+                    return BytesIO()
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def put(self, blob_name: str, generation, data: bytes):
+        """Store a blob generation, replacing any other generation of the same blob."""
+        if len(data) > self.max_bytes:
+            return
+        prefix = self._prefix(blob_name)
+        path = self._path(blob_name, generation)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self._locked():
+                os.replace(tmp_path, path)
+                for entry in os.scandir(self.directory):
+                    if entry.name.startswith(prefix) and entry.path != path:
+                        self._remove(entry.path)
+                self._evict()
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+    def invalidate(self, blob_name: str):
+        prefix = self._prefix(blob_name)
+        with self._locked():
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith(prefix):
+                    self._remove(entry.path)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith("." + BLOB_FILE_EXT):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, blob_name: str, generation) -> str:
+        return os.path.join(self.directory, "{}{}.{}".format(self._prefix(blob_name), generation, BLOB_FILE_EXT))
+
+    @staticmethod
+    def _prefix(blob_name: str) -> str:
+        return "{}-".format(hashlib.sha256(blob_name.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self) -> int:
+        return sum(1 for entry in os.scandir(self.directory) if entry.name.endswith("." + BLOB_FILE_EXT))
+
+    def size(self) -> int:
+        """Total bytes of the cached blobs."""
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.endswith("." + BLOB_FILE_EXT))
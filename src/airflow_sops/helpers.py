@@ -1,81 +1,151 @@
 import subprocess
 import hashlib
+import copy
+import json
 import sys
+import os
 import re
+import threading
 
 from os import environ
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import MutableMapping, MutableSequence
-from ruamel.yaml.scalarstring import PreservedScalarString
 from datetime import datetime, timedelta
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, modes, algorithms
-from base64 import b64decode
+from base64 import b64decode, b64encode
 from airflow.exceptions import AirflowException
 
 SOPS_INPUT_VERSION = '1.18'
 
 SOPS_UNENCRYPTED_SUFFIX = '_unencrypted'
 
+_MISSING = object()
 
-def _get_key_from_pgp(tree):
-    """Retrieve the key from the PGP tree leave."""
+# resolved on first use, see _set_gpg_exec
+GPG_EXEC = None
+
+# YAML instances are not thread-safe, so each thread keeps its own
+_yaml_local = threading.local()
+
+
+def _load_document(stream, name=None):
+    """Parse a sops document from a file-like object.
+
+    Files named *.json, or whose content starts with `{`, are parsed as JSON.
+    Everything else is parsed as YAML, with the C loader when ruamel.yaml.clib
+    is installed.
+    """
+    if name is None:
+        name = getattr(stream, 'name', None)
+    data = stream.read()
+    if isinstance(name, str) and name.endswith('.json'):
+        return json.loads(data)
+    if data.lstrip()[:1] in (b'{', '{'):
+        try:
+            return json.loads(data)
+        except ValueError:
+            pass  # a YAML flow mapping rather than JSON
+    return _yaml().load(data)
+
+
+def _yaml():
+    yaml = getattr(_yaml_local, 'yaml', None)
+    if yaml is None:
+        from ruamel.yaml import YAML
+        yaml = _yaml_local.yaml = YAML(typ='safe')
+    return yaml
+
+
+def _get_key_from_pgp(tree, cache=None, max_workers=4):
+    """Retrieve the key from the PGP tree leave.
+
+    The entries are tried concurrently and the first one that yields a 32
+    bytes key wins. Unwrapped keys are kept in `cache`, keyed by fingerprint
+    and wrapped key, so gpg only runs once per data key.
+    """
     try:
         pgp_tree = tree['sops']['pgp']
     except KeyError:
         return None
+    entries = []
     i = -1
     for entry in pgp_tree:
         if not entry:
             continue
         i += 1
         try:
-            enc = entry['enc']
+            entries.append((i, ('pgp', entry.get('fp'), entry['enc'])))
         except KeyError:
             continue
-        try:
-            # check if the user has specified a custom GPG program.
-            _set_gpg_exec()
-
-            p = subprocess.Popen([GPG_EXEC, '--use-agent', '-d'],
-                                 stdout=subprocess.PIPE,
-                                 stdin=subprocess.PIPE)
-            key = p.communicate(input=enc.encode('utf-8'))[0]
-        except Exception as e:
-            print("INFO: PGP decryption failed in entry %s with error: %s" %
-                  (i, e), file=sys.stderr)
-            continue
-        if len(key) == 32:
-            return key
+    if cache is not None:
+        for _, cache_key in entries:
+            key = cache.get(cache_key)
+            if key is not None:
+                return key
+    if not entries:
+        return None
+
+    # check once if the user has specified a custom GPG program.
+    if GPG_EXEC is None:
+        _set_gpg_exec()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(entries))))
+    try:
+        futures = {executor.submit(_gpg_decrypt, GPG_EXEC, cache_key[2]): i
+                   for i, cache_key in entries}
+        cache_keys = dict(entries)
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                key = future.result()
+            except Exception as e:
+                print("INFO: PGP decryption failed in entry %s with error: %s" %
+                      (i, e), file=sys.stderr)
+                continue
+            if len(key) == 32:
+                if cache is not None:
+                    cache.set(cache_keys[i], key)
+                return key
+    finally:
+        # don't wait for slower entries once a key was found
+        executor.shutdown(wait=False)
     return None
 
 
+def _gpg_decrypt(gpg_exec, enc):
+    p = subprocess.Popen([gpg_exec, '--use-agent', '-d'],
+                         stdout=subprocess.PIPE,
+                         stdin=subprocess.PIPE)
+    return p.communicate(input=enc.encode('utf-8'))[0]
+
+
+class MacMismatchError(AirflowException):
+    """The values of a sops document don't match its MAC."""
+
+
+class UnknownValueTypeError(AirflowException):
+    """A sops value has a type this module can't decode."""
+
+
+# master keys older than this should be rotated
+ROTATION_AGE = timedelta(days=183)
+
+
+def _master_key_dates(tree, kinds=('kms', 'pgp')):
+    """The creation dates of the master key entries of the given kinds in a document."""
+    dates = []
+    for kind in kinds:
+        for entry in tree['sops'].get(kind) or []:
+            if entry and 'created_at' in entry:
+                dates.append(datetime.strptime(entry['created_at'], '%Y-%m-%dT%H:%M:%SZ'))
+    return dates
+
+
 def _check_rotation_needed(tree):
     """ Browse the master keys and check their creation date to
         display a warning if older than 6 months (it's time to rotate).
     """
-    show_rotation_warning = False
-    six_months_ago = datetime.utcnow() - timedelta(days=183)
-    if 'kms' in tree['sops']:
-        for entry in tree['sops']['kms']:
-            if not entry:
-                continue
-            # check if creation date is older than 6 months
-            if 'created_at' in entry:
-                d = datetime.strptime(entry['created_at'],
-                                      '%Y-%m-%dT%H:%M:%SZ')
-                if d < six_months_ago:
-                    show_rotation_warning = True
-
-    if 'pgp' in tree['sops']:
-        for entry in tree['sops']['pgp']:
-            if not entry:
-                continue
-            # check if creation date is older than 6 months
-            if 'created_at' in entry:
-                d = datetime.strptime(entry['created_at'],
-                                      '%Y-%m-%dT%H:%M:%SZ')
-                if d < six_months_ago:
-                    show_rotation_warning = True
+    six_months_ago = datetime.utcnow() - ROTATION_AGE
+    show_rotation_warning = any(d < six_months_ago for d in _master_key_dates(tree))
     if show_rotation_warning:
         print("INFO: the data key on this document is over 6 months old. "
               "Considering rotating it with $ sops -r <file> ",
@@ -85,39 +155,58 @@ def _check_rotation_needed(tree):
 def _walk_list_and_decrypt(branch, key, aad=b'', stash=None, digest=None,
                            unencrypted=False):
     """Walk a list contained in a branch and decrypts its values."""
-    nstash = dict()
-    kl = []
-    for i, v in enumerate(list(branch)):
-        if stash:
-            stash[i] = {'has_stash': True}
-            nstash = stash[i]
-        if isinstance(v, MutableMapping):
-            kl.append(_walk_and_decrypt(v, key, aad=aad, stash=nstash,
-                                        digest=digest, is_root=False,
-                                        unencrypted=unencrypted))
-        elif isinstance(v, MutableSequence):
-            kl.append(_walk_list_and_decrypt(v, key, aad=aad, stash=nstash,
-                                             digest=digest,
-                                             unencrypted=unencrypted))
-        else:
-            kl.append(_decrypt(v, key, aad=aad, stash=nstash, digest=digest,
-                               unencrypted=unencrypted))
+    kl = list(branch)
+    leaves = []
+    _collect_list_leaves(kl, aad, stash, unencrypted, leaves)
+    _decrypt_leaves(leaves, key, digest)
     return kl
 
 
 def _walk_and_decrypt(branch, key, aad=b'', stash=None, digest=None,
-                      is_root=True, ignore_mac=False, unencrypted=False):
-    """Walk the branch recursively and decrypt leaves."""
+                      is_root=True, ignore_mac=False, unencrypted=False, aead=None):
+    """Walk the branch recursively and decrypt leaves.
+
+    The leaves are collected first and then decrypted in one batch that
+    shares a single AES-GCM primitive for `key`, or `aead` when given.
+    """
     if is_root and not ignore_mac:
         digest = hashlib.sha512()
+    leaves = []
+    _collect_leaves(branch, aad, stash, is_root, unencrypted, leaves)
+    _decrypt_leaves(leaves, key, digest, aead=aead)
+
+    if is_root and not ignore_mac:
+        _check_mac(branch, key, digest)
+
+    return branch
+
+
+def _check_mac(branch, key, digest):
+    """Compare the digest of the decrypted values with the MAC stored in the document."""
+    # compute the hash computed on values with the one stored
+    # in the file. If they match, all is well.
+    if not ('mac' in branch['sops']):
+        raise MacMismatchError("SOPS decrypt error: 'mac' not found, unable to verify file integrity")
+    h = digest.hexdigest().upper()
+    # We know the original hash is trustworthy because it is encrypted
+    # with the data key and authenticated using the lastmodified timestamp
+    orig_h = _decrypt(branch['sops']['mac'], key,
+                      aad=branch['sops']['lastmodified'].encode('utf-8'))
+    if h != orig_h:
+        raise MacMismatchError("SOPS decrypt error: Checksum verification failed!\nexpected {}\nbut got  {}"
+                               .format(orig_h, h))
+
+
+def _collect_leaves(branch, aad, stash, is_root, unencrypted, leaves):
+    """Append a (container, key, value, aad, stash, unencrypted) record for
+    every leaf of a mapping, in the order sops computes the MAC over them."""
     carryaad = aad
     for k, v in branch.items():
         if k == 'sops' and is_root:
             continue  # everything under the `sops` key stays in clear
         unencrypted_branch = unencrypted or k.endswith(SOPS_UNENCRYPTED_SUFFIX)
         nstash = dict()
-        caad = aad
-        if _a_is_newer_than_b(SOPS_INPUT_VERSION, '0.9'):
+        if _SEPARATED_AAD:
             caad = aad + k.encode('utf-8') + b':'
         else:
             caad = carryaad
@@ -127,39 +216,58 @@ def _walk_and_decrypt(branch, key, aad=b'', stash=None, digest=None,
             stash[k] = {'has_stash': True}
             nstash = stash[k]
         if isinstance(v, MutableMapping):
-            branch[k] = _walk_and_decrypt(v, key, aad=caad, stash=nstash,
-                                          digest=digest, is_root=False,
-                                          unencrypted=unencrypted_branch)
+            _collect_leaves(v, caad, nstash, False, unencrypted_branch, leaves)
         elif isinstance(v, MutableSequence):
-            branch[k] = _walk_list_and_decrypt(v, key, aad=caad, stash=nstash,
-                                               digest=digest,
-                                               unencrypted=unencrypted_branch)
-        elif isinstance(v, PreservedScalarString):
-            ev = _decrypt(v, key, aad=caad, stash=nstash, digest=digest,
-                          unencrypted=unencrypted_branch)
-            branch[k] = PreservedScalarString(ev)
+            branch[k] = list(v)
+            _collect_list_leaves(branch[k], caad, nstash, unencrypted_branch, leaves)
         else:
-            branch[k] = _decrypt(v, key, aad=caad, stash=nstash, digest=digest,
-                                 unencrypted=unencrypted_branch)
+            leaves.append((branch, k, v, caad, nstash, unencrypted_branch))
 
-    if is_root and not ignore_mac:
-        # compute the hash computed on values with the one stored
-        # in the file. If they match, all is well.
-        if not ('mac' in branch['sops']):
-            raise AirflowException("SOPS decrypt error: 'mac' not found, unable to verify file integrity")
-        h = digest.hexdigest().upper()
-        # We know the original hash is trustworthy because it is encrypted
-        # with the data key and authenticated using the lastmodified timestamp
-        orig_h = _decrypt(branch['sops']['mac'], key,
-                          aad=branch['sops']['lastmodified'].encode('utf-8'))
-        if h != orig_h:
-            raise AirflowException("SOPS decrypt error: Checksum verification failed!\nexpected {}\nbut got  {}}"
-                                   .format(orig_h, h))
 
-    return branch
+def _collect_list_leaves(branch, aad, stash, unencrypted, leaves):
+    """Same as `_collect_leaves` for the items of a list, which are replaced in place."""
+    for i, v in enumerate(branch):
+        nstash = dict()
+        if stash:
+            stash[i] = {'has_stash': True}
+            nstash = stash[i]
+        if isinstance(v, MutableMapping):
+            _collect_leaves(v, aad, nstash, False, unencrypted, leaves)
+        elif isinstance(v, MutableSequence):
+            branch[i] = list(v)
+            _collect_list_leaves(branch[i], aad, nstash, unencrypted, leaves)
+        else:
+            leaves.append((branch, i, v, aad, nstash, unencrypted))
 
 
-def _decrypt(value, key, aad=b'', stash=None, digest=None, unencrypted=False):
+def _decrypt_leaves(leaves, key, digest=None, aead=None):
+    """Decrypt collected leaves in place."""
+    if aead is None:
+        aead = _aead(key)
+    # only a document loaded by ruamel can hold preserved scalars, and then the module is loaded
+    scalarstring = sys.modules.get('ruamel.yaml.scalarstring')
+    preserved = scalarstring.PreservedScalarString if scalarstring else ()
+    for container, k, v, aad, stash, unencrypted in leaves:
+        ev = _decrypt(v, key, aad=aad, stash=stash, digest=digest,
+                      unencrypted=unencrypted, aead=aead)
+        if preserved and isinstance(v, preserved):
+            ev = preserved(ev)
+        container[k] = ev
+
+
+def _aead(key):
+    """Return the AES-GCM primitive for a data key.
+
+    It holds the key, so it is only kept as long as the key is: for one walk, or next to
+    the key of a `_LazyDecryptedTree`. It is never cached on its own, where it would outlive
+    the key cache TTL and `invalidate_key_cache()`.
+    """
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+
+def _decrypt(value, key, aad=b'', stash=None, digest=None, unencrypted=False,
+             aead=None):
     """Return a decrypted value."""
     if unencrypted:
         if digest:
@@ -167,27 +275,19 @@ def _decrypt(value, key, aad=b'', stash=None, digest=None, unencrypted=False):
             digest.update(bvalue)
         return value
 
-    valre = b'^ENC\[AES256_GCM,data:(.+),iv:(.+),tag:(.+)'  # noqa: W605
-    # extract fields using a regex
-    if _a_is_newer_than_b(SOPS_INPUT_VERSION, '0.8'):
-        valre += b',type:(.+)'
-    valre += b'\]'  # noqa: W605
-    res = re.match(valre, value.encode('utf-8'))
     # if the value isn't in encrypted form, return it as is
+    if not isinstance(value, str):
+        return value
+    res = _ENC_VALUE_RE.match(value)
     if res is None:
         return value
     enc_value = b64decode(res.group(1))
     iv = b64decode(res.group(2))
     tag = b64decode(res.group(3))
-    valtype = 'str'
-    if _a_is_newer_than_b(SOPS_INPUT_VERSION, '0.8'):
-        valtype = res.group(4)
-    decryptor = Cipher(algorithms.AES(key),
-                       modes.GCM(iv, tag),
-                       default_backend()
-                       ).decryptor()
-    decryptor.authenticate_additional_data(aad)
-    cleartext = decryptor.update(enc_value) + decryptor.finalize()
+    valtype = res.group(4) if _HAS_VALUE_TYPE else 'str'
+    if aead is None:
+        aead = _aead(key)
+    cleartext = aead.decrypt(iv, enc_value + tag, aad)
 
     if stash:
         # save the values for later if we need to reencrypt
@@ -198,9 +298,9 @@ def _decrypt(value, key, aad=b'', stash=None, digest=None, unencrypted=False):
     if digest:
         digest.update(cleartext)
 
-    if valtype == b'bytes':
+    if valtype == 'bytes':
         return cleartext
-    if valtype == b'str':
+    if valtype == 'str':
         # Welcome to python compatibility hell... :(
         # Python 2 treats everything as str, but python 3 treats bytes and str
         # as different types. So if a file was encrypted by sops with py2, and
@@ -214,15 +314,110 @@ def _decrypt(value, key, aad=b'', stash=None, digest=None, unencrypted=False):
         except UnicodeDecodeError:
             return cleartext
         return cv
-    if valtype == b'int':
+    if valtype == 'int':
         return int(cleartext.decode('utf-8'))
-    if valtype == b'float':
+    if valtype == 'float':
         return float(cleartext.decode('utf-8'))
-    if valtype == b'bool':
+    if valtype == 'bool':
         if cleartext.lower() == b'true':
             return True
         return False
-    raise AirflowException("SOPS decrypt error: unknown type " + valtype)
+    raise UnknownValueTypeError("SOPS decrypt error: unknown type " + valtype)
+
+
+def _encrypt(value, key, aad=b'', digest=None, aead=None):
+    """Return a value encrypted in the sops `ENC[AES256_GCM,...]` format."""
+    if isinstance(value, bool):
+        valtype, cleartext = 'bool', str(value).encode('utf-8')
+    elif isinstance(value, int):
+        valtype, cleartext = 'int', str(value).encode('utf-8')
+    elif isinstance(value, float):
+        valtype, cleartext = 'float', str(value).encode('utf-8')
+    elif isinstance(value, bytes):
+        valtype, cleartext = 'bytes', value
+    else:
+        valtype, cleartext = 'str', str(value).encode('utf-8')
+    if digest:
+        digest.update(cleartext)
+    iv = os.urandom(32)
+    encrypted = (aead or _aead(key)).encrypt(iv, cleartext, aad)
+    return "ENC[AES256_GCM,data:{},iv:{},tag:{},type:{}]".format(
+        b64encode(encrypted[:-16]).decode('utf-8'), b64encode(iv).decode('utf-8'),
+        b64encode(encrypted[-16:]).decode('utf-8'), valtype)
+
+
+class _LazyDecryptedTree:
+    """A parsed sops document whose top-level keys are decrypted on first access.
+
+    Each key's subtree is decrypted at most once and memoized. The MAC covers
+    every leaf, so it cannot be verified lazily; decrypt the whole document with
+    `_walk_and_decrypt` when integrity checking is required.
+    """
+
+    def __init__(self, tree, key):
+        self._encrypted = {k: v for k, v in tree.items() if k != 'sops'}
+        self._decrypted = {}
+        self._key = key
+        # shared by the subtrees, and dropped with the key when the tree is
+        self._aead = _aead(key)
+        self._lock = threading.Lock()
+        if not _SEPARATED_AAD:
+            # older sops versions chain the AAD across keys, so keys can't be decrypted on their own
+            for k in list(self._encrypted):
+                self.get(k)
+
+    def get(self, k, default=None):
+        try:
+            return self._decrypted[k]
+        except KeyError:
+            pass
+        with self._lock:
+            if k not in self._decrypted:
+                if k not in self._encrypted:
+                    return default
+                branch = _walk_and_decrypt({k: copy.deepcopy(self._encrypted[k])}, self._key,
+                                           ignore_mac=True, aead=self._aead)
+                self._decrypted[k] = branch[k]
+                del self._encrypted[k]
+            return self._decrypted[k]
+
+    def __getitem__(self, k):
+        value = self.get(k, _MISSING)
+        if value is _MISSING:
+            raise KeyError(k)
+        return value
+
+    def __contains__(self, k):
+        return k in self._decrypted or k in self._encrypted
+
+    def __len__(self):
+        return len(self._decrypted) + len(self._encrypted)
+
+    def keys(self):
+        return list(self._decrypted) + list(self._encrypted)
+
+
+def _walk_and_encrypt(branch, key, lastmodified=None):
+    """Encrypt the leaves of a document in place and seal it with a sops MAC.
+
+    The `sops` key of the document must already hold the wrapped data key entries.
+    """
+    digest = hashlib.sha512()
+    aead = _aead(key)
+    leaves = []
+    _collect_leaves(branch, b'', None, True, False, leaves)
+    for container, k, v, aad, _, unencrypted in leaves:
+        if unencrypted:
+            digest.update(_to_bytes(v))
+        else:
+            container[k] = _encrypt(v, key, aad=aad, digest=digest, aead=aead)
+    sops = branch.setdefault('sops', {})
+    if lastmodified is None:
+        lastmodified = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    sops['lastmodified'] = lastmodified
+    sops['mac'] = _encrypt(digest.hexdigest().upper(), key,
+                           aad=lastmodified.encode('utf-8'), aead=aead)
+    return branch
 
 
 def _set_gpg_exec(exec_name=None):
@@ -264,3 +459,12 @@ def _a_is_newer_than_b(A, B):
     if is_equal and len(A_comp) > len(B_comp):
         return True
     return False
+
+
+# The value format and the AAD scheme only depend on SOPS_INPUT_VERSION, so
+# they are resolved once instead of for every leaf.
+_HAS_VALUE_TYPE = _a_is_newer_than_b(SOPS_INPUT_VERSION, '0.8')
+_SEPARATED_AAD = _a_is_newer_than_b(SOPS_INPUT_VERSION, '0.9')
+_ENC_VALUE_RE = re.compile(
+    r'^ENC\[AES256_GCM,data:(.+),iv:(.+),tag:(.+)' +
+    (r',type:(.+)' if _HAS_VALUE_TYPE else '') + r'\]')
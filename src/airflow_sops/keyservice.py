@@ -0,0 +1,119 @@
+"""A node-local service that unwraps SOPS data keys with GCP KMS once for every worker.
+
+Run it next to the Airflow workers and point the backend to its socket with the
+`key_service_socket` backend kwarg:
+
+    python -m airflow_sops.keyservice --socket /run/airflow-sops/keyservice.sock
+
+Requests and responses are single lines of JSON over a Unix socket. The socket is
+only accessible to the user running the service, since it answers with plaintext
+data keys.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+
+from base64 import b64decode, b64encode
+from typing import Optional
+from .cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+class _KeyServiceHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                key = self.server.unwrap(request['resource_id'], request['enc'])
+                response = {'key': b64encode(key).decode('utf-8')}
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class KeyServiceServer(socketserver.ThreadingUnixStreamServer):
+    """Unwraps data keys through KMS and keeps them in memory for `ttl` seconds."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, kms_client=None, ttl: Optional[float] = 3600, max_size: int = 1024):
+        if kms_client is None:
+            from google.cloud.kms import KeyManagementServiceClient
+            kms_client = KeyManagementServiceClient()
+        self.kms_client = kms_client
+        self.key_cache = TTLCache(max_size=max_size, ttl=ttl)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _KeyServiceHandler)
+        finally:
+            os.umask(old_umask)
+
+    def unwrap(self, resource_id: str, enc: str) -> bytes:
+        cache_key = (resource_id, enc)
+        key = self.key_cache.get(cache_key)
+        if key is None:
+            from google.cloud.kms import DecryptRequest
+            request = DecryptRequest(name=resource_id, ciphertext=b64decode(enc))
+            key = self.kms_client.decrypt(request=request).plaintext
+            self.key_cache.set(cache_key, key)
+        return key
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+class KeyServiceClient:
+    """Asks a local key service for data keys. Any failure returns None so callers fall back to KMS."""
+
+    def __init__(self, socket_path: str, timeout: float = 1.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def unwrap(self, resource_id: str, enc: str) -> Optional[bytes]:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.socket_path)
+                request = json.dumps({'resource_id': resource_id, 'enc': enc}).encode('utf-8') + b'\n'
+                sock.sendall(request)
+                with sock.makefile('rb') as f:
+                    response = json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            log.debug("Key service %s unavailable: %s", self.socket_path, e)
+            return None
+        if 'key' not in response:
+            log.debug("Key service could not unwrap %s: %s", resource_id, response.get('error'))
+            return None
+        return b64decode(response['key'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Node-local SOPS data key service backed by GCP KMS.")
+    parser.add_argument('--socket', required=True, help='path of the Unix socket to listen on')
+    parser.add_argument('--ttl', type=float, default=3600, help='seconds unwrapped keys are kept in memory')
+    parser.add_argument('--max-size', type=int, default=1024, help='maximum number of keys kept in memory')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with KeyServiceServer(args.socket, ttl=args.ttl, max_size=args.max_size) as server:
+        log.info("Key service listening on %s", args.socket)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
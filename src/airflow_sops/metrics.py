@@ -0,0 +1,72 @@
+from time import perf_counter
+
+METRIC_PREFIX = "sops_secrets"
+
+
+class _NoopPhase:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_PHASE = _NoopPhase()
+
+
+class _Phase:
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        if self.metrics.tracer is not None:
+            self.span = self.metrics.tracer.start_as_current_span("{}.{}".format(METRIC_PREFIX, self.name))
+            self.span.__enter__()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = perf_counter() - self.start
+        if self.metrics.enabled:
+            self.metrics.stats.timing("{}.{}".format(METRIC_PREFIX, self.name), duration * 1000)
+        if self.span is not None:
+            return self.span.__exit__(*exc_info)
+        return False
+
+
+class Metrics:
+    """Per-phase timers and counters for secret lookups.
+
+    Timers and counters go to Airflow's Stats (StatsD) as `sops_secrets.<name>`, and
+    each timed phase is also an OpenTelemetry span when tracing is on and the
+    opentelemetry-api package is installed. When both are off every call is a no-op.
+    """
+
+    def __init__(self, enabled: bool = True, tracing: bool = False, log=None):
+        self.enabled = enabled
+        self.stats = None
+        self.tracer = None
+        if enabled:
+            from airflow.stats import Stats
+            self.stats = Stats
+        if tracing:
+            try:
+                from opentelemetry import trace
+                self.tracer = trace.get_tracer("airflow_sops")
+            except ImportError:
+                if log is not None:
+                    log.warning("Tracing needs the opentelemetry-api package, spans are disabled")
+
+    def phase(self, name: str):
+        """Time the block as `name`."""
+        if not self.enabled and self.tracer is None:
+            return _NOOP_PHASE
+        return _Phase(self, name)
+
+    def incr(self, name: str, count: int = 1):
+        if self.enabled and count:
+            self.stats.incr("{}.{}".format(METRIC_PREFIX, name), count)
@@ -0,0 +1,138 @@
+"""Evict cached secrets as soon as GCS reports a change to their file.
+
+Create a Pub/Sub notification on the bucket for the secrets folder, then set the
+`notifications_topic` backend kwarg:
+
+    gcloud storage buckets notifications create gs://<bucket> --topic=sops-changes \\
+        --object-prefix=sops/ --event-types=OBJECT_FINALIZE,OBJECT_DELETE
+
+Each message is delivered to one subscriber of a subscription, so every listening
+process needs its own. Only the long-lived Airflow components listen, the commands in
+the `notifications_components` kwarg, e.g. `airflow scheduler`: task processes are too
+many and too short-lived, and may end without running their exit handlers, so they rely
+on the cache TTLs. With a topic, each listening process creates a subscription, off its
+lookup path, and deletes it when it shuts down; one left behind by a killed process
+expires after SUBSCRIPTION_TTL seconds without a subscriber. A subscription created
+beforehand, the `notifications_subscription` kwarg, only suits a single listening
+process. The listener needs the google-cloud-pubsub package, which connects to a local
+emulator when PUBSUB_EMULATOR_HOST is set.
+"""
+import logging
+import os
+import socket
+import sys
+import uuid
+
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# GCS notification event types that change the content of an object
+CHANGE_EVENTS = ('OBJECT_FINALIZE', 'OBJECT_DELETE', 'OBJECT_ARCHIVE')
+
+# seconds an unused per-process subscription is kept, the shortest expiration Pub/Sub allows
+SUBSCRIPTION_TTL = 24 * 3600
+# seconds an undelivered notification is kept, the shortest retention Pub/Sub allows; a
+# notification older than that is superseded by the cache TTL anyway
+MESSAGE_RETENTION = 600
+
+
+class InvalidationListener:
+    """Consumes GCS object notifications and invalidates the backend entries of changed objects.
+
+    Listens on `subscription`, or on a subscription of its own to `topic`, created by `start`
+    and deleted by `stop`. `subscriber` defaults to a `google.cloud.pubsub_v1.SubscriberClient`;
+    anything with the same `subscribe(subscription, callback)` method returning a cancellable
+    future, and `create_subscription` and `delete_subscription` for a topic, will do.
+    """
+
+    def __init__(self, backend, subscription: Optional[str] = None, subscriber=None, topic: Optional[str] = None):
+        if not subscription and not topic:
+            raise ValueError("a subscription or a topic is required")
+        self.backend = backend
+        self.subscription = subscription
+        self.topic = topic
+        self.subscriber = subscriber
+        self.future = None
+        self.created = False
+
+    def start(self):
+        if self.subscriber is None:
+            from google.cloud.pubsub_v1 import SubscriberClient
+            self.subscriber = SubscriberClient()
+        if self.topic:
+            self.subscription = _subscription_name(self.topic)
+            self.subscriber.create_subscription(request={
+                'name': self.subscription,
+                'topic': self.topic,
+                'expiration_policy': {'ttl': {'seconds': SUBSCRIPTION_TTL}},
+                'message_retention_duration': {'seconds': MESSAGE_RETENTION},
+            })
+            self.created = True
+        self.future = self.subscriber.subscribe(self.subscription, callback=self._on_message)
+        log.debug("Listening for changes to gs://%s/%s on %s",
+                  self.backend.bucket_name, self.backend.root_folder_name, self.subscription)
+        return self
+
+    def stop(self):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        if self.created:
+            self.created = False
+            try:
+                self.subscriber.delete_subscription(request={'subscription': self.subscription})
+            except Exception as e:
+                # it expires on its own
+                log.warning("Could not delete subscription %s: %s", self.subscription, e)
+
+    def _on_message(self, message):
+        try:
+            self.handle(message.attributes)
+        except Exception as e:
+            log.warning("Could not handle GCS notification %s: %s", dict(message.attributes), e)
+        finally:
+            # a lost invalidation only delays the change until the cache entry expires
+            message.ack()
+
+    def handle(self, attributes) -> bool:
+        """Invalidate the entry of the object described by notification `attributes`.
+
+        Returns whether a cached entry was dropped.
+        """
+        event_type = attributes.get('eventType')
+        object_id = attributes.get('objectId', '')
+        if event_type not in CHANGE_EVENTS or attributes.get('bucketId') != self.backend.bucket_name:
+            return False
+        if not object_id.startswith(self.backend.root_folder_name + '/'):
+            return False
+        return self.backend.invalidate_blob(object_id, generation=_generation(attributes),
+                                            deleted=event_type != 'OBJECT_FINALIZE')
+
+
+def airflow_component(argv=None) -> Optional[str]:
+    """The Airflow command this process runs, e.g. 'scheduler' for `airflow scheduler`, or None."""
+    argv = sys.argv if argv is None else argv
+    # `airflow <command>`, or `python -m airflow <command>`
+    if not argv or 'airflow' not in (os.path.basename(argv[0]), os.path.basename(os.path.dirname(argv[0]))):
+        return None
+    words = [arg for arg in argv[1:] if not arg.startswith('-')]
+    return words[0] if words else None
+
+
+def _subscription_name(topic: str) -> str:
+    """A subscription name unique to this process, in the project of `topic`."""
+    project, _, topic_id = topic.partition('/topics/')
+    host = ''.join(c if c.isalnum() or c in '-_' else '-' for c in socket.gethostname().lower())
+    # names are at most 255 characters and start with a letter
+    name = '{}-{}-{}-{}'.format(topic_id, host, os.getpid(), uuid.uuid4().hex[:8])[-255:]
+    if not name[0].isalpha():
+        name = 's' + name[1:]
+    return '{}/subscriptions/{}'.format(project, name)
+
+
+def _generation(attributes) -> Optional[int]:
+    try:
+        return int(attributes['objectGeneration'])
+    except (KeyError, ValueError):
+        return None
@@ -0,0 +1,65 @@
+from typing import TYPE_CHECKING, Dict, Optional
+
+if TYPE_CHECKING:
+    from airflow.models.connection import Connection
+
+_UNSET = object()
+
+
+class ConnectionRecord:
+    """The decrypted fields of a connection, as kept in the connections cache.
+
+    Records are immutable and much smaller than a `Connection`, which is only
+    built when one is asked for. The connection URI is built once, on first use.
+    """
+
+    __slots__ = ('_fields', '_uri')
+
+    def __init__(self, fields: Dict):
+        object.__setattr__(self, '_fields', tuple(fields.items()))
+        object.__setattr__(self, '_uri', _UNSET)
+
+    @classmethod
+    def from_dict(cls, conn_dict: Optional[Dict]) -> Optional['ConnectionRecord']:
+        """A record of a decrypted connection, or None for an empty one."""
+        if not conn_dict:
+            return None
+        return cls(conn_dict)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ConnectionRecord is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("ConnectionRecord is immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, ConnectionRecord) and self._fields == other._fields
+
+    def __hash__(self):
+        return hash(tuple(name for name, _ in self._fields))
+
+    def __repr__(self):
+        # field names only, values are secrets
+        return "ConnectionRecord({})".format(", ".join(name for name, _ in self._fields))
+
+    def get(self, name: str, default=None):
+        for field, value in self._fields:
+            if field == name:
+                return value
+        return default
+
+    def as_dict(self) -> Dict:
+        return dict(self._fields)
+
+    def to_connection(self, conn_id: str) -> 'Connection':
+        """A new `Connection` with the fields of this record."""
+        from airflow.models.connection import Connection
+        return Connection(conn_id=conn_id, **self.as_dict())
+
+    @property
+    def uri(self) -> str:
+        uri = self._uri
+        if uri is _UNSET:
+            uri = self.to_connection(None).get_uri()
+            object.__setattr__(self, '_uri', uri)
+        return uri
@@ -0,0 +1,95 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import weakref
+
+from time import monotonic
+from typing import Callable, Hashable
+
+log = logging.getLogger(__name__)
+
+
+class BackgroundRefresher:
+    """Runs scheduled refreshes of cache entries on a daemon thread.
+
+    Each key is scheduled at most once at a time; scheduling a key that is already
+    pending is a no-op, so a hot entry is refreshed once however often it is read.
+    A refresh that raises is logged and dropped, leaving the cached value in place.
+    The thread starts with the first scheduled refresh, and again in a forked process,
+    where the refreshes pending in the parent are dropped.
+    """
+
+    def __init__(self, name: str = 'airflow-sops-refresher', timer=monotonic):
+        self.name = name
+        self._timer = timer
+        self._counter = itertools.count()
+        self._stopped = False
+        self._reset()
+        after_fork_in_child(self, BackgroundRefresher._reset)
+
+    def _reset(self):
+        self._queue = []
+        self._pending = set()
+        # the lock may have been held by a thread of the parent process
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, key: Hashable, refresh: Callable[[], None], due: float = 0.0):
+        """Run `refresh` on the refresher thread once the timer reaches `due`."""
+        with self._condition:
+            if self._stopped or key in self._pending:
+                return
+            self._pending.add(key)
+            heapq.heappush(self._queue, (due, next(self._counter), key, refresh))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def is_pending(self, key: Hashable) -> bool:
+        with self._condition:
+            return key in self._pending
+
+    def stop(self, timeout: float = None):
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._pending.clear()
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._queue or self._queue[0][0] > self._timer()):
+                    self._condition.wait(self._queue[0][0] - self._timer() if self._queue else None)
+                if self._stopped:
+                    return
+                _, _, key, refresh = heapq.heappop(self._queue)
+            try:
+                refresh()
+            except Exception as e:
+                log.warning("Background refresh of %s failed, keeping the cached value: %s", key, e)
+            finally:
+                with self._condition:
+                    self._pending.discard(key)
+
+
+def after_fork_in_child(obj, reset: Callable[[object], None]):
+    """Call `reset(obj)` in the child of every fork, for as long as `obj` is alive.
+
+    Threads don't survive a fork, so objects that start threads must forget them.
+    """
+    if not hasattr(os, 'register_at_fork'):
+        return
+    ref = weakref.ref(obj)
+
+    def after_fork():
+        instance = ref()
+        if instance is not None:
+            reset(instance)
+
+    os.register_at_fork(after_in_child=after_fork)
@@ -0,0 +1,211 @@
+import random
+import threading
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Optional
+from .refresher import after_fork_in_child
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed GCS or KMS request is worth retrying.
+
+    GCS errors are those the storage library retries itself, e.g. read timeouts and 408,
+    429 and 5xx responses; KMS errors those the API core retries.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    from google.api_core.exceptions import DeadlineExceeded
+    from google.api_core.retry import if_transient_error
+    from google.cloud.storage.retry import _should_retry
+    return isinstance(error, DeadlineExceeded) or if_transient_error(error) or _should_retry(error)
+
+
+class LatencyTracker:
+    """The latencies of the last `window` requests of one kind."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """The `q` quantile of the recorded latencies, or None until `min_samples` were recorded."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class RequestPolicy:
+    """Timeouts, retries and hedging for GCS and KMS requests.
+
+    A request is retried up to `max_retries` times on transient errors, after an exponential
+    backoff with full jitter, as long as the deadline allows. With `hedge`, an attempt still
+    running after the `hedge_quantile` latency of its kind of request gets a duplicate, and
+    whichever answers first wins. Hedged attempts run on a pool of `max_workers` threads,
+    or on a thread of their own when the pool is busy, so no attempt waits for a worker.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, max_retries: int = 0, backoff: float = 0.1,
+                 max_backoff: float = 2.0, hedge: bool = False, hedge_quantile: float = 0.95,
+                 max_workers: int = 8):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.max_workers = max_workers
+        self.latencies: Dict[str, LatencyTracker] = {}
+        self._reset()
+        after_fork_in_child(self, RequestPolicy._reset)
+
+    def _reset(self):
+        # a forked process has none of the pool threads of its parent
+        self._executor = None
+        self._busy = 0
+        self._lock = threading.Lock()
+
+    def call(self, name: str, fn: Callable[[Optional[float]], object], deadline: Optional[float] = None):
+        """Call `fn(timeout)` until it succeeds, fails for good or `deadline` passes.
+
+        `timeout` is the time left for the attempt, None when there is no limit.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._attempt(name, fn, deadline)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_transient(e):
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                if deadline is not None and monotonic() + delay >= deadline:
+                    raise
+            sleep(delay)
+            attempt += 1
+
+    def _attempt(self, name, fn, deadline):
+        timeout = self.timeout
+        if deadline is not None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise TimeoutError("deadline exceeded before {}".format(name))
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        tracker = self._tracker(name)
+        hedge_after = tracker.quantile(self.hedge_quantile) if self.hedge else None
+        start = monotonic()
+        if hedge_after is None or (timeout is not None and hedge_after >= timeout):
+            result = fn(timeout)
+            tracker.record(monotonic() - start)
+            return result
+
+        futures = [self._start(fn, timeout)]
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            futures.append(self._start(fn, None if timeout is None else timeout - hedge_after))
+        pending = set(futures)
+        error = None
+        while pending:
+            left = None if timeout is None else max(0.0, start + timeout - monotonic())
+            done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    tracker.record(monotonic() - start)
+                    return future.result()
+                error = future.exception()
+        if error is not None:
+            raise error
+        raise TimeoutError("{} did not answer within {:.3f}s".format(name, timeout))
+
+    def _tracker(self, name) -> LatencyTracker:
+        tracker = self.latencies.get(name)
+        if tracker is None:
+            with self._lock:
+                tracker = self.latencies.setdefault(name, LatencyTracker())
+        return tracker
+
+    def _start(self, fn, timeout) -> Future:
+        """Run `fn(timeout)` in the background, on a pooled thread if one is free."""
+        with self._lock:
+            pooled = self._busy < self.max_workers
+            if pooled:
+                self._busy += 1
+        if pooled:
+            future = self._get_executor().submit(fn, timeout)
+            future.add_done_callback(self._release)
+            return future
+
+        # a queued attempt could time out before it even starts
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(timeout))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name='airflow-sops-hedge', daemon=True).start()
+        return future
+
+    def _release(self, _future):
+        with self._lock:
+            self._busy -= 1
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix='airflow-sops-hedge')
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+class EntryHealth:
+    """Latency and failure rate of each key entry, as exponentially weighted moving averages."""
+
+    def __init__(self, alpha: float = 0.3, failure_penalty: float = 10.0):
+        self.alpha = alpha
+        self.failure_penalty = failure_penalty
+        self._stats: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: Optional[float] = None, failed: bool = False):
+        with self._lock:
+            stats = self._stats.get(name)
+            failure = 1.0 if failed else 0.0
+            if stats is None:
+                self._stats[name] = [seconds, failure]
+                return
+            if seconds is not None:
+                stats[0] = seconds if stats[0] is None else stats[0] + self.alpha * (seconds - stats[0])
+            stats[1] += self.alpha * (failure - stats[1])
+
+    def rank(self, names: List[str]) -> List[int]:
+        """Indices of `names`, healthy entries first by latency, then entries never seen, then failing ones."""
+        with self._lock:
+            stats = [self._stats.get(name) for name in names]
+
+        def score(i):
+            if stats[i] is None:
+                return (1, 0.0)
+            latency, failure_rate = stats[i]
+            cost = (latency or 0.0) * (1 + self.failure_penalty * failure_rate)
+            return (0 if failure_rate < 0.5 else 2, cost)
+
+        return sorted(range(len(names)), key=score)
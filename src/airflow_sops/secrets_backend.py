@@ -1,31 +1,65 @@
 import os
 import atexit
+import contextlib
+import functools
+import hashlib
+import threading
+import weakref
 
-from typing import TYPE_CHECKING, Dict, Optional
+import concurrent.futures
+
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, Union
 from io import BytesIO
-from ruamel.yaml import YAML
+from time import monotonic
 from base64 import b64decode
-from google.cloud.kms import KeyManagementServiceClient, DecryptRequest
 from airflow.exceptions import AirflowException
 from airflow.secrets import BaseSecretsBackend
 from airflow.utils.log.logging_mixin import LoggingMixin
-from google.cloud.storage import Client as StorageClient
-from google.auth import default
-from google.auth.exceptions import DefaultCredentialsError
-from .helpers import _get_key_from_pgp, _check_rotation_needed, _walk_and_decrypt
+from .bundle import ConnectionsBundle, bundle_index
+from .cache import CachedBlob, TTLCache
+from .disk_cache import DiskBlobCache
+from .keyservice import KeyServiceClient
+from .metrics import Metrics
+from .records import ConnectionRecord
+from .refresher import BackgroundRefresher
+from .resilience import EntryHealth, RequestPolicy
+from .helpers import _get_key_from_pgp, _check_rotation_needed, _walk_and_decrypt, _LazyDecryptedTree, \
+    _load_document, _check_mac
+
+# (blob name, generation) a document was read from
+BlobVersion = Tuple[str, object]
 
 if TYPE_CHECKING:
     # Avoid circular import problems when instantiating the backend during configuration.
     # See: https://github.com/apache/airflow/pull/25810/files/44399b7a3ccf151afa469367dd9319107138218a
     from airflow.models.connection import Connection
 
+
+def _not_found():
+    """The GCS "not found" error, imported on demand because google.api_core is slow to import."""
+    from google.api_core.exceptions import NotFound
+    return NotFound
+
+
 # Composer environment key for bucket name.
 BUCKET_NAME = os.environ.get('GCS_BUCKET')
 
 YAML_FILE_EXT = "yaml"
 
+FILE_FORMATS = ("yaml", "json")
+
+# cached in place of the connections index when the connections folder can't be listed
+_INDEX_UNAVAILABLE = object()
+
 
 class GcsSopsSecretsBackend(BaseSecretsBackend, LoggingMixin):
+    """Reads Airflow connections and variables from SOPS encrypted files in a GCS bucket.
+
+    A backend instance is safe to share between threads: the caches are locked, the GCS
+    and KMS clients are created once and reuse pooled HTTP connections and one gRPC channel.
+    """
+
     def __init__(
             self,
             project_id: Optional[str] = None,
@@ -34,8 +68,41 @@ class GcsSopsSecretsBackend(BaseSecretsBackend, LoggingMixin):
             connections_folder_name: str = "connections",
             variables_file_name: str = "variables",
             encrypted_file_ext: str = "enc",
-            ignore_mac: bool = True):
+            file_format: str = YAML_FILE_EXT,
+            ignore_mac: bool = True,
+            key_cache_max_size: int = 128,
+            key_cache_ttl: Optional[float] = 3600,
+            connections_cache_max_size: int = 256,
+            connections_cache_ttl: float = 60,
+            variables_cache_ttl: float = 60,
+            variables_encrypted: bool = False,
+            max_workers: int = 8,
+            prefetch_connections: bool = False,
+            disk_cache_dir: Optional[str] = None,
+            disk_cache_max_bytes: int = 64 * 1024 * 1024,
+            key_service_socket: Optional[str] = None,
+            connections_index_ttl: Optional[float] = None,
+            negative_cache_ttl: Optional[float] = 60,
+            metrics: bool = True,
+            tracing: bool = False,
+            http_pool_size: Optional[int] = None,
+            kms_keepalive_ms: Optional[int] = None,
+            connections_bundle: Optional[str] = None,
+            refresh_ahead: Optional[float] = None,
+            max_staleness: float = 0,
+            notifications_subscription: Optional[str] = None,
+            notifications_topic: Optional[str] = None,
+            notifications_components: Iterable[str] = ('scheduler', 'triggerer', 'dag-processor'),
+            request_timeout: Optional[float] = None,
+            lookup_deadline: Optional[float] = None,
+            max_retries: int = 0,
+            retry_backoff: float = 0.1,
+            hedged_requests: bool = False,
+            hedge_quantile: float = 0.95,
+            race_key_entries: bool = False,
+            key_race_width: int = 2):
         super().__init__()
+        self.metrics = Metrics(enabled=metrics, tracing=tracing, log=self.log)
         self.project_id = project_id
         self.bucket_name = bucket_name
         self.root_folder_name = root_folder_name
@@ -43,84 +110,923 @@ class GcsSopsSecretsBackend(BaseSecretsBackend, LoggingMixin):
         self.variables_file_name = variables_file_name
         self.encrypted_file_ext = encrypted_file_ext
         self.ignore_mac = ignore_mac
+        # unwrapped data keys, keyed by the wrapped key material, so repeated reads skip KMS
+        self.key_cache = TTLCache(max_size=key_cache_max_size, ttl=key_cache_ttl, name='key_cache')
+        # node-local key service asked before KMS, see airflow_sops.keyservice
+        self.key_service = KeyServiceClient(key_service_socket) if key_service_socket else None
+        # decrypted connections, keyed by blob name and revalidated against the blob generation
+        self.connections_cache = TTLCache(max_size=connections_cache_max_size, name='connections_cache')
+        self.connections_cache_ttl = connections_cache_ttl
+        # the loaded connections bundle, when connections are read from one, see airflow_sops.bundle
+        self.connections_bundle = connections_bundle
+        self.bundle_cache = TTLCache(max_size=1 if connections_cache_max_size > 0 else 0, name='bundle_cache')
+        # the parsed variables file, indexed by variable key
+        self.variables_cache = TTLCache(max_size=1, name='variables_cache')
+        # names of the existing connection blobs, from one listing of the connections folder; the folder
+        # is listed on the first missing connection, so lookups of existing connections never wait for it
+        self.connections_index = TTLCache(max_size=1, ttl=connections_index_ttl)
+        self.connections_index_ttl = connections_index_ttl
+        # blob names known not to exist, so misses are answered without a request
+        self.negative_cache = TTLCache(max_size=1024 if negative_cache_ttl else 0, ttl=negative_cache_ttl)
+        self.variables_cache_ttl = variables_cache_ttl
+        # hot entries are revalidated on a background thread `refresh_ahead` seconds before they expire,
+        # and cached values up to `max_staleness` seconds past expiry are served while refreshing or on errors
+        self.refresh_ahead = refresh_ahead
+        self.max_staleness = max_staleness or 0
+        self.refresher = BackgroundRefresher() if refresh_ahead is not None else None
+        # GCS and KMS requests use the client library timeouts and retries, unless any of these is set
+        self.lookup_deadline = lookup_deadline
+        self._deadlines = threading.local()
+        # loads and unwraps in flight, awaited by the threads that need the same blob or data key
+        self._inflight: Dict[Hashable, Future] = {}
+        self._inflight_lock = threading.Lock()
+        self.request_policy = None
+        if request_timeout or lookup_deadline or max_retries or hedged_requests:
+            self.request_policy = RequestPolicy(timeout=request_timeout, max_retries=max_retries,
+                                                backoff=retry_backoff, hedge=hedged_requests,
+                                                hedge_quantile=hedge_quantile, max_workers=max_workers)
+        # unwrap through several key entries at once, healthiest first, see _race_for_key
+        self.race_key_entries = race_key_entries
+        self.key_race_width = key_race_width
+        self.key_entry_health = EntryHealth()
+        # blob generations whose key rotation was checked, mapped to whether their MAC was verified;
+        # a generation never changes, so both checks run once per generation
+        self.checked_blobs = TTLCache(max_size=4096, name='checked_blobs')
+        self.variables_encrypted = variables_encrypted
+        self.max_workers = max_workers
+        # encrypted blobs shared with the other processes on this node
+        self.disk_cache = DiskBlobCache(disk_cache_dir, max_bytes=disk_cache_max_bytes) if disk_cache_dir else None
 
         if not self.bucket_name or self.bucket_name == "":
             self.bucket_name = BUCKET_NAME
             if not self.bucket_name or self.bucket_name == "":
                 raise AirflowException("Bucket name not found")
 
-        try:
-            self.credentials, self.project_id = default()
-        except (DefaultCredentialsError, FileNotFoundError):
-            self.log.exception(
-                'Unable to load credentials for GCP Secret Manager. '
-                'Make sure that the keyfile path, dictionary, or GOOGLE_APPLICATION_CREDENTIALS '
-                'environment variable is correct and properly configured.'
-            )
-
-        # In case project id provided
-        if project_id:
-            self.project_id = project_id
+        # credentials and clients are created on the first lookup, see storage_client and kms_client
+        self.credentials = None
+        self._storage_client = None
+        self._kms_client = None
+        self._bucket = None
+        self.http_pool_size = http_pool_size
+        self.kms_keepalive_ms = kms_keepalive_ms
+        self._clients_lock = threading.RLock()
+        self._credentials_loaded = False
+        # the async lookups of each event loop, see airflow_sops.aio
+        self._async_lookups = weakref.WeakKeyDictionary()
 
+        if file_format not in FILE_FORMATS:
+            raise AirflowException("Unsupported file format {}, expected one of {}".format(file_format, FILE_FORMATS))
+        self.file_format = file_format
         if not self.encrypted_file_ext:
-            self.file_ext = YAML_FILE_EXT
+            self.file_ext = self.file_format
         else:
-            self.file_ext = "{}.{}".format(self.encrypted_file_ext, YAML_FILE_EXT)
-
-        self.storage_client = StorageClient(project=self.project_id)
-        self.kms_client = KeyManagementServiceClient()
+            self.file_ext = "{}.{}".format(self.encrypted_file_ext, self.file_format)
 
         atexit.register(self._cleanup)
 
+        # evicts entries when GCS reports a change to their file, see airflow_sops.notifications; only
+        # the long-lived Airflow components listen, task processes rely on the cache TTLs
+        self.notifications_subscription = notifications_subscription
+        self.notifications_topic = notifications_topic
+        self.notifications = None
+        self._listens = False
+        if notifications_subscription or notifications_topic:
+            from .notifications import airflow_component
+            self._listens = airflow_component() in set(notifications_components)
+        self._listener_thread = None
+        # processes forked from this one, e.g. the tasks of a LocalExecutor, never listen
+        self._owner_pid = os.getpid()
+
+        if prefetch_connections:
+            try:
+                self.prefetch_connections()
+            except Exception:
+                self.log.exception("Prefetching connections from bucket %s failed", self.bucket_name)
+
+    @property
+    def storage_client(self):
+        """The GCS client, created on first use."""
+        if self._storage_client is None:
+            with self._clients_lock:
+                if self._storage_client is None:
+                    from google.cloud.storage import Client as StorageClient
+                    self._load_credentials()
+                    session = self._pooled_http_session()
+                    if session is None:
+                        self._storage_client = StorageClient(project=self.project_id)
+                    else:
+                        self._storage_client = StorageClient(project=self.project_id,
+                                                             credentials=session.credentials, _http=session)
+        return self._storage_client
+
+    @storage_client.setter
+    def storage_client(self, client):
+        self._storage_client = client
+        self._bucket = None
+
+    def _pooled_http_session(self):
+        """An authorized HTTP session whose connection pool holds `http_pool_size` connections."""
+        if not self.http_pool_size or self.credentials is None:
+            return None
+        from google.auth.credentials import with_scopes_if_required
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud.storage import Client as StorageClient
+        from requests.adapters import HTTPAdapter
+        # the storage client only scopes the credentials of the sessions it creates itself
+        session = AuthorizedSession(with_scopes_if_required(self.credentials, StorageClient.SCOPE))
+        adapter = HTTPAdapter(pool_connections=self.http_pool_size, pool_maxsize=self.http_pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def bucket(self):
+        """The bucket handle, shared by all lookups."""
+        if self._bucket is None:
+            self._bucket = self.storage_client.bucket(self.bucket_name)
+        return self._bucket
+
+    @property
+    def kms_client(self):
+        """The KMS client, created on first use."""
+        if self._kms_client is None:
+            with self._clients_lock:
+                if self._kms_client is None:
+                    from google.cloud.kms import KeyManagementServiceClient
+                    self._load_credentials()
+                    transport = self._kms_transport()
+                    if transport is None:
+                        self._kms_client = KeyManagementServiceClient()
+                    else:
+                        self._kms_client = KeyManagementServiceClient(transport=transport)
+        return self._kms_client
+
+    @kms_client.setter
+    def kms_client(self, client):
+        self._kms_client = client
+
+    def _kms_transport(self):
+        """A gRPC transport whose channel sends keepalive pings every `kms_keepalive_ms`."""
+        if not self.kms_keepalive_ms:
+            return None
+        from google.cloud.kms_v1.services.key_management_service.transports import KeyManagementServiceGrpcTransport
+        channel = KeyManagementServiceGrpcTransport.create_channel(
+            credentials=self.credentials,
+            options=[("grpc.keepalive_time_ms", self.kms_keepalive_ms),
+                     ("grpc.keepalive_timeout_ms", min(self.kms_keepalive_ms, 20000)),
+                     ("grpc.keepalive_permit_without_calls", 1),
+                     ("grpc.http2.max_pings_without_data", 0)])
+        return KeyManagementServiceGrpcTransport(channel=channel)
+
+    def _load_credentials(self):
+        if self._credentials_loaded:
+            return
+        with self._clients_lock:
+            if self._credentials_loaded:
+                return
+            from google.auth import default
+            from google.auth.exceptions import DefaultCredentialsError
+            try:
+                credentials, project_id = default()
+                self.credentials = credentials
+                # In case project id provided
+                if not self.project_id:
+                    self.project_id = project_id
+            except (DefaultCredentialsError, FileNotFoundError):
+                self.log.exception(
+                    'Unable to load credentials for GCP Secret Manager. '
+                    'Make sure that the keyfile path, dictionary, or GOOGLE_APPLICATION_CREDENTIALS '
+                    'environment variable is correct and properly configured.'
+                )
+            self._credentials_loaded = True
+
     def get_connection(self, conn_id: str) -> Optional['Connection']:
-        stream = self._download_to_stream("{}/{}/{}.{}".format(
-            self.root_folder_name, self.connections_folder_name, conn_id, self.file_ext))
-        conn_dict = self._decrypt_stream(stream, ignore_mac=self.ignore_mac)
-        from airflow.models.connection import Connection
-        if conn_dict:
-            conn = Connection(conn_id=conn_id, **conn_dict)
-            return conn
+        return self._build_connection(conn_id, self._get_connection_record(conn_id))
+
+    def _get_connection_record(self, conn_id: str) -> Optional[ConnectionRecord]:
+        with self.metrics.phase('get_connection'), self._deadline_scope():
+            if self.connections_bundle:
+                return self._get_bundle().get(conn_id)
+            blob_name = self._connection_blob_name(conn_id)
+            if self._is_missing(blob_name):
+                return None
+            try:
+                return self._get_cached_document(
+                    blob_name, self.connections_cache, self.connections_cache_ttl, self._load_connection)
+            except _not_found():
+                self.negative_cache.set(blob_name, True)
+                self._load_connections_index()
+                return None
+
+    def get_connections(self, conn_ids: Iterable[str],
+                        return_exceptions: bool = False) -> Dict[str, Union[Optional['Connection'], Exception]]:
+        """Resolve several connections at once.
+
+        Cache misses are revalidated and downloaded concurrently, blobs sharing a data key are
+        unwrapped once and decrypted in parallel. A connection that cannot be loaded maps to None
+        and the error is logged, or to the raised exception when `return_exceptions` is true.
+        """
+        with self.metrics.phase('get_connections'), self._deadline_scope():
+            if self.connections_bundle:
+                return self._get_bundled_connections(list(dict.fromkeys(conn_ids)), return_exceptions)
+            return self._get_connections(list(dict.fromkeys(conn_ids)), return_exceptions)
+
+    def _get_bundled_connections(self, conn_ids: List[str], return_exceptions: bool):
+        bundle = self._get_bundle()
+        connections = {}
+        for conn_id in conn_ids:
+            try:
+                connections[conn_id] = self._build_connection(conn_id, bundle.get(conn_id))
+            except Exception as e:
+                self.log.warning("Could not load connection %s: %s", conn_id, e)
+                connections[conn_id] = e if return_exceptions else None
+        return connections
+
+    def _get_connections(self, conn_ids: List[str], return_exceptions: bool):
+        self._listen_for_changes()
+        results = {}
+        pending = []
+        for conn_id in conn_ids:
+            if self._is_missing(self._connection_blob_name(conn_id)):
+                results[conn_id] = None
+                continue
+            cached = self._get_fresh(self._connection_blob_name(conn_id), self.connections_cache,
+                                     self.connections_cache_ttl, self._load_connection)
+            if cached is not None:
+                self.metrics.incr('connections_cache.hit')
+                results[conn_id] = cached.value
+            else:
+                pending.append(conn_id)
+
+        revalidated = self._map_concurrently(
+            lambda conn_id: self._blob_to_load(self._connection_blob_name(conn_id), self.connections_cache), pending)
+        to_load = []
+        for conn_id, outcome in zip(pending, revalidated):
+            if isinstance(outcome, Exception):
+                stale = self._stale_fallback(self._connection_blob_name(conn_id), self.connections_cache,
+                                             self.connections_cache_ttl, outcome)
+                results[conn_id] = outcome if stale is None else stale.value
+                continue
+            blob, cached = outcome
+            if blob is None:
+                results[conn_id] = cached.value
+            else:
+                to_load.append((conn_id, blob))
+
+        self.metrics.incr('connections_cache.miss', len(to_load))
+        loaded = self._load_connection_blobs([blob for _, blob in to_load])
+        now = monotonic()
+        for (conn_id, blob), record in zip(to_load, loaded):
+            if not isinstance(record, Exception):
+                self.connections_cache.set(blob.name, CachedBlob(blob.generation, record, now))
+            else:
+                stale = self._stale_fallback(blob.name, self.connections_cache, self.connections_cache_ttl, record)
+                if stale is not None:
+                    record = stale.value
+            results[conn_id] = record
+
+        connections = {}
+        for conn_id in conn_ids:
+            result = results[conn_id]
+            if isinstance(result, Exception) and isinstance(result, _not_found()):
+                self.negative_cache.set(self._connection_blob_name(conn_id), True)
+                self._load_connections_index()
+                connections[conn_id] = None
+            elif isinstance(result, Exception):
+                self.log.warning("Could not load connection %s: %s", conn_id, result)
+                connections[conn_id] = result if return_exceptions else None
+            else:
+                connections[conn_id] = self._build_connection(conn_id, result)
+        return connections
+
+    def _load_connection(self, stream, version: Optional[BlobVersion] = None) -> Optional[ConnectionRecord]:
+        return ConnectionRecord.from_dict(self._decrypt_stream(stream, ignore_mac=self.ignore_mac, version=version))
+
+    def _load_connection_tree(self, tree, version: Optional[BlobVersion] = None,
+                              key: Optional[bytes] = None) -> Optional[ConnectionRecord]:
+        return ConnectionRecord.from_dict(self._decrypt_tree(tree, ignore_mac=self.ignore_mac, key=key,
+                                                             version=version))
+
+    @staticmethod
+    def _build_connection(conn_id: str, record: Optional[ConnectionRecord]) -> Optional['Connection']:
+        if record:
+            return record.to_connection(conn_id)
         return None
 
     def get_conn_uri(self, conn_id: str) -> Optional[str]:
-        conn = self.get_connection(conn_id)
-        if conn:
-            return conn.get_uri()
+        """The URI of a connection, built once per cached connection without creating a `Connection`."""
+        record = self._get_connection_record(conn_id)
+        if record:
+            return record.uri
         return None
 
     def get_variable(self, key: str) -> Optional[str]:
-        """variables are not encrypted. the variable is downloaded and passed as is."""
-        stream = self._download_to_stream("{}/{}.{}".format(
-            self.root_folder_name, self.variables_file_name, YAML_FILE_EXT))
-        yaml = YAML(typ='safe', pure=True)
-        tree = yaml.load(stream)
-        var_dict = dict(tree)
-        if var_dict and var_dict.get(key):
-            return var_dict[key]
+        """Read a variable from the parsed variables file.
+
+        When `variables_encrypted` is set, only the requested variable is decrypted, on first access.
+        """
+        with self.metrics.phase('get_variable'), self._deadline_scope():
+            var_dict = self._get_variables()
+            if var_dict and var_dict.get(key):
+                return var_dict[key]
+            return None
+
+    def get_variables(self, keys: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Return the values of several variables, reading the variables file at most once."""
+        with self._deadline_scope():
+            var_dict = self._get_variables()
+        return {key: var_dict.get(key) or None for key in keys}
+
+    def _get_variables(self) -> Dict:
+        blob_name = self._variables_blob_name()
+        if blob_name in self.negative_cache:
+            self.metrics.incr('negative_cache.hit')
+            return {}
+        try:
+            return self._get_cached_document(
+                blob_name, self.variables_cache, self.variables_cache_ttl, self._load_variables)
+        except _not_found():
+            self.negative_cache.set(blob_name, True)
+            return {}
+
+    async def aget_connection(self, conn_id: str) -> Optional['Connection']:
+        """Like `get_connection`, without blocking the event loop, see airflow_sops.aio."""
+        return self._build_connection(conn_id, await self._async_lookup(self._aget_connection_record(conn_id)))
+
+    async def _aget_connection_record(self, conn_id: str) -> Optional[ConnectionRecord]:
+        lookups = self._get_async_lookups()
+        with self.metrics.phase('get_connection'):
+            if self.connections_bundle:
+                bundle = await lookups.get_document(self._bundle_blob_name(), self.bundle_cache,
+                                                    self.connections_cache_ttl, self._load_bundle,
+                                                    self._load_bundle_tree, missing=ConnectionsBundle({}, {}))
+                # decrypts the connection on first access
+                return await lookups.resolve(bundle.get, conn_id)
+            return await lookups.get_document(self._connection_blob_name(conn_id), self.connections_cache,
+                                              self.connections_cache_ttl, self._load_connection,
+                                              self._load_connection_tree)
+
+    async def aget_variable(self, key: str) -> Optional[str]:
+        """Like `get_variable`, without blocking the event loop, see airflow_sops.aio."""
+        lookups = self._get_async_lookups()
+        with self.metrics.phase('get_variable'):
+            var_dict = await self._async_lookup(lookups.get_document(
+                self._variables_blob_name(), self.variables_cache, self.variables_cache_ttl,
+                self._load_variables, self._load_variables_tree, missing={}))
+            if isinstance(var_dict, _LazyDecryptedTree):
+                value = await lookups.resolve(var_dict.get, key)
+            else:
+                value = var_dict.get(key) if var_dict else None
+        return value or None
+
+    async def _async_lookup(self, lookup):
+        """Await a lookup, within `lookup_deadline` when set."""
+        if not self.lookup_deadline:
+            return await lookup
+        import asyncio
+        return await asyncio.wait_for(lookup, self.lookup_deadline)
+
+    def _get_async_lookups(self):
+        """The async lookups of the running event loop, created on first use."""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        lookups = self._async_lookups.get(loop)
+        if lookups is None:
+            from .aio import AsyncLookups
+            lookups = self._async_lookups[loop] = AsyncLookups(self)
+        return lookups
+
+    async def aclose(self):
+        """Close the HTTP session and KMS channel of the async lookups on the running event loop."""
+        import asyncio
+        lookups = self._async_lookups.pop(asyncio.get_running_loop(), None)
+        if lookups is not None:
+            await lookups.close()
+
+    def _variables_blob_name(self) -> str:
+        file_ext = self.file_ext if self.variables_encrypted else self.file_format
+        return "{}/{}.{}".format(self.root_folder_name, self.variables_file_name, file_ext)
+
+    def _load_variables(self, stream, version: Optional[BlobVersion] = None):
+        return self._load_variables_tree(self._parse_stream(stream), version)
+
+    def _load_variables_tree(self, tree, version: Optional[BlobVersion] = None, key: Optional[bytes] = None):
+        if not tree:
+            return {}
+        if not self.variables_encrypted:
+            return dict(tree)
+        if not self.ignore_mac and not self._mac_verified(version):
+            return self._decrypt_tree(tree, ignore_mac=False, key=key, version=version)
+        if key is None:
+            key, tree = self._get_key(tree)
+        self._check_once(tree, version)
+        return _LazyDecryptedTree(tree, key)
+
+    def _get_bundle(self) -> ConnectionsBundle:
+        blob_name = self._bundle_blob_name()
+        if blob_name in self.negative_cache:
+            self.metrics.incr('negative_cache.hit')
+            return ConnectionsBundle({}, {})
+        try:
+            return self._get_cached_document(
+                blob_name, self.bundle_cache, self.connections_cache_ttl, self._load_bundle)
+        except _not_found():
+            self.negative_cache.set(blob_name, True)
+            return ConnectionsBundle({}, {})
+
+    def _bundle_blob_name(self) -> str:
+        return "{}/{}.{}".format(self.root_folder_name, self.connections_bundle, self.file_ext)
+
+    def _load_bundle(self, stream, version: Optional[BlobVersion] = None) -> ConnectionsBundle:
+        return self._load_bundle_tree(self._parse_stream(stream), version)
+
+    def _load_bundle_tree(self, tree, version: Optional[BlobVersion] = None,
+                          key: Optional[bytes] = None) -> ConnectionsBundle:
+        if not tree:
+            return ConnectionsBundle({}, {})
+        index = bundle_index(tree)
+        if not self.ignore_mac and not self._mac_verified(version):
+            return ConnectionsBundle(index, self._decrypt_tree(tree, ignore_mac=False, key=key, version=version))
+        if key is None:
+            key, tree = self._get_key(tree)
+        self._check_once(tree, version)
+        return ConnectionsBundle(index, _LazyDecryptedTree(tree, key))
+
+    def prefetch_connections(self) -> int:
+        """Load every connection in the connections folder into the cache.
+
+        The folder is listed once, blobs are downloaded concurrently and every distinct
+        data key is unwrapped once. Returns the number of connections loaded.
+        With `connections_bundle` set, the bundle is loaded and all its connections decrypted.
+        """
+        self._listen_for_changes()
+        if self.connections_bundle:
+            bundle = self._get_bundle()
+            for conn_id in bundle.conn_ids():
+                bundle.get(conn_id)
+            return len(bundle)
+        blobs = self._list_connection_blobs()
+        now = monotonic()
+        loaded = 0
+        for blob, record in zip(blobs, self._load_connection_blobs(blobs)):
+            if isinstance(record, Exception):
+                self.log.warning("Could not prefetch %s: %s", blob.name, record)
+                continue
+            self.connections_cache.set(blob.name, CachedBlob(blob.generation, record, now))
+            loaded += 1
+        self.log.debug("Prefetched %s of %s connections", loaded, len(blobs))
+        return loaded
+
+    def refresh_connections_index(self):
+        """Forget the connections index and the known missing blobs, e.g. after adding connections."""
+        self.connections_index.clear()
+        self.negative_cache.clear()
+
+    def _list_connection_blobs(self) -> List:
+        """List the connection blobs, refreshing the connections index with their names."""
+        prefix = "{}/{}/".format(self.root_folder_name, self.connections_folder_name)
+        suffix = ".{}".format(self.file_ext)
+        with self.metrics.phase('gcs_list'):
+            blobs = [blob for blob in self.storage_client.list_blobs(self.bucket_name, prefix=prefix)
+                     if blob.name.endswith(suffix)]
+        if self.connections_index_ttl:
+            self.connections_index.set(prefix, frozenset(blob.name for blob in blobs))
+        return blobs
+
+    def _is_missing(self, blob_name: str) -> bool:
+        """Tell from the negative cache or a loaded connections index whether a connection blob doesn't exist."""
+        if blob_name in self.negative_cache:
+            self.metrics.incr('negative_cache.hit')
+            return True
+        if not self.connections_index_ttl:
+            return False
+        prefix = "{}/{}/".format(self.root_folder_name, self.connections_folder_name)
+        index = self.connections_index.get(prefix)
+        if index is None or index is _INDEX_UNAVAILABLE:
+            return False
+        if blob_name not in index:
+            self.negative_cache.set(blob_name, True)
+            return True
+        return False
+
+    def _load_connections_index(self):
+        """List the connections folder after a missing connection, unless the index is loaded or disabled."""
+        if not self.connections_index_ttl:
+            return
+        prefix = "{}/{}/".format(self.root_folder_name, self.connections_folder_name)
+        if self.connections_index.get(prefix) is not None:
+            return
+        try:
+            self._list_connection_blobs()
+        except Exception as e:
+            self.log.warning("Could not list %s, connections are looked up one by one: %s", prefix, e)
+            self.connections_index.set(prefix, _INDEX_UNAVAILABLE)
+
+    def _load_connection_blobs(self, blobs: List) -> List:
+        """Download, unwrap and decrypt many connection blobs concurrently.
+
+        Returns the connection records in the order of `blobs`, with the raised
+        exception in place of any blob that could not be loaded.
+        """
+        trees = self._map_concurrently(lambda blob: self._parse_stream(self._download_blob_to_stream(blob)), blobs)
+
+        # unwrap each distinct data key once, however many blobs share it
+        key_ids = [None if isinstance(tree, Exception) else self._wrapped_key_id(tree) for tree in trees]
+        representatives = {}
+        for key_id, tree in zip(key_ids, trees):
+            if key_id is not None:
+                representatives.setdefault(key_id, tree)
+        unwrapped = self._map_concurrently(lambda tree: self._get_key(tree)[0], list(representatives.values()))
+        keys = dict(zip(representatives.keys(), unwrapped))
+
+        def decrypt(item):
+            blob, tree, key_id = item
+            if isinstance(tree, Exception):
+                raise tree
+            key = keys[key_id]
+            if isinstance(key, Exception):
+                raise key
+            return ConnectionRecord.from_dict(self._decrypt_tree(tree, ignore_mac=self.ignore_mac, key=key,
+                                                                 version=(blob.name, blob.generation)))
+
+        return self._map_concurrently(decrypt, list(zip(blobs, trees, key_ids)))
+
+    def _shared(self, key: Hashable, fn: Callable):
+        """Return `fn()`, or the outcome of the call for the same `key` already running on another thread.
+
+        A thread waiting for another one's call still gives up at the deadline of its own lookup.
+        """
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            running = future is not None
+            if not running:
+                future = self._inflight[key] = Future()
+        if running:
+            self.metrics.incr('inflight.shared')
+            deadline = getattr(self._deadlines, 'deadline', None)
+            try:
+                return future.result(None if deadline is None else max(0.0, deadline - monotonic()))
+            except concurrent.futures.TimeoutError:
+                raise TimeoutError("deadline exceeded waiting for {}".format(key[1])) from None
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _needs_listener(self) -> bool:
+        return self._listens and self._listener_thread is None and os.getpid() == self._owner_pid
+
+    def _listen_for_changes(self):
+        """Start listening for GCS notifications on the first lookup of a long-lived component.
+
+        The listener starts on a thread of its own, so the lookup doesn't wait for Pub/Sub.
+        """
+        if not self._needs_listener():
+            return
+        with self._clients_lock:
+            if not self._needs_listener():
+                return
+            self._listener_thread = threading.Thread(target=self._start_listener, daemon=True,
+                                                     name='airflow-sops-notifications')
+            self._listener_thread.start()
+
+    def _start_listener(self):
+        from .notifications import InvalidationListener
+        try:
+            self.notifications = InvalidationListener(self, self.notifications_subscription,
+                                                      topic=self.notifications_topic).start()
+        except Exception:
+            self.log.exception("Listening to GCS notifications on %s failed",
+                               self.notifications_topic or self.notifications_subscription)
+
+    def _map_concurrently(self, fn: Callable, items: List) -> List:
+        """Apply `fn` to every item on a bounded thread pool, keeping exceptions as results."""
+        deadline = getattr(self._deadlines, 'deadline', None)
+
+        def call(item):
+            try:
+                with self._deadline_scope(deadline):
+                    return fn(item)
+            except Exception as e:
+                return e
+
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [call(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            return list(executor.map(call, items))
+
+    @staticmethod
+    def _wrapped_key_id(tree) -> tuple:
+        """Identify the data key of a SOPS tree by its wrapped key material."""
+        sops = tree.get('sops') or {}
+        return (tuple((entry.get('resource_id'), entry.get('enc')) for entry in sops.get('gcp_kms') or [] if entry) +
+                tuple(entry.get('enc') for entry in sops.get('pgp') or [] if entry))
+
+    def _connection_blob_name(self, conn_id: str) -> str:
+        return "{}/{}/{}.{}".format(self.root_folder_name, self.connections_folder_name, conn_id, self.file_ext)
+
+    def _get_cached_document(self, blob_name, cache, ttl, load):
+        """Return the document loaded from a blob, served from cache while it is fresh.
+
+        Once `ttl` seconds have passed since the entry was last validated, only the blob
+        metadata is fetched; the blob is downloaded and loaded again only if its generation changed.
+        `load` is called with the downloaded stream and the `(blob_name, generation)` it holds.
+        """
+        self._listen_for_changes()
+        if cache.max_size <= 0:
+            stream, generation = self._download_to_stream(blob_name)
+            return load(stream, None if generation is None else (blob_name, generation))
+
+        cached = self._get_fresh(blob_name, cache, ttl, load)
+        if cached is not None:
+            self.metrics.incr('{}.hit'.format(cache.name))
+            return cached.value
+
+        def reload():
+            cached = cache.get(blob_name)
+            if cached is not None and monotonic() - cached.checked_at < ttl:
+                # reloaded by another thread since the cache was read
+                return cached
+            entry, loaded = self._load_blob(blob_name, cache, load)
+            if loaded:
+                self.metrics.incr('{}.miss'.format(cache.name))
+                cache.set(blob_name, entry)
+            return entry
+
+        try:
+            return self._shared((cache.name, blob_name), reload).value
+        except Exception as e:
+            stale = self._stale_fallback(blob_name, cache, ttl, e)
+            if stale is None:
+                raise
+            return stale.value
+
+    def _load_blob(self, blob_name, cache, load) -> Tuple[CachedBlob, bool]:
+        """Revalidate the cached entry of a blob, or load the blob; returns the entry and whether it was loaded.
+
+        With nothing cached to revalidate, the blob is downloaded right away and its generation
+        read from the download, unless the disk cache may already hold it.
+        """
+        if self.disk_cache is None and cache.get(blob_name) is None:
+            stream, generation = self._download_to_stream(blob_name)
+        else:
+            blob, cached = self._revalidate(blob_name, cache)
+            if blob is None:
+                return cached, False
+            stream, generation = self._download_blob_to_stream(blob), blob.generation
+        return CachedBlob(generation, load(stream, (blob_name, generation)), monotonic()), True
+
+    def _get_fresh(self, blob_name, cache, ttl, load) -> Optional[CachedBlob]:
+        """Return the cached entry for a blob if it was validated less than `ttl` seconds ago.
+
+        With background refreshes on, reading an entry schedules its refresh `refresh_ahead`
+        seconds before it expires, and an entry expired for less than `max_staleness` seconds
+        is returned while it is refreshed.
+        """
+        cached = cache.get(blob_name)
+        if cached is None:
+            return None
+        age = monotonic() - cached.checked_at
+        if age < ttl:
+            if self.refresher is not None:
+                self.refresher.schedule((cache.name, blob_name), lambda: self._refresh(blob_name, cache, load),
+                                        cached.checked_at + max(ttl - self.refresh_ahead, ttl / 2))
+            return cached
+        if self.refresher is not None and age < ttl + self.max_staleness:
+            self.refresher.schedule((cache.name, blob_name), lambda: self._refresh(blob_name, cache, load))
+            self.metrics.incr('{}.stale'.format(cache.name))
+            return cached
         return None
 
-    def _download_to_stream(self, source_blob_name):
-        """Downloads a blob to a stream or other file-like object."""
-        bucket = self.storage_client.bucket(self.bucket_name)
+    def _refresh(self, blob_name, cache, load):
+        """Revalidate a cached blob, and load it again if its generation changed."""
+        try:
+            entry, loaded = self._load_blob(blob_name, cache, load)
+        except _not_found():
+            cache.invalidate(blob_name)
+            self.negative_cache.set(blob_name, True)
+            return
+        if loaded:
+            cache.set(blob_name, entry)
+            self.metrics.incr('{}.refreshed'.format(cache.name))
+
+    def _stale_fallback(self, blob_name, cache, ttl, error) -> Optional[CachedBlob]:
+        """The cached entry to serve in place of a failed reload, if it is within `max_staleness`."""
+        if not self.max_staleness or isinstance(error, _not_found()):
+            return None
+        cached = cache.get(blob_name)
+        if cached is None or monotonic() - cached.checked_at >= ttl + self.max_staleness:
+            return None
+        self.log.warning("Could not reload %s, serving the cached value: %s", blob_name, error)
+        self.metrics.incr('{}.stale'.format(cache.name))
+        return cached
+
+    def _blob_to_load(self, blob_name, cache):
+        """`_revalidate`, except that a blob with nothing cached is returned without fetching its metadata.
+
+        Its generation is then read from the download.
+        """
+        if self.disk_cache is None and cache.get(blob_name) is None:
+            return self.bucket.blob(blob_name), None
+        return self._revalidate(blob_name, cache)
+
+    def _revalidate(self, blob_name, cache):
+        """Check a blob's generation against its cached entry.
+
+        Returns `(None, cached)` when the cached entry is still current, or `(blob, None)` with
+        the blob metadata loaded when it must be downloaded again.
+        """
+        cached = cache.get(blob_name)
+        with self.metrics.phase('gcs_metadata'):
+            blob = self._request('gcs_metadata', lambda **kwargs: self.bucket.get_blob(blob_name, **kwargs))
+        if blob is None:
+            cache.invalidate(blob_name)
+            raise _not_found()("{} not found in bucket {}".format(blob_name, self.bucket_name))
+        if cached is not None and cached.generation == blob.generation:
+            cached = cached._replace(checked_at=monotonic())
+            cache.set(blob_name, cached)
+            self.metrics.incr('{}.revalidated'.format(cache.name))
+            return None, cached
+        return blob, None
+
+    def invalidate_connection_cache(self, conn_id: Optional[str] = None):
+        """Drop a cached connection, or all of them when no conn_id is given.
+
+        A loaded connections bundle is always dropped as a whole.
+        """
+        self.bundle_cache.clear()
+        if conn_id is None:
+            self.connections_cache.clear()
+        else:
+            self.connections_cache.invalidate(self._connection_blob_name(conn_id))
+            self.negative_cache.invalidate(self._connection_blob_name(conn_id))
+
+    def invalidate_blob(self, blob_name: str, generation: Optional[int] = None, deleted: bool = False) -> bool:
+        """Drop the cache entry loaded from a blob, e.g. when GCS reports a change to it.
+
+        `generation` is the generation that was written, or deleted when `deleted` is set;
+        notifications may arrive late or twice, so an entry already at the written generation,
+        or at another one than the deleted generation, is kept. With background refreshes on,
+        the dropped entry is reloaded on the refresher thread. Returns whether an entry was dropped.
+        """
+        self.negative_cache.invalidate(blob_name)
+        connections_prefix = "{}/{}/".format(self.root_folder_name, self.connections_folder_name)
+        if blob_name.startswith(connections_prefix):
+            self.connections_index.clear()
+            cache, load = self.connections_cache, self._load_connection
+        elif blob_name == self._variables_blob_name():
+            cache, load = self.variables_cache, self._load_variables
+        elif self.connections_bundle and blob_name == self._bundle_blob_name():
+            cache, load = self.bundle_cache, self._load_bundle
+        else:
+            return False
+        cached = cache.get(blob_name)
+        if cached is None or (generation is not None and (cached.generation == generation) != deleted):
+            return False
+        cache.invalidate(blob_name)
+        self.metrics.incr('{}.invalidated'.format(cache.name))
+        if self.refresher is not None and not deleted:
+            self.refresher.schedule((cache.name, blob_name), lambda: self._refresh(blob_name, cache, load))
+        return True
+
+    def invalidate_variables_cache(self):
+        """Drop the parsed variables file so the next lookup reads it again."""
+        self.variables_cache.clear()
+
+    def _request(self, name: str, fn: Callable):
+        """Send a GCS or KMS request, `fn(**kwargs)`, with the configured timeouts, retries and hedging.
+
+        `fn` must pass the keyword arguments on to the client method, they replace the client
+        library's own timeout settings, and its retries when `max_retries` is set.
+        """
+        if self.request_policy is None:
+            return fn()
+        kwargs = {'retry': None} if self.request_policy.max_retries else {}
+
+        def attempt(timeout):
+            if timeout is None:
+                return fn(**kwargs)
+            return fn(timeout=timeout, **kwargs)
+
+        return self.request_policy.call(name, attempt, getattr(self._deadlines, 'deadline', None))
+
+    @contextlib.contextmanager
+    def _deadline_scope(self, deadline: Optional[float] = None):
+        """Bound the requests of a lookup by `lookup_deadline`, or by the given `deadline`.
+
+        Nested scopes keep the deadline of the outermost lookup.
+        """
+        previous = getattr(self._deadlines, 'deadline', None)
+        if deadline is None and previous is None and self.lookup_deadline:
+            deadline = monotonic() + self.lookup_deadline
+        if deadline is None or previous is not None:
+            yield
+            return
+        self._deadlines.deadline = deadline
+        try:
+            yield
+        finally:
+            self._deadlines.deadline = None
+
+    def _download_blob_to_stream(self, blob):
+        """Downloads the exact generation of a blob whose metadata is already loaded.
+
+        The local disk cache is tried first when configured, and filled on a miss.
+        """
+        if self.disk_cache is not None:
+            cached = self.disk_cache.get(blob.name, blob.generation)
+            if cached is not None:
+                self.metrics.incr('disk_cache.hit')
+                return cached
+            self.metrics.incr('disk_cache.miss')
 
-        blob = bucket.blob(source_blob_name)
-        file_obj = BytesIO()
-        blob.download_to_file(file_obj)
+        def download(**kwargs):
+            file_obj = BytesIO()
+            file_obj.name = blob.name
+            blob.download_to_file(file_obj, if_generation_match=blob.generation, **kwargs)
+            return file_obj
 
+        with self.metrics.phase('gcs_download'):
+            file_obj = self._request('gcs_download', download)
+        self.metrics.incr('bytes_downloaded', file_obj.tell())
+
+        if self.disk_cache is not None:
+            try:
+                self.disk_cache.put(blob.name, blob.generation, file_obj.getvalue())
+            except OSError as e:
+                self.log.warning("Could not write %s to the disk cache: %s", blob.name, e)
         file_obj.seek(0)
         return file_obj
 
-    def _decrypt_stream(self, file_obj: BytesIO, ignore_mac: bool) -> Optional[Dict]:
-        yaml = YAML(typ='safe', pure=True)
-        tree = yaml.load(file_obj)
-        key, tree = self._get_key(tree)
-        _check_rotation_needed(tree)
-        tree = _walk_and_decrypt(tree, key, ignore_mac=ignore_mac)
+    def _download_to_stream(self, source_blob_name):
+        """Downloads the latest generation of a blob; returns the stream and the generation downloaded."""
+        def download(**kwargs):
+            blob = self.bucket.blob(source_blob_name)
+            file_obj = BytesIO()
+            file_obj.name = source_blob_name
+            blob.download_to_file(file_obj, **kwargs)
+            # the client fills in the generation from the download response
+            return file_obj, blob.generation
+
+        with self.metrics.phase('gcs_download'):
+            file_obj, generation = self._request('gcs_download', download)
+        self.metrics.incr('bytes_downloaded', file_obj.tell())
+
+        file_obj.seek(0)
+        return file_obj, generation
+
+    def _decrypt_stream(self, file_obj: BytesIO, ignore_mac: bool,
+                        version: Optional[BlobVersion] = None) -> Optional[Dict]:
+        return self._decrypt_tree(self._parse_stream(file_obj), ignore_mac=ignore_mac, version=version)
+
+    def _parse_stream(self, file_obj: BytesIO):
+        with self.metrics.phase('parse'):
+            return _load_document(file_obj)
+
+    def _decrypt_tree(self, tree, ignore_mac: bool, key: Optional[bytes] = None,
+                      version: Optional[BlobVersion] = None) -> Optional[Dict]:
+        """Decrypt a parsed sops document.
+
+        `version` is the `(blob name, generation)` the document was read from. The key rotation
+        check and the MAC verification run on the first load of a generation only.
+        """
+        if key is None:
+            key, tree = self._get_key(tree)
+        verify_mac = not ignore_mac and not self._check_once(tree, version)
+        digest = hashlib.sha512() if verify_mac else None
+        with self.metrics.phase('decrypt'):
+            tree = _walk_and_decrypt(tree, key, digest=digest, ignore_mac=True)
+        if verify_mac:
+            with self.metrics.phase('mac'):
+                _check_mac(tree, key, digest)
+            if version is not None:
+                self.checked_blobs.set(version, True)
         if tree:
             tree.pop('sops', None)
             return dict(tree)
         return None
 
+    def _check_once(self, tree, version: Optional[BlobVersion]) -> bool:
+        """Check the key rotation of a generation not seen before; return whether its MAC was verified."""
+        checked = self.checked_blobs.get(version) if version is not None else None
+        if checked is not None:
+            self.metrics.incr('checked_blobs.hit')
+            return checked
+        _check_rotation_needed(tree)
+        if version is not None:
+            self.checked_blobs.set(version, False)
+        return False
+
+    def _mac_verified(self, version: Optional[BlobVersion]) -> bool:
+        return version is not None and self.checked_blobs.get(version) is True
+
     def _get_key(self, tree):
         """Obtain a 256 bits symetric key.
 
@@ -128,10 +1034,17 @@ class GcsSopsSecretsBackend(BaseSecretsBackend, LoggingMixin):
         KMS or PGP. Otherwise, generate a new random key.
 
         """
+        if self.race_key_entries:
+            key = self._race_for_key(tree)
+            if key is not None:
+                return key, tree
+            raise AirflowException("could not retrieve a key to encrypt/decrypt the tree")
+
         key = self._get_key_from_kms(tree)
         if not (key is None):
             return key, tree
-        key = _get_key_from_pgp(tree)
+        with self.metrics.phase('pgp_unwrap'):
+            key = _get_key_from_pgp(tree, cache=self.key_cache, max_workers=self.max_workers)
         if not (key is None):
             return key, tree
 
@@ -139,12 +1052,30 @@ class GcsSopsSecretsBackend(BaseSecretsBackend, LoggingMixin):
 
     def _get_key_from_kms(self, tree):
         """Get the key form the KMS tree leave."""
+        errors = []
+        for resource_id, enc in self._kms_entries(tree):
+            try:
+                return self._unwrap_kms_entry(resource_id, enc)
+            except Exception as e:
+                errors.append("kms %s failed with error: %s " % (resource_id, e))
+                continue
+
+        if not errors:
+            return None
+        self.log.warning("WARN: no KMS client could be accessed:")
+        for err in errors:
+            self.log.warning("* %s" % err)
+
+        return None
+
+    def _kms_entries(self, tree) -> List[Tuple[str, str]]:
+        """The `(resource_id, enc)` of the usable gcp_kms entries of a document."""
         try:
             kms_tree = tree['sops']['gcp_kms']
         except KeyError:
-            return None
+            return []
+        entries = []
         i = -1
-        errors = []
         for entry in kms_tree:
             if not entry:
                 continue
@@ -156,22 +1087,115 @@ class GcsSopsSecretsBackend(BaseSecretsBackend, LoggingMixin):
             if 'resource_id' not in entry or entry['resource_id'] == "":
                 self.log.warning("WARN: KMS resource id not found skipping entry %s" % i)
                 continue
+            entries.append((entry['resource_id'], enc))
+        return entries
+
+    def _unwrap_kms_entry(self, resource_id: str, enc: str) -> bytes:
+        """Unwrap the data key of a gcp_kms entry, from the key cache, the key service or KMS."""
+        cache_key = (resource_id, enc)
+        key = self.key_cache.get(cache_key)
+        if key is not None:
+            self.metrics.incr('key_cache.hit')
+            return key
+        return self._shared(('key',) + cache_key, lambda: self._fetch_kms_key(resource_id, enc))
+
+    def _fetch_kms_key(self, resource_id: str, enc: str) -> bytes:
+        cache_key = (resource_id, enc)
+        key = self.key_cache.get(cache_key)
+        if key is not None:
+            # unwrapped by another thread since the cache was read
+            return key
+        self.metrics.incr('key_cache.miss')
+        if self.key_service is not None:
+            with self.metrics.phase('key_service_unwrap'):
+                key = self.key_service.unwrap(resource_id, enc)
+            if key is not None:
+                self.key_cache.set(cache_key, key)
+                return key
+
+        from google.cloud.kms import DecryptRequest
+        request = DecryptRequest(name=resource_id, ciphertext=b64decode(enc))
+        with self.metrics.phase('kms_unwrap'):
+            response = self._request('kms_unwrap', lambda **kwargs: self.kms_client.decrypt(request=request, **kwargs))
+        self.key_cache.set(cache_key, response.plaintext)
+        return response.plaintext
+
+    def _unwrap_pgp_entries(self, tree) -> bytes:
+        with self.metrics.phase('pgp_unwrap'):
+            key = _get_key_from_pgp(tree, cache=self.key_cache, max_workers=self.max_workers)
+        if key is None:
+            raise AirflowException("no pgp entry could be decrypted")
+        return key
+
+    def _race_for_key(self, tree) -> Optional[bytes]:
+        """Unwrap the data key through several key entries at once and return the first key.
+
+        The gcp_kms entries, and the pgp entries as one more candidate, start in order of their
+        recorded health, `key_race_width` at a time; the next one starts whenever one fails.
+        """
+        kms_entries = self._kms_entries(tree)
+        for resource_id, enc in kms_entries:
+            key = self.key_cache.get((resource_id, enc))
+            if key is not None:
+                self.metrics.incr('key_cache.hit')
+                return key
+        candidates = [(resource_id, functools.partial(self._unwrap_kms_entry, resource_id, enc))
+                      for resource_id, enc in kms_entries]
+        if (tree.get('sops') or {}).get('pgp'):
+            candidates.append(('pgp', functools.partial(self._unwrap_pgp_entries, tree)))
+        if not candidates:
+            return None
+        candidates = [candidates[i] for i in self.key_entry_health.rank([name for name, _ in candidates])]
+
+        deadline = getattr(self._deadlines, 'deadline', None)
 
+        def unwrap(name, fn):
+            start = monotonic()
             try:
-                request = DecryptRequest(name=entry['resource_id'], ciphertext=b64decode(enc))
-                response = self.kms_client.decrypt(request=request)
-            except Exception as e:
-                errors.append("kms %s failed with error: %s " % (entry['resource_id'], e))
-                continue
-            return response.plaintext
+                with self._deadline_scope(deadline):
+                    key = fn()
+            except Exception:
+                self.key_entry_health.record(name, failed=True)
+                raise
+            self.key_entry_health.record(name, monotonic() - start)
+            return key
 
-        self.log.warning("WARN: no KMS client could be accessed:")
+        errors = []
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.key_race_width, len(candidates))))
+        futures = {executor.submit(unwrap, name, fn): name for name, fn in candidates}
+        try:
+            for future in as_completed(futures):
+                try:
+                    return future.result()
+                except Exception as e:
+                    errors.append("%s failed with error: %s" % (futures[future], e))
+        finally:
+            # candidates that haven't started are dropped, running ones finish in the background
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        self.log.warning("WARN: no key entry could unwrap the data key:")
         for err in errors:
             self.log.warning("* %s" % err)
-
         return None
 
+    def invalidate_key_cache(self, resource_id: Optional[str] = None, enc: Optional[str] = None):
+        """Drop a cached data key, or all of them when no wrapped key is given."""
+        if resource_id is None or enc is None:
+            self.key_cache.clear()
+        else:
+            self.key_cache.invalidate((resource_id, enc))
+
     def _cleanup(self):
         self.log.debug("closing")
-        self.storage_client.close()
-        self.kms_client.transport.close()
+        if self.notifications is not None and os.getpid() == self._owner_pid:
+            self.notifications.stop()
+        if self.refresher is not None:
+            self.refresher.stop(timeout=1)
+        if self.request_policy is not None:
+            self.request_policy.close()
+        if self._storage_client is not None:
+            self._storage_client.close()
+        if self._kms_client is not None:
+            self._kms_client.transport.close()
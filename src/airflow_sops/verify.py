@@ -0,0 +1,211 @@
+"""Verify every SOPS file under the root folder of the bucket, e.g. as a pre-deploy gate.
+
+    python -m airflow_sops verify --bucket my-composer-bucket --processes 8
+
+Each encrypted file is downloaded, its data key unwrapped and its values decrypted with
+the MAC verified, on a pool of processes each running a pool of threads. The report
+lists the files that failed, the age of their oldest master key and the time spent on
+each file. The exit status is 1 when any file failed.
+
+With `--disk-cache-dir`, the downloaded files are written to the disk cache shared by
+the backends of this node (see the `disk_cache_dir` kwarg), which prewarms it.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+from .helpers import ROTATION_AGE, MacMismatchError, UnknownValueTypeError, _check_mac, _master_key_dates, \
+    _walk_and_decrypt
+
+# outcome of verifying one file
+OK = 'ok'
+DOWNLOAD_ERROR = 'download_error'
+PARSE_ERROR = 'parse_error'
+KEY_ERROR = 'key_error'
+DECRYPT_ERROR = 'decrypt_error'
+MAC_MISMATCH = 'mac_mismatch'
+UNKNOWN_TYPE = 'unknown_type'
+
+# master key entries whose creation date is reported
+KEY_KINDS = ('gcp_kms', 'kms', 'pgp')
+
+FileReport = namedtuple('FileReport', ['name', 'status', 'error', 'key_age_days',
+                                       'download_ms', 'parse_ms', 'key_ms', 'decrypt_ms'])
+
+# the backend of a worker process, see _init_worker
+_worker_backend = None
+
+
+def verify_blob(backend, name: str, generation=None, now: Optional[datetime] = None) -> FileReport:
+    """Download, unwrap and decrypt one blob with MAC verification; never raises."""
+    timings = {'download_ms': None, 'parse_ms': None, 'key_ms': None, 'decrypt_ms': None}
+    key_age_days = None
+    phase = 'download_ms'
+    status, error = DOWNLOAD_ERROR, None
+    start = perf_counter()
+    try:
+        stream = backend._download_blob_to_stream(backend.bucket.blob(name, generation=generation))
+        timings[phase] = _elapsed_ms(start)
+
+        phase, status, start = 'parse_ms', PARSE_ERROR, perf_counter()
+        tree = backend._parse_stream(stream)
+        dates = _master_key_dates(tree, kinds=KEY_KINDS)
+        if dates:
+            key_age_days = ((now or datetime.utcnow()) - min(dates)).days
+        timings[phase] = _elapsed_ms(start)
+
+        phase, status, start = 'key_ms', KEY_ERROR, perf_counter()
+        key, tree = backend._get_key(tree)
+        timings[phase] = _elapsed_ms(start)
+
+        phase, status, start = 'decrypt_ms', DECRYPT_ERROR, perf_counter()
+        digest = hashlib.sha512()
+        tree = _walk_and_decrypt(tree, key, digest=digest, ignore_mac=True)
+        # a document whose MAC can't be decrypted was tampered with as surely as one whose MAC differs
+        status = MAC_MISMATCH
+        _check_mac(tree, key, digest)
+        timings[phase] = _elapsed_ms(start)
+        status = OK
+    except UnknownValueTypeError as e:
+        status, error = UNKNOWN_TYPE, e
+    except MacMismatchError as e:
+        status, error = MAC_MISMATCH, e
+    except Exception as e:
+        error = e
+    if status != OK:
+        timings[phase] = _elapsed_ms(start)
+    return FileReport(name, status, _describe(error), key_age_days, **timings)
+
+
+def verify_blobs(backend, blobs: List[Tuple[str, object]]) -> List[FileReport]:
+    """Verify `(name, generation)` blobs on the thread pool of `backend`."""
+    now = datetime.utcnow()
+    return backend._map_concurrently(lambda blob: verify_blob(backend, blob[0], blob[1], now), blobs)
+
+
+def list_encrypted_blobs(backend) -> List[Tuple[str, object]]:
+    """The `(name, generation)` of the encrypted files under the root folder, in name order."""
+    suffix = ".{}".format(backend.file_ext)
+    blobs = backend.storage_client.list_blobs(backend.bucket_name, prefix=backend.root_folder_name + '/')
+    return sorted((blob.name, blob.generation) for blob in blobs if blob.name.endswith(suffix))
+
+
+def _init_worker(backend_kwargs: Dict):
+    global _worker_backend
+    from .secrets_backend import GcsSopsSecretsBackend
+    _worker_backend = GcsSopsSecretsBackend(**backend_kwargs)
+
+
+def _verify_chunk(blobs: List[Tuple[str, object]]) -> List[FileReport]:
+    return verify_blobs(_worker_backend, blobs)
+
+
+def verify(backend_kwargs: Dict, processes: int = 1, backend=None) -> List[FileReport]:
+    """Verify every encrypted file under the root folder of a backend built from `backend_kwargs`.
+
+    With several `processes`, each worker process builds its own backend, so the data
+    keys are unwrapped once per process. `backend` lists the files, and verifies them
+    when running in a single process.
+    """
+    if backend is None:
+        _init_worker(backend_kwargs)
+        backend = _worker_backend
+    blobs = list_encrypted_blobs(backend)
+    if processes <= 1 or len(blobs) <= 1:
+        return verify_blobs(backend, blobs)
+
+    # a few chunks per process, so a slow chunk doesn't hold the others back
+    chunk_size = max(1, -(-len(blobs) // (processes * 4)))
+    chunks = [blobs[i:i + chunk_size] for i in range(0, len(blobs), chunk_size)]
+    with ProcessPoolExecutor(max_workers=min(processes, len(chunks)), initializer=_init_worker,
+                             initargs=(backend_kwargs,)) as executor:
+        return [report for reports in executor.map(_verify_chunk, chunks) for report in reports]
+
+
+def _elapsed_ms(start: float) -> float:
+    return round((perf_counter() - start) * 1e3, 3)
+
+
+def _describe(error: Optional[Exception]) -> Optional[str]:
+    if error is None:
+        return None
+    message = str(error).splitlines()[0] if str(error) else ''
+    return "{}: {}".format(type(error).__name__, message) if message else type(error).__name__
+
+
+def _format_ms(ms: Optional[float]) -> str:
+    return '-' if ms is None else "{:.1f}".format(ms)
+
+
+def print_report(reports: List[FileReport], elapsed: float, max_key_age_days: int, stream=None):
+    stream = stream or sys.stdout
+    print("{:<15} {:>9} {:>9} {:>9} {:>9} {:>8}  {}".format('status', 'download', 'parse', 'key', 'decrypt',
+                                                           'key age', 'file'), file=stream)
+    for report in reports:
+        key_age = '-' if report.key_age_days is None else "{}d".format(report.key_age_days)
+        if report.key_age_days is not None and report.key_age_days > max_key_age_days:
+            key_age += '!'
+        print("{:<15} {:>9} {:>9} {:>9} {:>9} {:>8}  {}".format(
+            report.status, _format_ms(report.download_ms), _format_ms(report.parse_ms), _format_ms(report.key_ms),
+            _format_ms(report.decrypt_ms), key_age, report.name), file=stream)
+        if report.error:
+            print("    {}".format(report.error), file=stream)
+    print(_summary(reports, elapsed, max_key_age_days), file=stream)
+
+
+def _summary(reports: List[FileReport], elapsed: float, max_key_age_days: int) -> str:
+    failed = sum(1 for report in reports if report.status != OK)
+    rotation_due = sum(1 for report in reports
+                       if report.key_age_days is not None and report.key_age_days > max_key_age_days)
+    return "Verified {} files in {:.2f}s: {} ok, {} failed, {} with master keys older than {} days".format(
+        len(reports), elapsed, len(reports) - failed, failed, rotation_due, max_key_age_days)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m airflow_sops verify',
+                                     description="Decrypt every SOPS file in the bucket and verify its MAC.")
+    parser.add_argument('--bucket', default=os.environ.get('GCS_BUCKET'),
+                        help='bucket holding the sops files, $GCS_BUCKET by default')
+    parser.add_argument('--project-id', default=None)
+    parser.add_argument('--root-folder', default='sops', help='folder holding the sops files')
+    parser.add_argument('--encrypted-file-ext', default='enc')
+    parser.add_argument('--file-format', choices=('yaml', 'json'), default='yaml')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=8, help='concurrent files per process')
+    parser.add_argument('--disk-cache-dir', default=None, help='disk cache to prewarm with the downloaded files')
+    parser.add_argument('--max-key-age-days', type=int, default=ROTATION_AGE.days,
+                        help='flag master keys older than this')
+    parser.add_argument('--fail-on-key-age', action='store_true',
+                        help='exit with status 1 when a master key is older than --max-key-age-days')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+    if not args.bucket:
+        parser.error("--bucket is required when $GCS_BUCKET is not set")
+
+    backend_kwargs = dict(project_id=args.project_id, bucket_name=args.bucket, root_folder_name=args.root_folder,
+                          encrypted_file_ext=args.encrypted_file_ext, file_format=args.file_format,
+                          ignore_mac=False, max_workers=args.threads, disk_cache_dir=args.disk_cache_dir,
+                          connections_index_ttl=None, metrics=False)
+    start = perf_counter()
+    reports = verify(backend_kwargs, processes=args.processes)
+    elapsed = perf_counter() - start
+
+    if args.json:
+        json.dump({'files': [report._asdict() for report in reports],
+                   'summary': _summary(reports, elapsed, args.max_key_age_days)}, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(reports, elapsed, args.max_key_age_days)
+
+    failed = any(report.status != OK for report in reports)
+    if args.fail_on_key_age:
+        failed = failed or any(report.key_age_days is not None and report.key_age_days > args.max_key_age_days
+                               for report in reports)
+    return 1 if failed else 0
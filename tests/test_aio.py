@@ -0,0 +1,192 @@
+import asyncio
+import os
+import stat
+import tempfile
+import threading
+import unittest
+from io import StringIO
+from unittest import mock
+
+from airflow_sops.bundle import build_bundle, dump_bundle
+from airflow_sops.helpers import _LazyDecryptedTree, _walk_and_encrypt
+from airflow_sops.secrets_backend import GcsSopsSecretsBackend
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+RESOURCE_ID = 'projects/p/locations/l/keyRings/r/cryptoKeys/k'
+
+
+def _encrypted(document, key) -> bytes:
+    document = dict(document, sops={'gcp_kms': [{'resource_id': RESOURCE_ID, 'enc': 'd3JhcHBlZA=='}]})
+    stream = StringIO()
+    dump_bundle(_walk_and_encrypt(document, key), stream)
+    return stream.getvalue().encode('utf-8')
+
+
+@unittest.skipIf(web is None, "needs aiohttp")
+class TestAsyncLookups(unittest.IsolatedAsyncioTestCase):
+    """Async lookups against a local server speaking the GCS JSON API."""
+
+    async def asyncSetUp(self):
+        self.key = os.urandom(32)
+        self.objects = {}
+        self.downloads = []
+        app = web.Application()
+        app.router.add_get('/storage/v1/b/{bucket}/o/{name:.+}', self._media)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        self.backend = GcsSopsSecretsBackend(bucket_name='bucket', connections_index_ttl=None, metrics=False)
+        # anonymous requests, as to an emulator
+        self.backend._credentials_loaded = True
+        self.kms_calls = 0
+        kms_client = mock.Mock()
+        kms_client.decrypt = self._kms_decrypt
+        kms_client.transport.close = mock.AsyncMock()
+        with mock.patch.dict(os.environ, {'STORAGE_EMULATOR_HOST': 'http://127.0.0.1:{}'.format(port)}):
+            self.lookups = self.backend._get_async_lookups()
+        self.lookups.kms_client = kms_client
+
+    async def asyncTearDown(self):
+        await self.backend.aclose()
+        await self.runner.cleanup()
+
+    async def _media(self, request):
+        name = request.match_info['name']
+        self.downloads.append(name)
+        # let concurrent lookups pile up
+        await asyncio.sleep(0.01)
+        if name not in self.objects:
+            return web.Response(status=404)
+        generation, data = self.objects[name]
+        if request.query.get('ifGenerationNotMatch') == str(generation):
+            return web.Response(status=304)
+        return web.Response(body=data, headers={'x-goog-generation': str(generation)})
+
+    async def _kms_decrypt(self, request=None, **kwargs):
+        self.kms_calls += 1
+        await asyncio.sleep(0.01)
+        return mock.Mock(plaintext=self.key)
+
+    def _upload(self, name, data, generation=1):
+        self.objects[name] = (generation, data)
+
+    async def test_concurrent_lookups_share_downloads_and_unwraps(self):
+        self._upload('sops/connections/db.enc.yaml', _encrypted({'conn_type': 'postgres', 'host': 'db'}, self.key))
+        self._upload('sops/connections/api.enc.yaml', _encrypted({'conn_type': 'http', 'host': 'api'}, self.key))
+
+        connections = await asyncio.gather(*[self.backend.aget_connection(conn_id)
+                                             for conn_id in ['db', 'api'] * 5])
+
+        self.assertEqual(['db', 'api'] * 5, [connection.host for connection in connections])
+        self.assertEqual(2, len(self.downloads))
+        self.assertEqual(1, self.kms_calls)
+        # the sync lookups share the cache
+        self.assertEqual('db', self.backend.get_connection('db').host)
+
+    async def test_expired_entry_is_revalidated(self):
+        self.backend.connections_cache_ttl = 0
+        self._upload('sops/connections/db.enc.yaml', _encrypted({'conn_type': 'postgres', 'host': 'db'}, self.key))
+        self.assertEqual('db', (await self.backend.aget_connection('db')).host)
+        with mock.patch.object(self.backend, '_load_connection_tree') as load:
+            self.assertEqual('db', (await self.backend.aget_connection('db')).host)
+        load.assert_not_called()
+
+        self._upload('sops/connections/db.enc.yaml', _encrypted({'conn_type': 'postgres', 'host': 'db2'}, self.key),
+                     generation=2)
+        self.assertEqual('db2', (await self.backend.aget_connection('db')).host)
+        self.assertEqual(3, len(self.downloads))
+
+    async def test_missing_connection(self):
+        self.assertIsNone(await self.backend.aget_connection('nope'))
+        self.assertIsNone(await self.backend.aget_connection('nope'))
+        self.assertEqual(1, len(self.downloads))
+
+    async def test_variables(self):
+        self._upload('sops/variables.yaml', b'greeting: hello\n')
+        self.assertEqual('hello', await self.backend.aget_variable('greeting'))
+        self.assertIsNone(await self.backend.aget_variable('missing'))
+        self.assertEqual(1, len(self.downloads))
+
+    def _record_decrypting_threads(self):
+        threads = []
+        get = _LazyDecryptedTree.get
+
+        def recorded(tree, *args):
+            threads.append(threading.current_thread())
+            return get(tree, *args)
+
+        patcher = mock.patch.object(_LazyDecryptedTree, 'get', recorded)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return threads
+
+    async def test_encrypted_variables(self):
+        self.backend.variables_encrypted = True
+        self._upload('sops/variables.enc.yaml', _encrypted({'greeting': 'hello'}, self.key))
+        threads = self._record_decrypting_threads()
+        self.assertEqual('hello', await self.backend.aget_variable('greeting'))
+        self.assertIsNone(await self.backend.aget_variable('missing'))
+        # lazy values are decrypted on the executor, not on the loop
+        self.assertNotIn(threading.current_thread(), threads)
+
+    async def test_bundle(self):
+        self.backend.connections_bundle = 'connections'
+        stream = StringIO()
+        dump_bundle(build_bundle({'db': {'conn_type': 'postgres', 'host': 'db'}}, self.key,
+                                 kms_entries=[{'resource_id': RESOURCE_ID, 'enc': 'd3JhcHBlZA=='}]), stream)
+        self._upload('sops/connections.enc.yaml', stream.getvalue().encode('utf-8'))
+        threads = self._record_decrypting_threads()
+        self.assertEqual('db', (await self.backend.aget_connection('db')).host)
+        self.assertIsNone(await self.backend.aget_connection('missing'))
+        self.assertEqual(1, len(self.downloads))
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    async def test_lookup_deadline(self):
+        self.backend.lookup_deadline = 0.001
+        self._upload('sops/connections/db.enc.yaml', _encrypted({'conn_type': 'postgres', 'host': 'db'}, self.key))
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.backend.aget_connection('db')
+        # the lookup that timed out leaves its download running for the next one
+        self.backend.lookup_deadline = None
+        self.assertEqual('db', (await self.backend.aget_connection('db')).host)
+        self.assertEqual(1, len(self.downloads))
+
+    async def test_key_file_credentials_are_scoped(self):
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials(mock.Mock(), 'sa@p.iam.gserviceaccount.com',
+                                                  'https://oauth2.googleapis.com/token')
+        refreshed = []
+
+        def refresh(creds, request):
+            refreshed.append(creds.scopes)
+            creds.token = 'token'
+
+        self.backend.credentials = credentials
+        with mock.patch.object(service_account.Credentials, 'refresh', refresh):
+            self.assertEqual({'Authorization': 'Bearer token'}, await self.lookups._auth_headers())
+            self.assertEqual({'Authorization': 'Bearer token'}, await self.lookups._auth_headers())
+        self.assertEqual([['https://www.googleapis.com/auth/devstorage.read_only']], [list(s) for s in refreshed])
+
+    async def test_pgp_entries_run_as_subprocesses(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a gpg stand-in that prints the "decrypted" key it was sent
+            gpg = os.path.join(tmp_dir, 'gpg')
+            with open(gpg, 'w') as f:
+                f.write('#!/bin/sh\ncat\n')
+            os.chmod(gpg, os.stat(gpg).st_mode | stat.S_IEXEC)
+            tree = {'sops': {'pgp': [{'fp': 'short', 'enc': 'too short'}, {'fp': 'good', 'enc': 'k' * 32}]}}
+            with mock.patch('airflow_sops.helpers.GPG_EXEC', gpg):
+                self.assertEqual(b'k' * 32, await self.lookups.unwrap(tree))
+        self.assertEqual(b'k' * 32, self.backend.key_cache.get(('pgp', 'good', 'k' * 32)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from airflow_sops.bundle import BUNDLE_INDEX_KEY, build_bundle, bundle_index, main
+from airflow_sops.helpers import _check_mac, _walk_and_decrypt
+
+RESOURCE_ID = 'projects/p/locations/l/keyRings/r/cryptoKeys/k'
+
+
+class TestBuildBundle(unittest.TestCase):
+
+    def test_round_trip(self):
+        key = os.urandom(32)
+        connections = {'db': {'conn_type': 'postgres', 'port': 5432}, 'sops': {'conn_type': 'http'},
+                       'tricky_unencrypted': {'password': 'secret'}}
+        tree = build_bundle(connections, key, kms_entries=[{'resource_id': RESOURCE_ID, 'enc': 'd3JhcHBlZA=='}])
+
+        index = bundle_index(tree)
+        self.assertEqual(['db', 'sops', 'tricky_unencrypted'], sorted(index))
+        self.assertEqual('db', index['db'])
+        self.assertNotIn(index['sops'], ('sops', BUNDLE_INDEX_KEY))
+        self.assertTrue(tree[index['tricky_unencrypted']]['password'].startswith('ENC['))
+        self.assertTrue(tree['db']['conn_type'].startswith('ENC['))
+
+        digest = hashlib.sha512()
+        decrypted = _walk_and_decrypt(tree, key, digest=digest, ignore_mac=True)
+        _check_mac(decrypted, key, digest)
+        self.assertEqual({'conn_type': 'postgres', 'port': 5432}, decrypted['db'])
+        self.assertEqual({'password': 'secret'}, decrypted[index['tricky_unencrypted']])
+
+    def test_main_writes_bundle(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'db.yaml')
+            with open(source, 'w') as f:
+                f.write('conn_type: postgres\nhost: db.internal\n')
+            output = os.path.join(tmp_dir, 'connections.enc.json')
+            kms = mock.Mock()
+            kms.encrypt.return_value = mock.Mock(ciphertext=b'wrapped')
+            with mock.patch('google.cloud.kms.KeyManagementServiceClient', return_value=kms):
+                main(['--kms-key', RESOURCE_ID, '--output', output, source])
+
+            with open(output) as f:
+                content = f.read()
+        self.assertIn('"index_unencrypted"', content)
+        self.assertIn(RESOURCE_ID, content)
+        self.assertNotIn('db.internal', content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from airflow_sops.cache import TTLCache
+
+
+class FakeTimer:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_expires_after_ttl(self):
+        timer = FakeTimer()
+        cache = TTLCache(max_size=2, ttl=10, timer=timer)
+        cache.set("a", 1)
+        self.assertEqual(1, cache.get("a"))
+        timer.now = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, len(cache))
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_invalidate(self):
+        cache = TTLCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.invalidate("a")
+        self.assertNotIn("a", cache)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+    def test_zero_size_disables_cache(self):
+        cache = TTLCache(max_size=0)
+        cache.set("a", 1)
+        self.assertNotIn("a", cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+from airflow_sops.disk_cache import DiskBlobCache
+
+
+class TestDiskBlobCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = DiskBlobCache(os.path.join(self.tmp_dir.name, "cache"), max_bytes=10)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_matches_generation(self):
+        self.assertIsNone(self.cache.get("sops/connections/a.enc.yaml", 1))
+        self.cache.put("sops/connections/a.enc.yaml", 1, b"abc")
+        self.assertEqual(b"abc", self.cache.get("sops/connections/a.enc.yaml", 1).read())
+        self.assertIsNone(self.cache.get("sops/connections/a.enc.yaml", 2))
+
+    def test_new_generation_replaces_old(self):
+        self.cache.put("a", 1, b"abc")
+        self.cache.put("a", 2, b"abcd")
+        self.assertIsNone(self.cache.get("a", 1))
+        self.assertEqual(b"abcd", self.cache.get("a", 2).read())
+        self.assertEqual(1, len(self.cache))
+
+    def test_evicts_least_recently_read(self):
+        self.cache.put("a", 1, b"aaaa")
+        self.cache.put("b", 1, b"bbbb")
+        os.utime(self.cache._path("a", 1), (0, 0))
+        self.cache.put("c", 1, b"cccc")
+        self.assertIsNone(self.cache.get("a", 1))
+        self.assertIsNotNone(self.cache.get("b", 1))
+        self.assertLessEqual(self.cache.size(), 10)
+
+    def test_empty_blob_and_invalidate(self):
+        self.cache.put("a", 1, b"")
+        self.assertEqual(b"", self.cache.get("a", 1).read())
+        self.cache.invalidate("a")
+        self.assertIsNone(self.cache.get("a", 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
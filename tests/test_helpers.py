@@ -0,0 +1,113 @@
+import json
+import os
+import unittest
+from io import BytesIO
+from unittest import mock
+
+from airflow.exceptions import AirflowException
+from airflow_sops.cache import TTLCache
+from airflow_sops.helpers import _decrypt, _encrypt, _walk_and_decrypt, _walk_and_encrypt, _LazyDecryptedTree, \
+    _load_document, _get_key_from_pgp
+
+
+def _document():
+    return {
+        'conn_type': 'google_cloud_platform',
+        'port': 5432,
+        'extra': {'keyfile_dict': '{"type": "service_account"}', 'scopes': ['a', 'b'], 'retries': 3.5},
+        'description_unencrypted': 'kept in clear',
+        'enabled': True,
+        'sops': {'gcp_kms': []},
+    }
+
+
+class TestDecrypt(unittest.TestCase):
+
+    def setUp(self):
+        self.key = os.urandom(32)
+
+    def test_value_round_trip(self):
+        for value in ('text', 42, 1.5, True, False, b'\x00\xff'):
+            self.assertEqual(value, _decrypt(_encrypt(value, self.key, aad=b'k:'), self.key, aad=b'k:'))
+
+    def test_plain_values_are_returned_as_is(self):
+        self.assertEqual('plain', _decrypt('plain', self.key))
+        self.assertEqual(5, _decrypt(5, self.key))
+
+    def test_tree_round_trip_with_mac(self):
+        tree = _walk_and_encrypt(_document(), self.key)
+        self.assertTrue(tree['conn_type'].startswith('ENC[AES256_GCM,'))
+        self.assertEqual('kept in clear', tree['description_unencrypted'])
+
+        decrypted = _walk_and_decrypt(tree, self.key, ignore_mac=False)
+        decrypted.pop('sops')
+        expected = _document()
+        expected.pop('sops')
+        self.assertEqual(expected, decrypted)
+
+    def test_key_is_not_kept_after_the_walk(self):
+        tree = _walk_and_encrypt(_document(), self.key)
+        with mock.patch('cryptography.hazmat.primitives.ciphers.aead.AESGCM') as aesgcm:
+            aesgcm.return_value.decrypt.return_value = b'1'
+            _walk_and_decrypt(dict(tree), self.key, ignore_mac=True)
+            _walk_and_decrypt(dict(tree), self.key, ignore_mac=True)
+        # one primitive per walk, however many leaves, and none cached across walks
+        self.assertEqual([mock.call(self.key)] * 2, aesgcm.call_args_list)
+
+    def test_mac_mismatch(self):
+        tree = _walk_and_encrypt(_document(), self.key)
+        tree['conn_type'] = _encrypt('tampered', self.key, aad=b'conn_type:')
+        with self.assertRaises(AirflowException):
+            _walk_and_decrypt(tree, self.key, ignore_mac=False)
+
+
+class TestLazyDecryptedTree(unittest.TestCase):
+
+    def test_decrypts_requested_keys_only(self):
+        key = os.urandom(32)
+        tree = _LazyDecryptedTree(_walk_and_encrypt(_document(), key), key)
+        self.assertEqual(5, len(tree))
+        self.assertNotIn('sops', tree)
+        self.assertEqual(['a', 'b'], tree.get('extra')['scopes'])
+        self.assertEqual(5432, tree['port'])
+        self.assertIsNone(tree.get('missing'))
+        self.assertEqual(['extra', 'port'], sorted(tree._decrypted))
+
+
+class TestLoadDocument(unittest.TestCase):
+
+    def test_formats(self):
+        expected = {'a': {'b': [1, 'c']}}
+        json_stream = BytesIO(json.dumps(expected).encode('utf-8'))
+        self.assertEqual(expected, _load_document(json_stream, name='conn.enc.json'))
+        self.assertEqual(expected, _load_document(BytesIO(json.dumps(expected).encode('utf-8'))))
+        self.assertEqual(expected, _load_document(BytesIO(b'a:\n  b:\n  - 1\n  - c\n'), name='conn.enc.yaml'))
+        self.assertEqual(expected, _load_document(BytesIO(b'{a: {b: [1, c]}}')))
+
+
+class TestGetKeyFromPgp(unittest.TestCase):
+
+    TREE = {'sops': {'pgp': [{'fp': 'AAAA', 'enc': 'broken'}, {'fp': 'BBBB', 'enc': 'good'}]}}
+
+    @staticmethod
+    def _gpg(gpg_exec, enc):
+        if enc == 'broken':
+            raise OSError("no secret key")
+        return b'k' * 32
+
+    def test_first_working_entry_is_cached(self):
+        cache = TTLCache()
+        with mock.patch('airflow_sops.helpers._gpg_decrypt', side_effect=self._gpg) as gpg:
+            self.assertEqual(b'k' * 32, _get_key_from_pgp(self.TREE, cache=cache))
+            self.assertEqual(b'k' * 32, _get_key_from_pgp(self.TREE, cache=cache))
+        self.assertEqual(2, gpg.call_count)
+        self.assertIn(('pgp', 'BBBB', 'good'), cache)
+
+    def test_no_working_entry(self):
+        with mock.patch('airflow_sops.helpers._gpg_decrypt', return_value=b''):
+            self.assertIsNone(_get_key_from_pgp(self.TREE))
+        self.assertIsNone(_get_key_from_pgp({'sops': {}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from airflow_sops.keyservice import KeyServiceClient, KeyServiceServer
+
+RESOURCE_ID = 'projects/p/locations/l/keyRings/r/cryptoKeys/k'
+
+
+class FakeKms:
+
+    def __init__(self):
+        self.calls = 0
+
+    def decrypt(self, request):
+        self.calls += 1
+        if request.name != RESOURCE_ID:
+            raise PermissionError("denied")
+        return mock.Mock(plaintext=b'k' * 32)
+
+
+class TestKeyService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmp_dir.name, 'keyservice.sock')
+        self.kms = FakeKms()
+        self.server = KeyServiceServer(self.socket_path, kms_client=self.kms)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def test_unwraps_once_for_all_clients(self):
+        for _ in range(3):
+            self.assertEqual(b'k' * 32, KeyServiceClient(self.socket_path).unwrap(RESOURCE_ID, 'd3JhcHBlZA=='))
+        self.assertEqual(1, self.kms.calls)
+        self.assertEqual(0o600, os.stat(self.socket_path).st_mode & 0o777)
+
+    def test_errors_return_none(self):
+        self.assertIsNone(KeyServiceClient(self.socket_path).unwrap('other', 'd3JhcHBlZA=='))
+        self.assertIsNone(KeyServiceClient(self.socket_path + '.missing').unwrap(RESOURCE_ID, 'd3JhcHBlZA=='))
+
+
+if __name__ == '__main__':
+    unittest.main()
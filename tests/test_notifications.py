@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+from airflow_sops.cache import CachedBlob
+from airflow_sops.notifications import InvalidationListener
+from airflow_sops.secrets_backend import GcsSopsSecretsBackend
+
+CONN_BLOB = 'sops/connections/http_conn.enc.yaml'
+
+
+class FakeSubscriber:
+    """Delivers published messages to the callback of the subscription, on the caller's thread."""
+
+    def __init__(self):
+        self.callbacks = {}
+        self.subscriptions = {}
+
+    def create_subscription(self, request):
+        self.subscriptions[request['name']] = request
+
+    def delete_subscription(self, request):
+        del self.subscriptions[request['subscription']]
+
+    def subscribe(self, subscription, callback):
+        self.callbacks[subscription] = callback
+        return mock.Mock()
+
+    def publish(self, subscription, **attributes):
+        message = mock.Mock(attributes=attributes)
+        self.callbacks[subscription](message)
+        return message
+
+
+def _attributes(object_id=CONN_BLOB, generation=2, event_type='OBJECT_FINALIZE', bucket='bucket'):
+    return {'eventType': event_type, 'bucketId': bucket, 'objectId': object_id,
+            'objectGeneration': str(generation), 'payloadFormat': 'JSON_API_V1'}
+
+
+class TestInvalidationListener(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = GcsSopsSecretsBackend(bucket_name='bucket', connections_index_ttl=None)
+        self.backend.storage_client = mock.MagicMock()
+        self.backend.kms_client = mock.MagicMock()
+        self.backend.connections_cache.set(CONN_BLOB, CachedBlob(1, {'host': 'old'}, time.monotonic()))
+        self.subscriber = FakeSubscriber()
+        self.listener = InvalidationListener(self.backend, 'projects/p/subscriptions/s', self.subscriber).start()
+
+    def test_new_generation_evicts_entry(self):
+        message = self.subscriber.publish('projects/p/subscriptions/s', **_attributes())
+        message.ack.assert_called_once_with()
+        self.assertIsNone(self.backend.connections_cache.get(CONN_BLOB))
+
+    def test_cached_generation_is_kept(self):
+        self.assertFalse(self.listener.handle(_attributes(generation=1)))
+        self.assertIsNotNone(self.backend.connections_cache.get(CONN_BLOB))
+
+    def test_delete_of_cached_generation_evicts_entry(self):
+        self.assertFalse(self.listener.handle(_attributes(generation=0, event_type='OBJECT_DELETE')))
+        self.assertTrue(self.listener.handle(_attributes(generation=1, event_type='OBJECT_DELETE')))
+        self.assertIsNone(self.backend.connections_cache.get(CONN_BLOB))
+
+    def test_unrelated_objects_are_ignored(self):
+        self.assertFalse(self.listener.handle(_attributes(bucket='other')))
+        self.assertFalse(self.listener.handle(_attributes(object_id='dags/dag.py')))
+        self.assertFalse(self.listener.handle(_attributes(event_type='OBJECT_METADATA_UPDATE')))
+        self.assertIsNotNone(self.backend.connections_cache.get(CONN_BLOB))
+
+    def test_variables_entry_is_evicted(self):
+        self.backend.variables_cache.set('sops/variables.yaml', CachedBlob(1, {'a': '1'}, time.monotonic()))
+        self.listener.handle(_attributes(object_id='sops/variables.yaml'))
+        self.assertIsNone(self.backend.variables_cache.get('sops/variables.yaml'))
+
+    def test_malformed_message_is_acked(self):
+        message = self.subscriber.publish('projects/p/subscriptions/s', eventType='OBJECT_FINALIZE')
+        message.ack.assert_called_once_with()
+
+    def test_changed_entry_is_reloaded_in_background(self):
+        backend = GcsSopsSecretsBackend(bucket_name='bucket', connections_index_ttl=None, refresh_ahead=10)
+        self.addCleanup(backend._cleanup)
+        backend.storage_client = mock.MagicMock()
+        bucket = backend.storage_client.bucket.return_value
+        bucket.get_blob.return_value = bucket.blob.return_value = mock.Mock(generation=2)
+        reloaded = threading.Event()
+        backend._decrypt_stream = mock.Mock(side_effect=lambda *args, **kwargs: reloaded.set() or {'host': 'new'})
+        backend.connections_cache.set(CONN_BLOB, CachedBlob(1, {'host': 'old'}, time.monotonic()))
+
+        InvalidationListener(backend, 's', FakeSubscriber()).handle(_attributes())
+        self.assertTrue(reloaded.wait(5))
+        deadline = time.monotonic() + 5
+        while backend.connections_cache.get(CONN_BLOB) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, backend.connections_cache.get(CONN_BLOB).generation)
+
+
+class TestPerProcessSubscription(unittest.TestCase):
+
+    def setUp(self):
+        self.subscriber = FakeSubscriber()
+        listener = mock.patch('airflow_sops.notifications.InvalidationListener',
+                              side_effect=lambda *args, **kwargs: InvalidationListener(*args, subscriber=self.subscriber,
+                                                                                       **kwargs))
+        listener.start()
+        self.addCleanup(listener.stop)
+
+    def _backend(self, argv=('/usr/local/bin/airflow', 'scheduler')):
+        with mock.patch('sys.argv', list(argv)):
+            backend = GcsSopsSecretsBackend(bucket_name='bucket', connections_index_ttl=None,
+                                            notifications_topic='projects/p/topics/sops-changes')
+        self.addCleanup(backend._cleanup)
+        backend.storage_client = mock.MagicMock()
+        blob = backend.storage_client.bucket.return_value.blob.return_value
+        blob.generation = 1
+        blob.download_to_file.side_effect = lambda file_obj, **kwargs: file_obj.write(b'a: "1"\n')
+        return backend
+
+    def _lookup(self, backend):
+        self.assertEqual('1', backend.get_variable('a'))
+        if backend._listener_thread is not None:
+            backend._listener_thread.join(5)
+
+    def test_subscription_is_created_off_the_lookup_path_and_deleted_on_shutdown(self):
+        backend = self._backend()
+        self.assertEqual({}, self.subscriber.subscriptions)
+        started = threading.Event()
+        create = self.subscriber.create_subscription
+        self.subscriber.create_subscription = lambda request: started.wait(5) and create(request)
+        # the lookup doesn't wait for the subscription
+        self.assertEqual('1', backend.get_variable('a'))
+        self.assertEqual({}, self.subscriber.subscriptions)
+        started.set()
+        backend._listener_thread.join(5)
+        self._lookup(backend)
+
+        [(name, request)] = self.subscriber.subscriptions.items()
+        self.assertTrue(name.startswith('projects/p/subscriptions/sops-changes-'))
+        self.assertIn('-{}-'.format(os.getpid()), name)
+        self.assertEqual('projects/p/topics/sops-changes', request['topic'])
+        self.assertEqual({'ttl': {'seconds': 24 * 3600}}, request['expiration_policy'])
+        self.assertIn(name, self.subscriber.callbacks)
+
+        backend._cleanup()
+        self.assertEqual({}, self.subscriber.subscriptions)
+
+    def test_notifications_reach_the_process(self):
+        backend = self._backend()
+        self._lookup(backend)
+        [name] = self.subscriber.subscriptions
+        self.subscriber.publish(name, **_attributes(object_id='sops/variables.yaml'))
+        self.assertIsNone(backend.variables_cache.get('sops/variables.yaml'))
+
+    def test_task_processes_do_not_listen(self):
+        for argv in (['/usr/local/bin/airflow', 'tasks', 'run', 'dag', 'task'], ['python', 'script.py']):
+            self._lookup(self._backend(argv))
+        self.assertEqual({}, self.subscriber.subscriptions)
+
+    def test_forked_processes_do_not_listen(self):
+        backend = self._backend()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self._lookup(backend)
+            backend._cleanup()
+        self.assertEqual({}, self.subscriber.subscriptions)
+
+    def test_listener_needs_a_subscription_or_topic(self):
+        with self.assertRaises(ValueError):
+            InvalidationListener(mock.Mock())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+from airflow.models.connection import Connection
+
+from airflow_sops.records import ConnectionRecord
+
+FIELDS = {'conn_type': 'postgres', 'host': 'db.internal', 'login': 'user', 'password': 'secret', 'port': 5432,
+          'schema': 'public', 'extra': '{"sslmode": "require"}'}
+
+
+class TestConnectionRecord(unittest.TestCase):
+
+    def test_empty_connection_has_no_record(self):
+        self.assertIsNone(ConnectionRecord.from_dict({}))
+        self.assertIsNone(ConnectionRecord.from_dict(None))
+
+    def test_immutable(self):
+        record = ConnectionRecord(FIELDS)
+        with self.assertRaises(AttributeError):
+            record.password = 'changed'
+        with self.assertRaises(AttributeError):
+            record.anything = 1
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_to_connection_builds_a_new_connection(self):
+        record = ConnectionRecord(FIELDS)
+        first = record.to_connection('db')
+        self.assertEqual('db', first.conn_id)
+        self.assertEqual('secret', first.password)
+        self.assertEqual({'sslmode': 'require'}, first.extra_dejson)
+        self.assertIsNot(first, record.to_connection('db'))
+
+    def test_uri_is_built_once(self):
+        record = ConnectionRecord(FIELDS)
+        expected = Connection(conn_id='db', **FIELDS).get_uri()
+        with mock.patch.object(Connection, 'get_uri', autospec=True, return_value=expected) as get_uri:
+            self.assertEqual(expected, record.uri)
+            self.assertEqual(expected, record.uri)
+        get_uri.assert_called_once()
+
+    def test_repr_hides_values(self):
+        self.assertNotIn('secret', repr(ConnectionRecord(FIELDS)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+import unittest
+
+from airflow_sops.refresher import BackgroundRefresher
+
+
+def _in_forked_child(check) -> int:
+    """Run `check()` in a forked child; returns the exit status, 0 when it returned True."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os._exit(0 if check() else 1)
+        except BaseException:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status)
+
+
+class TestBackgroundRefresher(unittest.TestCase):
+
+    def setUp(self):
+        self.refresher = BackgroundRefresher()
+        self.addCleanup(self.refresher.stop, 1)
+
+    def test_runs_scheduled_refresh(self):
+        done = threading.Event()
+        self.refresher.schedule('key', done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_pending_key_is_scheduled_once(self):
+        release = threading.Event()
+        calls = []
+
+        def refresh():
+            calls.append(1)
+            release.wait(5)
+
+        self.refresher.schedule('key', refresh)
+        self.refresher.schedule('key', refresh)
+        self.assertTrue(self.refresher.is_pending('key'))
+        release.set()
+        done = threading.Event()
+        self.refresher.schedule('other', done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(1, len(calls))
+
+    def test_failed_refresh_is_dropped(self):
+        def fail():
+            raise ValueError("unavailable")
+
+        self.refresher.schedule('key', fail)
+        done = threading.Event()
+        self.refresher.schedule('other', done.set)
+        self.assertTrue(done.wait(5))
+        self.assertFalse(self.refresher.is_pending('key'))
+
+    def test_stop_drops_pending_refreshes(self):
+        calls = []
+        self.refresher.schedule('key', lambda: calls.append(1), due=time.monotonic() + 3600)
+        self.refresher.stop(1)
+        self.refresher.schedule('other', lambda: calls.append(1))
+        self.assertEqual([], calls)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_refreshes_run_in_forked_process(self):
+        # the parent's thread is running, and a refresh is pending when the process forks
+        self.refresher.schedule('parent', lambda: None, due=time.monotonic() + 3600)
+
+        def refreshed_in_child():
+            done = threading.Event()
+            self.refresher.schedule('parent', done.set)
+            return done.wait(5)
+
+        self.assertEqual(0, _in_forked_child(refreshed_in_child))
+        self.assertTrue(self.refresher.is_pending('parent'))
@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+import unittest
+
+from google.api_core.exceptions import BadGateway, GatewayTimeout, NotFound, ServiceUnavailable, from_http_status
+from requests.exceptions import ReadTimeout
+
+from airflow_sops.resilience import EntryHealth, LatencyTracker, RequestPolicy, is_transient
+
+
+def _in_forked_child(check) -> int:
+    """Run `check()` in a forked child; returns the exit status, 0 when it returned True."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os._exit(0 if check() else 1)
+        except BaseException:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status)
+
+
+class TestIsTransient(unittest.TestCase):
+
+    def test_transient_errors(self):
+        self.assertTrue(is_transient(ServiceUnavailable("try again")))
+        self.assertTrue(is_transient(ConnectionResetError()))
+        # what the storage library retries by default
+        self.assertTrue(is_transient(ReadTimeout("read timed out")))
+        self.assertTrue(is_transient(BadGateway("bad gateway")))
+        self.assertTrue(is_transient(GatewayTimeout("gateway timeout")))
+        self.assertTrue(is_transient(from_http_status(408, "request timeout")))
+        self.assertFalse(is_transient(NotFound("gone")))
+        self.assertFalse(is_transient(ValueError("bad")))
+
+
+class TestLatencyTracker(unittest.TestCase):
+
+    def test_quantile_needs_min_samples(self):
+        tracker = LatencyTracker(min_samples=10)
+        for i in range(9):
+            tracker.record(i)
+        self.assertIsNone(tracker.quantile(0.95))
+        tracker.record(100)
+        self.assertEqual(100, tracker.quantile(0.95))
+        self.assertEqual(5, tracker.quantile(0.5))
+
+
+class TestRequestPolicy(unittest.TestCase):
+
+    def test_retries_transient_errors(self):
+        calls = []
+
+        def flaky(timeout):
+            calls.append(timeout)
+            if len(calls) < 3:
+                raise ServiceUnavailable("try again")
+            return 'ok'
+
+        policy = RequestPolicy(timeout=5, max_retries=3, backoff=0.001)
+        self.assertEqual('ok', policy.call('gcs_download', flaky))
+        self.assertEqual([5, 5, 5], calls)
+
+    def test_retries_read_timeouts(self):
+        calls = []
+
+        def slow(timeout):
+            calls.append(timeout)
+            if len(calls) < 2:
+                raise ReadTimeout("read timed out (read timeout=1)")
+            return 'ok'
+
+        self.assertEqual('ok', RequestPolicy(timeout=1, max_retries=3, backoff=0.001).call('gcs_download', slow))
+        self.assertEqual(2, len(calls))
+
+    def test_does_not_retry_permanent_errors(self):
+        calls = []
+
+        def missing(timeout):
+            calls.append(timeout)
+            raise NotFound("gone")
+
+        with self.assertRaises(NotFound):
+            RequestPolicy(max_retries=3, backoff=0.001).call('gcs_download', missing)
+        self.assertEqual(1, len(calls))
+
+    def test_deadline_bounds_timeout_and_retries(self):
+        timeouts = []
+
+        def unavailable(timeout):
+            timeouts.append(timeout)
+            raise ServiceUnavailable("down")
+
+        policy = RequestPolicy(timeout=10, max_retries=100, backoff=0.05)
+        start = time.monotonic()
+        with self.assertRaises(ServiceUnavailable):
+            policy.call('kms_unwrap', unavailable, deadline=start + 0.3)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertLessEqual(timeouts[0], 0.3)
+
+    def test_hedges_slow_request(self):
+        policy = RequestPolicy(hedge=True)
+        for _ in range(20):
+            policy.call('gcs_download', lambda timeout: 'warm')
+        release = threading.Event()
+        calls = []
+
+        def first_call_hangs(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                release.wait(5)
+                return 'slow'
+            return 'hedged'
+
+        start = time.monotonic()
+        self.assertEqual('hedged', policy.call('gcs_download', first_call_hangs))
+        self.assertLess(time.monotonic() - start, 1)
+        release.set()
+        policy.close()
+
+    def test_hedged_attempts_do_not_queue_behind_a_busy_pool(self):
+        policy = RequestPolicy(timeout=1.0, hedge=True, max_workers=4)
+        for _ in range(20):
+            policy.call('gcs_download', lambda timeout: 'warm')
+
+        def slow(timeout):
+            time.sleep(0.3)
+            return 'done'
+
+        results, errors = [], []
+
+        def caller():
+            try:
+                results.append(policy.call('gcs_download', slow))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=caller) for _ in range(32)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        policy.close()
+        self.assertEqual([], errors)
+        self.assertEqual(['done'] * 32, results)
+        self.assertLess(time.monotonic() - start, 1)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_hedge_pool_works_in_forked_process(self):
+        policy = RequestPolicy(hedge=True, max_workers=2)
+        self.addCleanup(policy.close)
+        self.assertEqual('parent', policy._start(lambda timeout: 'parent', None).result(5))
+        self.assertEqual(0, _in_forked_child(lambda: policy._start(lambda timeout: 'child', None).result(5) == 'child'))
+
+
+class TestEntryHealth(unittest.TestCase):
+
+    def test_rank(self):
+        health = EntryHealth()
+        health.record('slow', 0.5)
+        health.record('fast', 0.05)
+        health.record('failing', failed=True)
+        self.assertEqual([1, 0, 3, 2], health.rank(['slow', 'fast', 'failing', 'unknown']))
+
+    def test_recovered_entry_ranks_healthy_again(self):
+        health = EntryHealth(alpha=0.5)
+        health.record('a', failed=True)
+        health.record('a', 0.1)
+        health.record('a', 0.1)
+        health.record('b', 0.5)
+        self.assertEqual([0, 1], health.rank(['a', 'b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
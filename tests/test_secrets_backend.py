@@ -0,0 +1,679 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO, StringIO
+from unittest import mock
+
+from airflow.exceptions import AirflowException
+from google.api_core.exceptions import NotFound, ServiceUnavailable
+from ruamel.yaml import YAML
+
+from airflow_sops.bundle import build_bundle, dump_bundle
+from airflow_sops.helpers import _walk_and_encrypt
+from airflow_sops.secrets_backend import GcsSopsSecretsBackend
+
+KMS_TREE = {
+    'sops': {
+        'gcp_kms': [
+            {'resource_id': 'projects/p/locations/l/keyRings/r/cryptoKeys/k', 'enc': 'd3JhcHBlZA=='},
+        ]
+    }
+}
+
+
+def _backend(**kwargs):
+    # the connections index has its own tests, the others look connections up one by one
+    kwargs.setdefault('connections_index_ttl', None)
+    backend = GcsSopsSecretsBackend(bucket_name='bucket', **kwargs)
+    backend.storage_client = mock.MagicMock()
+    backend.kms_client = mock.MagicMock()
+    return backend
+
+
+def _concurrently(fn, threads=8):
+    """Call `fn` from several threads at once and return the results."""
+    barrier = threading.Barrier(threads)
+    results = [None] * threads
+
+    def run(i):
+        barrier.wait()
+        results[i] = fn()
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+class TestLazyClients(unittest.TestCase):
+
+    def test_clients_are_created_on_first_use(self):
+        with mock.patch('google.auth.default', return_value=(None, 'discovered')) as default, \
+                mock.patch('google.cloud.storage.Client') as storage_client:
+            backend = GcsSopsSecretsBackend(bucket_name='bucket')
+            default.assert_not_called()
+            storage_client.assert_not_called()
+
+            self.assertIs(backend.storage_client, backend.storage_client)
+            storage_client.assert_called_once_with(project='discovered')
+            default.assert_called_once_with()
+
+    def test_pooled_http_session(self):
+        from google.cloud.storage import Client
+        from google.oauth2 import service_account
+        # key file credentials have no scopes until given some
+        credentials = service_account.Credentials(mock.Mock(), 'sa@p.iam.gserviceaccount.com',
+                                                  'https://oauth2.googleapis.com/token')
+        self.assertTrue(credentials.requires_scopes)
+        with mock.patch('google.auth.default', return_value=(credentials, 'discovered')), \
+                mock.patch('google.cloud.storage.Client') as storage_client:
+            storage_client.SCOPE = Client.SCOPE
+            backend = GcsSopsSecretsBackend(bucket_name='bucket', http_pool_size=32)
+            backend.storage_client
+            session = storage_client.call_args.kwargs['_http']
+            self.assertFalse(session.credentials.requires_scopes)
+            self.assertEqual(list(Client.SCOPE), list(session.credentials.scopes))
+            self.assertIs(session.credentials, storage_client.call_args.kwargs['credentials'])
+            self.assertEqual(32, session.get_adapter('https://storage.googleapis.com')._pool_maxsize)
+
+    def test_kms_keepalive(self):
+        with mock.patch('google.auth.default', return_value=(mock.Mock(), 'discovered')), \
+                mock.patch('google.cloud.kms.KeyManagementServiceClient') as kms_client, \
+                mock.patch('google.cloud.kms_v1.services.key_management_service.transports.'
+                           'KeyManagementServiceGrpcTransport') as transport:
+            backend = GcsSopsSecretsBackend(bucket_name='bucket', kms_keepalive_ms=30000)
+            self.assertIs(backend.kms_client, backend.kms_client)
+            options = dict(transport.create_channel.call_args.kwargs['options'])
+            self.assertEqual(30000, options['grpc.keepalive_time_ms'])
+            kms_client.assert_called_once_with(transport=transport.return_value)
+
+    def test_bucket_handle_is_reused(self):
+        backend = _backend()
+        self.assertIs(backend.bucket, backend.bucket)
+        backend.storage_client.bucket.assert_called_once_with('bucket')
+
+
+class TestKeyCache(unittest.TestCase):
+
+    def test_repeat_unwrap_skips_kms(self):
+        backend = _backend()
+        backend.kms_client.decrypt.return_value = mock.Mock(plaintext=b'k' * 32)
+
+        self.assertEqual(b'k' * 32, backend._get_key_from_kms(KMS_TREE))
+        self.assertEqual(b'k' * 32, backend._get_key_from_kms(KMS_TREE))
+        self.assertEqual(1, backend.kms_client.decrypt.call_count)
+
+    def test_invalidate_key_cache(self):
+        backend = _backend()
+        backend.kms_client.decrypt.return_value = mock.Mock(plaintext=b'k' * 32)
+
+        backend._get_key_from_kms(KMS_TREE)
+        backend.invalidate_key_cache()
+        backend._get_key_from_kms(KMS_TREE)
+        self.assertEqual(2, backend.kms_client.decrypt.call_count)
+
+    def test_key_service_is_asked_first(self):
+        backend = _backend(key_service_socket='/tmp/keyservice.sock')
+        backend.key_service = mock.Mock()
+        backend.key_service.unwrap.return_value = b's' * 32
+
+        self.assertEqual(b's' * 32, backend._get_key_from_kms(KMS_TREE))
+        self.assertEqual(0, backend.kms_client.decrypt.call_count)
+
+        backend.invalidate_key_cache()
+        backend.key_service.unwrap.return_value = None
+        backend.kms_client.decrypt.return_value = mock.Mock(plaintext=b'k' * 32)
+        self.assertEqual(b'k' * 32, backend._get_key_from_kms(KMS_TREE))
+
+    def test_concurrent_misses_share_one_unwrap(self):
+        backend = _backend()
+        backend.kms_client.decrypt.side_effect = lambda **kwargs: time.sleep(0.05) or mock.Mock(plaintext=b'k' * 32)
+
+        self.assertEqual([b'k' * 32] * 8, _concurrently(lambda: backend._get_key_from_kms(KMS_TREE)))
+        self.assertEqual(1, backend.kms_client.decrypt.call_count)
+
+    def test_disabled_key_cache(self):
+        backend = _backend(key_cache_max_size=0)
+        backend.kms_client.decrypt.return_value = mock.Mock(plaintext=b'k' * 32)
+
+        backend._get_key_from_kms(KMS_TREE)
+        backend._get_key_from_kms(KMS_TREE)
+        self.assertEqual(2, backend.kms_client.decrypt.call_count)
+
+
+class TestConnectionsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = _backend(connections_cache_ttl=0)
+        self.bucket = self.backend.storage_client.bucket.return_value
+        self.blob = mock.Mock(generation=1)
+        self.bucket.get_blob.return_value = self.blob
+        self.bucket.blob.return_value = self.blob
+        self.backend._decrypt_stream = mock.Mock(return_value={'conn_type': 'http', 'host': 'example.com'})
+
+    def test_cold_load_is_one_download(self):
+        self.assertEqual('example.com', self.backend.get_connection('http_conn').host)
+        self.bucket.get_blob.assert_not_called()
+        self.assertEqual(1, self.blob.download_to_file.call_count)
+        self.assertEqual(1, self.backend.connections_cache.get('sops/connections/http_conn.enc.yaml').generation)
+
+    def test_unchanged_generation_skips_download(self):
+        self.assertEqual('example.com', self.backend.get_connection('http_conn').host)
+        self.assertEqual('example.com', self.backend.get_connection('http_conn').host)
+        self.assertEqual(1, self.bucket.get_blob.call_count)
+        self.assertEqual(1, self.blob.download_to_file.call_count)
+        self.assertEqual(1, self.backend._decrypt_stream.call_count)
+
+    def test_new_generation_is_downloaded(self):
+        self.backend.get_connection('http_conn')
+        self.blob.generation = 2
+        self.backend.get_connection('http_conn')
+        self.assertEqual(2, self.blob.download_to_file.call_count)
+        self.assertEqual(2, self.backend._decrypt_stream.call_count)
+
+    def test_cached_uri_skips_connection_construction(self):
+        self.backend.connections_cache_ttl = 60
+        uri = self.backend.get_conn_uri('http_conn')
+        with mock.patch('airflow.models.connection.Connection') as connection:
+            self.assertEqual(uri, self.backend.get_conn_uri('http_conn'))
+        connection.assert_not_called()
+        self.assertEqual('http://example.com', uri)
+
+    def test_connections_are_not_shared(self):
+        self.backend.connections_cache_ttl = 60
+        first = self.backend.get_connection('http_conn')
+        first.host = 'changed'
+        self.assertEqual('example.com', self.backend.get_connection('http_conn').host)
+
+    def test_fresh_entry_skips_metadata_check(self):
+        self.backend.connections_cache_ttl = 60
+        self.backend.get_connection('http_conn')
+        self.backend.get_connection('http_conn')
+        self.bucket.get_blob.assert_not_called()
+        self.assertEqual(1, self.blob.download_to_file.call_count)
+
+
+class TestVariablesCache(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = _backend()
+        self.bucket = self.backend.storage_client.bucket.return_value
+        self.blob = mock.Mock(generation=1)
+        self.bucket.blob.return_value = self.blob
+        self.blob.download_to_file.side_effect = lambda file_obj, **kwargs: file_obj.write(b'a: "1"\nb: "2"\n')
+
+    def test_variables_file_is_read_once(self):
+        self.assertEqual('1', self.backend.get_variable('a'))
+        self.assertEqual('2', self.backend.get_variable('b'))
+        self.assertIsNone(self.backend.get_variable('c'))
+        self.assertEqual(1, self.blob.download_to_file.call_count)
+        self.bucket.blob.assert_called_once_with('sops/variables.yaml')
+
+    def test_get_variables(self):
+        self.assertEqual({'a': '1', 'c': None}, self.backend.get_variables(['a', 'c']))
+        self.assertEqual(1, self.blob.download_to_file.call_count)
+
+    def test_concurrent_misses_share_one_download(self):
+        self.blob.download_to_file.side_effect = \
+            lambda file_obj, **kwargs: time.sleep(0.05) or file_obj.write(b'a: "1"\n')
+        self.assertEqual(['1'] * 8, _concurrently(lambda: self.backend.get_variable('a')))
+        self.assertEqual(1, self.blob.download_to_file.call_count)
+
+    def test_waiting_threads_share_the_error(self):
+        self.blob.download_to_file.side_effect = lambda file_obj, **kwargs: time.sleep(0.2) or 1 / 0
+
+        def lookup():
+            try:
+                self.backend.get_variable('a')
+            except ZeroDivisionError as e:
+                return e
+
+        self.assertEqual(8, len([error for error in _concurrently(lookup) if error is not None]))
+        self.assertEqual(1, self.blob.download_to_file.call_count)
+        self.assertEqual({}, self.backend._inflight)
+
+
+class TestConnectionsIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = _backend(connections_index_ttl=300)
+        blob = mock.Mock(generation=1)
+        blob.name = 'sops/connections/a.enc.yaml'
+        self.backend.storage_client.list_blobs.return_value = [blob]
+        self.bucket = self.backend.storage_client.bucket.return_value
+        self.bucket.blob.side_effect = lambda name, **kwargs: blob if name == blob.name else self._missing_blob()
+        self.downloads = []
+        self.backend._decrypt_stream = mock.Mock(return_value={'conn_type': 'http', 'host': 'h'})
+
+    def _missing_blob(self):
+        missing = mock.Mock(generation=None)
+        missing.download_to_file.side_effect = NotFound("gone")
+        self.downloads.append(missing)
+        return missing
+
+    def test_existing_connection_does_not_wait_for_a_listing(self):
+        self.assertEqual('h', self.backend.get_connection('a').host)
+        self.backend.storage_client.list_blobs.assert_not_called()
+
+    def test_missing_connections_are_answered_from_index(self):
+        self.assertIsNone(self.backend.get_connection('missing'))
+        self.assertEqual(1, self.backend.storage_client.list_blobs.call_count)
+        self.assertIsNone(self.backend.get_connection('other'))
+        self.assertEqual({'missing': None, 'third': None}, self.backend.get_connections(['missing', 'third']))
+        self.assertEqual('h', self.backend.get_connection('a').host)
+        self.assertEqual(1, self.backend.storage_client.list_blobs.call_count)
+        self.assertEqual(1, len(self.downloads))
+
+    def test_unlistable_folder_falls_back_to_lookups(self):
+        self.backend.storage_client.list_blobs.side_effect = PermissionError("denied")
+        self.assertIsNone(self.backend.get_connection('missing'))
+        self.assertIsNone(self.backend.get_connection('other'))
+        self.assertEqual(1, self.backend.storage_client.list_blobs.call_count)
+        self.assertEqual(2, len(self.downloads))
+
+    def test_missing_variables_file(self):
+        self.assertIsNone(self.backend.get_variable('a'))
+        self.assertIsNone(self.backend.get_variable('b'))
+        self.assertEqual(1, len(self.downloads))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_phases_and_counters_go_to_stats(self):
+        with mock.patch('airflow.stats.Stats') as stats:
+            backend = _backend()
+        backend.kms_client.decrypt.return_value = mock.Mock(plaintext=b'k' * 32)
+        backend._get_key_from_kms(KMS_TREE)
+        backend._get_key_from_kms(KMS_TREE)
+
+        timings = [c.args[0] for c in stats.timing.call_args_list]
+        self.assertEqual(['sops_secrets.kms_unwrap'], timings)
+        stats.incr.assert_any_call('sops_secrets.key_cache.miss', 1)
+        stats.incr.assert_any_call('sops_secrets.key_cache.hit', 1)
+
+    def test_disabled_metrics(self):
+        backend = _backend(metrics=False)
+        self.assertIsNone(backend.metrics.stats)
+        with backend.metrics.phase('parse'):
+            backend.metrics.incr('key_cache.hit')
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def test_second_backend_reads_from_disk(self):
+        with tempfile.TemporaryDirectory() as disk_cache_dir:
+            for expected_downloads in (1, 0):
+                backend = _backend(disk_cache_dir=disk_cache_dir)
+                blob = backend.storage_client.bucket.return_value.get_blob.return_value
+                blob.name = 'sops/variables.yaml'
+                blob.generation = 7
+                blob.download_to_file.side_effect = lambda file_obj, **kwargs: file_obj.write(b'a: "1"\n')
+
+                self.assertEqual('1', backend.get_variable('a'))
+                self.assertEqual(expected_downloads, blob.download_to_file.call_count)
+
+
+class TestPrefetchConnections(unittest.TestCase):
+
+    def test_prefetch_unwraps_each_data_key_once(self):
+        backend = _backend()
+        blobs = [mock.Mock(generation=1), mock.Mock(generation=1), mock.Mock(generation=1)]
+        blobs[0].name = 'sops/connections/a.enc.yaml'
+        blobs[1].name = 'sops/connections/b.enc.yaml'
+        blobs[2].name = 'sops/connections/readme.txt'
+        backend.storage_client.list_blobs.return_value = blobs
+        backend._parse_stream = mock.Mock(side_effect=lambda stream: {'sops': KMS_TREE['sops'], 'host': 'h'})
+        backend._get_key = mock.Mock(side_effect=lambda tree: (b'k' * 32, tree))
+        backend._decrypt_tree = mock.Mock(side_effect=lambda tree, ignore_mac, key, version: {'host': tree['host']})
+
+        self.assertEqual(2, backend.prefetch_connections())
+        backend.storage_client.list_blobs.assert_called_once_with('bucket', prefix='sops/connections/')
+        self.assertEqual(1, backend._get_key.call_count)
+        self.assertEqual(0, blobs[2].download_to_file.call_count)
+
+        backend.storage_client.bucket.return_value.get_blob.return_value = blobs[0]
+        self.assertEqual('h', backend.get_connection('a').host)
+        self.assertEqual(1, blobs[0].download_to_file.call_count)
+
+    def test_prefetch_skips_failing_blobs(self):
+        backend = _backend()
+        blob = mock.Mock(generation=1)
+        blob.name = 'sops/connections/a.enc.yaml'
+        blob.download_to_file.side_effect = IOError("boom")
+        backend.storage_client.list_blobs.return_value = [blob]
+
+        self.assertEqual(0, backend.prefetch_connections())
+        self.assertEqual(0, len(backend.connections_cache))
+
+
+class TestGetConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = _backend()
+        self.blobs = {}
+        for name in ('a', 'b'):
+            blob = mock.Mock(generation=1)
+            blob.name = 'sops/connections/{}.enc.yaml'.format(name)
+            self.blobs[blob.name] = blob
+        self.bucket = self.backend.storage_client.bucket.return_value
+        self.bucket.blob.side_effect = self._blob
+        self.backend._parse_stream = mock.Mock(side_effect=lambda stream: {'sops': KMS_TREE['sops']})
+        self.backend._get_key = mock.Mock(side_effect=lambda tree: (b'k' * 32, tree))
+        self.backend._decrypt_tree = mock.Mock(return_value={'conn_type': 'http', 'host': 'h'})
+
+    def _blob(self, name, **kwargs):
+        if name in self.blobs:
+            return self.blobs[name]
+        missing = mock.Mock(generation=None)
+        missing.download_to_file.side_effect = NotFound("gone")
+        return missing
+
+    def test_batch_reports_errors_per_id(self):
+        connections = self.backend.get_connections(['a', 'b', 'missing', 'a'])
+        self.assertEqual(['a', 'b', 'missing'], list(connections))
+        self.assertEqual('h', connections['a'].host)
+        self.assertEqual('h', connections['b'].host)
+        self.assertIsNone(connections['missing'])
+        self.assertEqual(1, self.backend._get_key.call_count)
+        # nothing cached, so each blob is downloaded without fetching its metadata first
+        self.bucket.get_blob.assert_not_called()
+
+    def test_return_exceptions(self):
+        self.backend._decrypt_tree.side_effect = ValueError("bad")
+        connections = self.backend.get_connections(['a', 'missing'], return_exceptions=True)
+        self.assertIsInstance(connections['a'], ValueError)
+        self.assertIsNone(connections['missing'])
+
+    def test_batch_uses_cache(self):
+        self.backend.get_connections(['a'])
+        self.backend.get_connections(['a'])
+        self.assertEqual(1, self.blobs['sops/connections/a.enc.yaml'].download_to_file.call_count)
+
+
+class TestEncryptedVariables(unittest.TestCase):
+
+    def test_encrypted_variables(self):
+        key = os.urandom(32)
+        document = {'a': '1', 'b': '2', 'sops': {'gcp_kms': list(KMS_TREE['sops']['gcp_kms'])}}
+        stream = BytesIO()
+        YAML(typ='safe', pure=True).dump(_walk_and_encrypt(document, key), stream)
+
+        for ignore_mac in (True, False):
+            backend = _backend(variables_encrypted=True, ignore_mac=ignore_mac)
+            backend.kms_client.decrypt.return_value = mock.Mock(plaintext=key)
+            bucket = backend.storage_client.bucket.return_value
+            blob = bucket.blob.return_value
+            blob.download_to_file.side_effect = lambda file_obj, **kwargs: file_obj.write(stream.getvalue())
+
+            self.assertEqual({'a': '1', 'c': None}, backend.get_variables(['a', 'c']))
+            self.assertEqual('2', backend.get_variable('b'))
+            bucket.blob.assert_called_once_with('sops/variables.enc.yaml')
+
+
+def _wait_for_refresh(backend, key):
+    deadline = time.monotonic() + 5
+    while backend.refresher.is_pending(key) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+
+    def _backend(self, **kwargs):
+        backend = _backend(**kwargs)
+        self.bucket = backend.storage_client.bucket.return_value
+        self.bucket.get_blob.return_value = self.bucket.blob.return_value = mock.Mock(generation=1)
+        backend._decrypt_stream = mock.Mock(return_value={'conn_type': 'http', 'host': 'example.com'})
+        self.addCleanup(backend._cleanup)
+        return backend
+
+    def test_hot_entry_is_refreshed_before_expiry(self):
+        backend = self._backend(connections_cache_ttl=0.4, refresh_ahead=0.3)
+        backend.get_connection('http_conn')
+        backend.get_connection('http_conn')
+        time.sleep(0.25)
+        _wait_for_refresh(backend, ('connections_cache', 'sops/connections/http_conn.enc.yaml'))
+
+        # the first load downloads the blob, the refresh only checks its generation
+        self.assertEqual(1, self.bucket.get_blob.call_count)
+        self.assertEqual('example.com', backend.get_connection('http_conn').host)
+        self.assertEqual(1, self.bucket.get_blob.call_count)
+
+    def test_expired_entry_is_served_while_refreshing(self):
+        backend = self._backend(connections_cache_ttl=0, refresh_ahead=0, max_staleness=60)
+        backend.get_connection('http_conn')
+        release = threading.Event()
+        self.bucket.get_blob.side_effect = lambda name: release.wait(5) and mock.Mock(generation=2)
+
+        self.assertEqual('example.com', backend.get_connection('http_conn').host)
+        release.set()
+        _wait_for_refresh(backend, ('connections_cache', 'sops/connections/http_conn.enc.yaml'))
+        self.assertEqual(2, backend._decrypt_stream.call_count)
+        self.assertEqual(2, backend.connections_cache.get('sops/connections/http_conn.enc.yaml').generation)
+
+    def test_failed_reload_serves_stale_value(self):
+        backend = self._backend(connections_cache_ttl=0, max_staleness=60)
+        backend.get_connection('http_conn')
+        self.bucket.get_blob.side_effect = ConnectionError("GCS unavailable")
+
+        self.assertEqual('example.com', backend.get_connection('http_conn').host)
+        self.assertEqual('example.com', backend.get_connections(['http_conn'])['http_conn'].host)
+
+    def test_failed_reload_raises_past_max_staleness(self):
+        backend = self._backend(connections_cache_ttl=0)
+        backend.get_connection('http_conn')
+        self.bucket.get_blob.side_effect = ConnectionError("GCS unavailable")
+
+        with self.assertRaises(ConnectionError):
+            backend.get_connection('http_conn')
+
+
+class TestRequestPolicy(unittest.TestCase):
+
+    def test_library_defaults_without_settings(self):
+        backend = _backend()
+        download = backend.storage_client.bucket.return_value.blob.return_value.download_to_file
+        download.side_effect = NotFound("gone")
+        self.assertIsNone(backend.get_connection('http_conn'))
+        download.assert_called_once()
+        self.assertEqual({}, download.call_args.kwargs)
+
+    def test_transient_errors_are_retried_within_deadline(self):
+        backend = _backend(request_timeout=5, lookup_deadline=30, max_retries=2, retry_backoff=0.001)
+        download = backend.storage_client.bucket.return_value.blob.return_value.download_to_file
+        download.side_effect = [ServiceUnavailable("try again"), NotFound("gone")]
+
+        self.assertIsNone(backend.get_connection('http_conn'))
+        self.assertEqual(2, download.call_count)
+        self.assertIsNone(download.call_args.kwargs['retry'])
+        self.assertLessEqual(download.call_args.kwargs['timeout'], 5)
+
+    def test_timeout_alone_keeps_library_retries(self):
+        backend = _backend(request_timeout=5)
+        download = backend.storage_client.bucket.return_value.blob.return_value.download_to_file
+        download.side_effect = NotFound("gone")
+        self.assertIsNone(backend.get_connection('http_conn'))
+        self.assertEqual({'timeout': 5}, download.call_args.kwargs)
+
+    def test_deadline_is_shared_by_concurrent_requests(self):
+        backend = _backend(lookup_deadline=30, max_workers=4)
+        deadlines = []
+
+        def revalidate(*args):
+            deadlines.append(backend._deadlines.deadline)
+            raise ValueError("unavailable")
+
+        backend._blob_to_load = revalidate
+        backend.get_connections(['a', 'b', 'c'])
+        self.assertEqual(3, len(deadlines))
+        self.assertEqual(1, len(set(deadlines)))
+        self.assertIsNone(getattr(backend._deadlines, 'deadline', None))
+
+
+TWO_REGIONS_TREE = {
+    'sops': {
+        'gcp_kms': [
+            {'resource_id': 'projects/p/locations/far/keyRings/r/cryptoKeys/k', 'enc': 'ZmFy'},
+            {'resource_id': 'projects/p/locations/near/keyRings/r/cryptoKeys/k', 'enc': 'bmVhcg=='},
+        ]
+    }
+}
+
+
+class TestKeyEntryRace(unittest.TestCase):
+
+    def _backend(self, far_delay=0.0, far_error=None):
+        backend = _backend(race_key_entries=True)
+        self.addCleanup(backend._cleanup)
+        self.calls = []
+
+        def decrypt(request, **kwargs):
+            self.calls.append(request.name)
+            if '/far/' in request.name:
+                time.sleep(far_delay)
+                if far_error is not None:
+                    raise far_error
+                return mock.Mock(plaintext=b'f' * 32)
+            return mock.Mock(plaintext=b'n' * 32)
+
+        backend.kms_client.decrypt.side_effect = decrypt
+        return backend
+
+    def test_first_answer_wins(self):
+        backend = self._backend(far_delay=0.5)
+        start = time.monotonic()
+        key, _ = backend._get_key(TWO_REGIONS_TREE)
+        self.assertEqual(b'n' * 32, key)
+        self.assertLess(time.monotonic() - start, 0.4)
+
+    def test_failing_entry_falls_back(self):
+        backend = self._backend(far_error=PermissionError("denied"))
+        key, _ = backend._get_key(TWO_REGIONS_TREE)
+        self.assertEqual(b'n' * 32, key)
+
+    def test_fastest_healthy_entry_starts_first(self):
+        backend = self._backend(far_error=PermissionError("denied"))
+        backend.key_race_width = 1
+        backend._get_key(TWO_REGIONS_TREE)
+        self.assertEqual(['projects/p/locations/far/keyRings/r/cryptoKeys/k',
+                          'projects/p/locations/near/keyRings/r/cryptoKeys/k'], self.calls)
+
+        backend.invalidate_key_cache()
+        self.calls.clear()
+        backend._get_key(TWO_REGIONS_TREE)
+        self.assertEqual(['projects/p/locations/near/keyRings/r/cryptoKeys/k'], self.calls)
+
+    def test_pgp_entries_race_too(self):
+        backend = self._backend(far_error=PermissionError("denied"))
+        tree = {'sops': {'gcp_kms': TWO_REGIONS_TREE['sops']['gcp_kms'][:1], 'pgp': [{'fp': 'F', 'enc': 'x'}]}}
+        with mock.patch('airflow_sops.secrets_backend._get_key_from_pgp', return_value=b'p' * 32):
+            key, _ = backend._get_key(tree)
+        self.assertEqual(b'p' * 32, key)
+
+    def test_no_entry_unwraps(self):
+        backend = self._backend(far_error=PermissionError("denied"))
+        with self.assertRaises(AirflowException):
+            backend._get_key({'sops': {'gcp_kms': TWO_REGIONS_TREE['sops']['gcp_kms'][:1]}})
+
+
+class TestMacVerification(unittest.TestCase):
+
+    def setUp(self):
+        self.key = os.urandom(32)
+        document = {'conn_type': 'http', 'host': 'example.com', 'sops': {'gcp_kms': list(KMS_TREE['sops']['gcp_kms'])}}
+        stream = StringIO()
+        YAML(typ='safe', pure=True).dump(_walk_and_encrypt(document, self.key), stream)
+        self.data = stream.getvalue().encode('utf-8')
+        self.backend = _backend(ignore_mac=False)
+        self.backend.kms_client.decrypt.return_value = mock.Mock(plaintext=self.key)
+        self.blob = mock.Mock(generation=1)
+        self.blob.name = 'sops/connections/http_conn.enc.yaml'
+        self.blob.download_to_file.side_effect = lambda file_obj, **kwargs: file_obj.write(self.data)
+        bucket = self.backend.storage_client.bucket.return_value
+        bucket.get_blob.return_value = bucket.blob.return_value = self.blob
+
+    def test_checked_once_per_generation(self):
+        with mock.patch('airflow_sops.secrets_backend._check_mac') as check_mac, \
+                mock.patch('airflow_sops.secrets_backend._check_rotation_needed') as check_rotation:
+            for _ in range(3):
+                self.assertEqual('example.com', self.backend.get_connection('http_conn').host)
+                self.backend.invalidate_connection_cache()
+            self.assertEqual(1, check_mac.call_count)
+            self.assertEqual(1, check_rotation.call_count)
+
+            self.blob.generation = 2
+            self.backend.get_connection('http_conn')
+            self.assertEqual(2, check_mac.call_count)
+            self.assertEqual(2, check_rotation.call_count)
+
+    def test_failed_verification_is_not_remembered(self):
+        tree = YAML(typ='safe').load(self.data)
+        tree['sops']['lastmodified'] = '2000-01-01T00:00:00Z'
+        stream = StringIO()
+        YAML(typ='safe', pure=True).dump(tree, stream)
+        self.data = stream.getvalue().encode('utf-8')
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                self.backend.get_connection('http_conn')
+            self.backend.invalidate_connection_cache()
+        self.assertFalse(self.backend.checked_blobs.get(('sops/connections/http_conn.enc.yaml', 1)))
+
+
+class TestConnectionsBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.key = os.urandom(32)
+        connections = {'db': {'conn_type': 'postgres', 'host': 'db.internal', 'password': 'secret'},
+                       'api': {'conn_type': 'http', 'host': 'api.internal'}}
+        stream = StringIO()
+        dump_bundle(build_bundle(connections, self.key, kms_entries=list(KMS_TREE['sops']['gcp_kms'])), stream)
+        self.data = stream.getvalue().encode('utf-8')
+
+    def _bundle_backend(self, **kwargs):
+        backend = _backend(connections_bundle='connections', **kwargs)
+        backend.kms_client.decrypt.return_value = mock.Mock(plaintext=self.key)
+        blob = backend.storage_client.bucket.return_value.blob.return_value
+        blob.download_to_file.side_effect = lambda file_obj, **kwargs: file_obj.write(self.data)
+        return backend
+
+    def test_one_download_and_unwrap_for_all_connections(self):
+        for ignore_mac in (True, False):
+            backend = self._bundle_backend(ignore_mac=ignore_mac)
+            bucket = backend.storage_client.bucket.return_value
+
+            self.assertEqual('db.internal', backend.get_connection('db').host)
+            self.assertEqual('secret', backend.get_connection('db').password)
+            self.assertEqual('api.internal', backend.get_connection('api').host)
+            self.assertIsNone(backend.get_connection('missing'))
+            bucket.blob.assert_called_once_with('sops/connections.enc.yaml')
+            bucket.get_blob.assert_not_called()
+            self.assertEqual(1, bucket.blob.return_value.download_to_file.call_count)
+            self.assertEqual(1, backend.kms_client.decrypt.call_count)
+
+    def test_only_requested_connections_are_decrypted(self):
+        backend = self._bundle_backend()
+        backend.get_connection('db')
+        bundle = backend.bundle_cache.get('sops/connections.enc.yaml').value
+        self.assertEqual(['db'], list(bundle.subtrees._decrypted))
+
+    def test_get_connections_and_prefetch(self):
+        backend = self._bundle_backend()
+        connections = backend.get_connections(['db', 'missing'])
+        self.assertEqual('db.internal', connections['db'].host)
+        self.assertIsNone(connections['missing'])
+        self.assertEqual(2, backend.prefetch_connections())
+
+    def test_missing_bundle(self):
+        backend = _backend(connections_bundle='connections')
+        bucket = backend.storage_client.bucket.return_value
+        bucket.blob.return_value.download_to_file.side_effect = NotFound("gone")
+        self.assertIsNone(backend.get_connection('db'))
+        self.assertIsNone(backend.get_connection('db'))
+        bucket.blob.assert_called_once_with('sops/connections.enc.yaml')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import io
+import json
+import os
+import time
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from airflow_sops import __main__ as cli
+from airflow_sops.bundle import dump_bundle
+from airflow_sops.helpers import _walk_and_encrypt
+from airflow_sops.secrets_backend import GcsSopsSecretsBackend
+from airflow_sops.verify import DECRYPT_ERROR, MAC_MISMATCH, OK, UNKNOWN_TYPE, FileReport, list_encrypted_blobs, \
+    verify
+
+RESOURCE_ID = 'projects/p/locations/l/keyRings/r/cryptoKeys/k'
+
+
+def _dump(tree) -> bytes:
+    stream = StringIO()
+    dump_bundle(tree, stream)
+    return stream.getvalue().encode('utf-8')
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.key = os.urandom(32)
+        self.files = {}
+        self.backend = GcsSopsSecretsBackend(bucket_name='bucket', connections_index_ttl=None, metrics=False)
+        self.backend.storage_client = mock.MagicMock()
+        self.backend.kms_client = mock.MagicMock()
+        self.backend.kms_client.decrypt.return_value = mock.Mock(plaintext=self.key)
+        self.backend.storage_client.list_blobs.side_effect = lambda bucket_name, prefix: [
+            self._listed(name) for name in self.files if name.startswith(prefix)]
+        self.backend.storage_client.bucket.return_value.blob.side_effect = self._blob
+
+    def _listed(self, name):
+        blob = mock.Mock(generation=1)
+        blob.name = name
+        return blob
+
+    def _blob(self, name, generation=None):
+        blob = mock.Mock(generation=generation)
+        blob.name = name
+        blob.download_to_file.side_effect = lambda file_obj, **kwargs: file_obj.write(self.files[name])
+        return blob
+
+    def _encrypted(self, document, key=None, created_at='2022-01-01T00:00:00Z'):
+        document = dict(document, sops={'gcp_kms': [{'resource_id': RESOURCE_ID, 'enc': 'd3JhcHBlZA==',
+                                                     'created_at': created_at}]})
+        return _walk_and_encrypt(document, key or self.key)
+
+    def _verify(self):
+        return {report.name: report for report in verify({}, backend=self.backend)}
+
+    def test_reports_each_file(self):
+        self.files['sops/connections/good.enc.yaml'] = _dump(self._encrypted({'conn_type': 'http'}))
+        tampered = self._encrypted({'conn_type': 'http'})
+        tampered['sops']['lastmodified'] = '2000-01-01T00:00:00Z'
+        self.files['sops/connections/tampered.enc.yaml'] = _dump(tampered)
+        self.files['sops/connections/wrong_key.enc.yaml'] = _dump(self._encrypted({'conn_type': 'http'},
+                                                                                  key=os.urandom(32)))
+        odd = self._encrypted({'conn_type': 'http'})
+        odd['conn_type'] = odd['conn_type'].replace('type:str', 'type:complex')
+        self.files['sops/connections/odd.enc.yaml'] = _dump(odd)
+        # plain-text files are not sops files
+        self.files['sops/variables.yaml'] = b'foo: bar\n'
+
+        reports = self._verify()
+
+        self.assertEqual(['sops/connections/good.enc.yaml', 'sops/connections/odd.enc.yaml',
+                          'sops/connections/tampered.enc.yaml', 'sops/connections/wrong_key.enc.yaml'],
+                         sorted(reports))
+        self.assertEqual(OK, reports['sops/connections/good.enc.yaml'].status)
+        self.assertIsNone(reports['sops/connections/good.enc.yaml'].error)
+        self.assertEqual(MAC_MISMATCH, reports['sops/connections/tampered.enc.yaml'].status)
+        self.assertEqual(DECRYPT_ERROR, reports['sops/connections/wrong_key.enc.yaml'].status)
+        self.assertEqual(UNKNOWN_TYPE, reports['sops/connections/odd.enc.yaml'].status)
+        self.assertIn('unknown type complex', reports['sops/connections/odd.enc.yaml'].error)
+        for report in reports.values():
+            self.assertIsNotNone(report.download_ms)
+            self.assertIsNotNone(report.parse_ms)
+            self.assertIsNotNone(report.decrypt_ms)
+
+    def test_download_time_excludes_parsing(self):
+        self.files['sops/connections/db.enc.yaml'] = _dump(self._encrypted({'conn_type': 'http'}))
+        parse = self.backend._parse_stream
+        self.backend._parse_stream = lambda stream: time.sleep(0.05) or parse(stream)
+        report = self._verify()['sops/connections/db.enc.yaml']
+        self.assertLess(report.download_ms, 50)
+        self.assertGreaterEqual(report.parse_ms, 50)
+
+    def test_changed_values_fail_the_mac(self):
+        tree = self._encrypted({'conn_type': 'http', 'host': 'a.example.com'})
+        tree['host'] = self._encrypted({'host': 'b.example.com'})['host']
+        self.files['sops/connections/swapped.enc.yaml'] = _dump(tree)
+        report = self._verify()['sops/connections/swapped.enc.yaml']
+        self.assertEqual(MAC_MISMATCH, report.status)
+        self.assertIn('Checksum verification failed', report.error)
+
+    def test_key_age(self):
+        created_at = datetime.utcnow() - timedelta(days=30, hours=1)
+        self.files['sops/connections/db.enc.yaml'] = _dump(self._encrypted(
+            {'conn_type': 'http'}, created_at=created_at.strftime('%Y-%m-%dT%H:%M:%SZ')))
+        self.assertEqual(30, self._verify()['sops/connections/db.enc.yaml'].key_age_days)
+
+    def test_data_key_is_unwrapped_once(self):
+        for i in range(5):
+            self.files['sops/connections/conn_{}.enc.yaml'.format(i)] = _dump(self._encrypted({'conn_type': 'http'}))
+        reports = self._verify()
+        self.assertEqual({OK}, {report.status for report in reports.values()})
+        self.assertEqual(1, self.backend.kms_client.decrypt.call_count)
+
+    def test_lists_only_encrypted_files_under_the_root_folder(self):
+        self.files['sops/connections/db.enc.yaml'] = b''
+        self.files['sops/variables.yaml'] = b''
+        self.files['other/db.enc.yaml'] = b''
+        self.assertEqual([('sops/connections/db.enc.yaml', 1)], list_encrypted_blobs(self.backend))
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def _run(self, argv, reports):
+        stdout = io.StringIO()
+        with mock.patch('airflow_sops.verify.verify', return_value=reports) as verify_files, \
+                redirect_stdout(stdout):
+            status = cli.main(['verify', '--bucket', 'bucket', '--processes', '3'] + argv)
+        return status, stdout.getvalue(), verify_files
+
+    def test_exit_status(self):
+        ok = FileReport('sops/connections/a.enc.yaml', OK, None, 400, 1.0, 0.2, 2.0, 0.5)
+        broken = FileReport('sops/connections/b.enc.yaml', MAC_MISMATCH, 'MacMismatchError: ...', 3, 1.0, 0.2, 2.0, 0.5)
+
+        status, output, verify_files = self._run([], [ok])
+        self.assertEqual(0, status)
+        self.assertIn('400d!', output)
+        self.assertIn('1 ok, 0 failed, 1 with master keys older than 183 days', output)
+        kwargs = verify_files.call_args[0][0]
+        self.assertEqual('bucket', kwargs['bucket_name'])
+        self.assertFalse(kwargs['ignore_mac'])
+        self.assertEqual(3, verify_files.call_args[1]['processes'])
+
+        self.assertEqual(1, self._run(['--fail-on-key-age'], [ok])[0])
+        self.assertEqual(1, self._run([], [ok, broken])[0])
+
+    def test_json_report(self):
+        broken = FileReport('sops/connections/b.enc.yaml', MAC_MISMATCH, 'MacMismatchError: ...', 3, 1.0, 0.2, 2.0, 0.5)
+        status, output, _ = self._run(['--json'], [broken])
+        self.assertEqual(1, status)
+        report = json.loads(output)
+        self.assertEqual(MAC_MISMATCH, report['files'][0]['status'])
+        self.assertEqual(0.5, report['files'][0]['decrypt_ms'])
+
+    def test_unknown_command(self):
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.assertEqual(2, cli.main(['frobnicate']))
+
+
+if __name__ == '__main__':
+    unittest.main()